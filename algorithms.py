@@ -1,3 +1,5 @@
+import numpy as np
+
 def bresenham_line(origin, pos):
     line = []
 
@@ -93,49 +95,238 @@ def ellipse(origin, end):
 
     return path
 
-def flood_fill(origin, canvas):
+def ellipse_points(origin, end):
+    """
+    The same outline as ellipse(), without duplicate points, as arrays of
+    x and y coordinates.
+    """
+    mid = (round((end[0]-origin[0])/2), round((end[1]-origin[1])/2))
+
+    rx, ry = abs(mid[0]), abs(mid[1])
+    xc, yc = origin[0] + mid[0], origin[1] + mid[1]
+
+    if ry == 0:
+        left = min(origin[0], end[0])
+        right = max(origin[0], end[0])
+        xs = np.arange(left, right)
+        return xs, np.full(len(xs), yc)
+
+    # region 1: x steps by one, y follows the curve but drops at most one per step
+    x = np.arange(rx + 2)
+    if rx > 0:
+        curve = ry * np.sqrt(np.clip(1 - (x / rx) ** 2, 0, None))
+    else:
+        curve = np.zeros(len(x))
+    y = np.ceil(curve + 0.5) - 1
+    y[0] = ry
+    y = (np.maximum.accumulate(y + x) - x).astype(np.intp)
+
+    inRegion = ry * ry * x < rx * rx * y
+    count = len(x) if inRegion.all() else int(np.argmin(inRegion))
+    x1, y1 = x[:count], y[:count]
+
+    # region 2: y steps down by one, x follows the curve but grows at most one per step
+    y2 = np.arange(y[count] if count < len(y) else 0, -1, -1)
+    curve = rx * np.sqrt(np.clip(1 - (y2 / ry) ** 2, 0, None))
+    x2 = np.maximum(np.floor(curve + 0.5).astype(np.intp), count)
+    x2[0] = count
+    step = np.arange(len(x2))
+    x2 = np.minimum.accumulate(x2 - step) + step
+
+    # mirror the quadrant, skipping points on the axes which would repeat
+    qx, qy = np.concatenate((x1, x2)), np.concatenate((y1, y2))
+    flipX, flipY = qx > 0, qy > 0
+    both = flipX & flipY
+    xs = np.concatenate((qx, -qx[flipX], qx[flipY], -qx[both]))
+    ys = np.concatenate((qy, qy[flipX], -qy[flipY], -qy[both]))
+
+    return xs + xc, ys + yc
+
+def ellipse_spans(origin, end, filled=False, width=1):
+    """
+    Filled or thick ellipse as horizontal runs (y, x0, x1), x1 exclusive.
+    A thick outline is the filled ellipse minus the filled ellipse inset
+    by the stroke width.
+    """
+    outer = points_to_spans(*ellipse_points(origin, end))
+    if filled:
+        return outer
+
+    left, right = min(origin[0], end[0]), max(origin[0], end[0])
+    bottom, top = min(origin[1], end[1]), max(origin[1], end[1])
+    if right - left < 2 * width or top - bottom < 2 * width:
+        return outer    # nothing left inside the stroke
+
+    inner = dict((y, (x0, x1)) for y, x0, x1 in
+                 points_to_spans(*ellipse_points((left + width, bottom + width), (right - width, top - width))))
+
+    spans = []
+    for y, x0, x1 in outer:
+        if y in inner:
+            if x0 < inner[y][0]:
+                spans.append((y, x0, inner[y][0]))
+            if inner[y][1] < x1:
+                spans.append((y, inner[y][1], x1))
+        else:
+            spans.append((y, x0, x1))
+
+    return spans
+
+def flood_fill(origin, pixels, connectivity=4, tolerance=0):
     """
     "Paint bucket tool"
+
+    Returns the filled area as horizontal runs (y, x0, x1) in canvas
+    coordinates, an array with a row per run, x1 being exclusive. With
+    connectivity=8 diagonal neighbours are connected too, and tolerance is
+    the largest per-channel difference to the clicked color that still gets
+    filled.
+    """
+    if connectivity not in (4, 8):
+        raise ValueError("connectivity must be 4 or 8")
+
+    ox, oy = origin[0], pixels.height - 1 - origin[1]     # clicked position in buffer rows
+
+    # a painted pixel can only connect to pixels inside the painted area
+    rect = (0, 0, pixels.width, pixels.height)
+    if not pixels.is_empty(ox, oy) and pixels.paintedRect is not None:
+        rect = tuple(pixels.paintedRect)
+    left, top = rect[:2]
+
+    # mark every pixel that has the same color as the clicked one
+    match = pixels.same_color_mask(ox, oy, tolerance, rect)
+    height, width = match.shape
+    ox, oy = ox - left, oy - top
+
+    # split the matching pixels into horizontal runs: +1 where one starts and -1 where it ends, rows stride apart
+    stride = width + 1
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = match
+    edges = np.diff(padded, axis=1).ravel()
+    isStart = edges == 1
+    starts, ends = np.flatnonzero(isStart), np.flatnonzero(edges == -1)     # positions row*stride + x of every run
+    startCount = np.cumsum(isStart, dtype=np.int32)     # runs started up to each position
+    inside = padded[:, 1:].ravel()                      # whether a run covers each position
+
+    # find the run under the cursor
+    seed = startCount[oy*stride + ox] - 1
+
+    # the runs of the row below touching a run are those ending after its start and starting before its end
+    grow = 1 if connectivity == 8 else 0
+    upper = np.flatnonzero(starts < (height - 1)*stride).astype(np.int32)
+    below = starts[upper] + stride - grow
+    first = startCount[below] - inside[below]       # the runs ended up to there
+    last = startCount[ends[upper] + stride + grow - 1]
+    counts = last - first
+    lower = np.arange(counts.sum(), dtype=np.int32) + np.repeat(first - (np.cumsum(counts, dtype=np.int32) - counts), counts)
+    upper = np.repeat(upper, counts)
+
+    labels = connected_labels(len(starts), upper, lower)
+    area = np.flatnonzero(labels == labels[seed])
+    rows = starts[area] // stride
+    return np.column_stack((pixels.height - 1 - top - rows, starts[area] - rows*stride + left, ends[area] - rows*stride + left))
+
+def connected_labels(count, a, b):
+    """
+    Label count nodes joined by the edges a[i]-b[i] with the root of their
+    group. Each pass points the larger root of every edge still joining
+    two groups at the smaller one, then follows the pointers to the roots.
+    """
+    labels = np.arange(count, dtype=a.dtype)
+    la, lb = a, b
+    while len(a):
+        labels[np.maximum(la, lb)] = np.minimum(la, lb)
+        while True:
+            jumped = labels[labels]
+            if (jumped == labels).all():
+                break
+            labels = jumped
+        la, lb = labels[a], labels[b]
+        joined = la != lb
+        a, b, la, lb = a[joined], b[joined], la[joined], lb[joined]
+    return labels
+
+
+def run_positions(runs):
+    """
+    Expand (y, x0, x1) runs into arrays of y and x coordinates.
+    """
+    if not runs:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+
+    ys, x0s, x1s = (np.array(column, dtype=np.intp) for column in zip(*runs))
+    lengths = x1s - x0s
+    offsets = np.cumsum(lengths) - lengths                  # where each run starts in the output
+    xs = np.arange(lengths.sum()) - np.repeat(offsets - x0s, lengths)
+
+    return np.repeat(ys, lengths), xs
+
+def line_points(origin, pos):
     """
-    area = []
-
-    posList = []                                                    # a list for possible fillable positions
-    canvasCopy = canvas.copy()
-    posList.append((origin[0], len(canvasCopy) - 1 - origin[1]))    # add the clicked position to the list
-    prevColor = canvasCopy[origin[1]][origin[0]]                    # check the original color that will be recolored
-    newColor = [x+1 for x in prevColor]
-
-    while posList:
-        pos = posList.pop()   # take one position out of the list
-        if canvasCopy[pos[1]][pos[0]] == prevColor:
-            area.append((pos[0], len(canvasCopy) - 1 - pos[1]))
-            canvasCopy[pos[1]][pos[0]] = newColor
-
-            # check pos from upside
-            x, y = pos[0], pos[1] - 1
-            if y >= 0 and x >= 0 and y < len(canvasCopy) and x < len(canvasCopy[pos[1]]):
-                if canvasCopy[y][x] == prevColor:
-                    posList.append((x, y))
-
-            # check pos from downside
-            y = pos[1] + 1
-            if y >= 0 and x >= 0 and y < len(canvasCopy) and x < len(canvasCopy[pos[1]]):
-                if canvasCopy[y][x] == prevColor:
-                    posList.append((x, y))
-
-            # check pos from left side
-            x, y = pos[0] - 1, pos[1]
-            if y >= 0 and x >= 0 and y < len(canvasCopy) and x < len(canvasCopy[pos[1]]):
-                if canvasCopy[y][x] == prevColor:
-                    posList.append((x, y))
-
-            # check pos from right side
-            x = pos[0] + 1
-            if y >= 0 and x >= 0 and y < len(canvasCopy) and x < len(canvasCopy[pos[1]]):
-                if canvasCopy[y][x] == prevColor:
-                    posList.append((x, y))
-
-    return area
+    The same pixels as bresenham_line(), as arrays of x and y coordinates.
+    """
+    x0, y0 = origin[0], origin[1]
+    x1, y1 = pos[0], pos[1]
+
+    dx = abs(x1 - x0)
+    dy = abs(y1 - y0)
+
+    sx = -1 if x0 > x1 else 1
+    sy = -1 if y0 > y1 else 1
+
+    # the minor axis moves once every time the error term of bresenham_line wraps
+    if dx > dy:
+        step = np.arange(dx + 1)
+        return x0 + sx * step, y0 - sy * ((dx - 2 * step * dy) // (2 * dx))
+    elif dy > 0:
+        step = np.arange(dy + 1)
+        return x0 - sx * ((dy - 2 * step * dx) // (2 * dy)), y0 + sy * step
+    else:
+        return np.array([x0]), np.array([y0])
+
+def line_spans(origin, pos, width=1):
+    """
+    Line drawn with a square brush of the given width, as horizontal runs
+    (y, x0, x1), x1 exclusive.
+    """
+    xs, ys = line_points(origin, pos)
+
+    # every row the brush passes gets one run, since the line moves at most a pixel per step
+    low, high = (width - 1) // 2, width // 2
+    offsets = np.arange(-low, high + 1)
+    rows = (ys[:, None] + offsets).ravel()
+    columns = np.repeat(xs, len(offsets))
+
+    return [(y, x0 - low, x1 + high) for y, x0, x1 in points_to_spans(columns, rows)]
+
+def points_to_spans(xs, ys):
+    """
+    Runs (y, x0, x1) from the leftmost to the rightmost point of every row, x1 exclusive.
+    """
+    if len(ys) == 0:
+        return []
+
+    rows, index = np.unique(ys, return_inverse=True)
+    left = np.full(len(rows), np.iinfo(np.intp).max)
+    right = np.full(len(rows), np.iinfo(np.intp).min)
+    np.minimum.at(left, index, xs)
+    np.maximum.at(right, index, xs)
+
+    return list(zip(rows.tolist(), left.tolist(), (right + 1).tolist()))
+
+def polyline_points(points):
+    """
+    Lines through all the points joined together, as arrays of x and y
+    coordinates. The shared end points of the segments appear once.
+    """
+    xs, ys = [np.array([points[0][0]])], [np.array([points[0][1]])]
+
+    for start, end in zip(points, points[1:]):
+        segmentXs, segmentYs = line_points(start, end)
+        xs.append(segmentXs[1:])
+        ys.append(segmentYs[1:])
+
+    return np.concatenate(xs), np.concatenate(ys)
 
 def rectangle(origin, end):
     path = []
@@ -157,3 +348,44 @@ def rectangle(origin, end):
         path.append((x1, j))
 
     return path
+
+def rectangle_points(origin, end):
+    """
+    The same outline as rectangle(), without duplicate points, as arrays of
+    x and y coordinates.
+    """
+    x0, x1 = min(origin[0], end[0]), max(origin[0], end[0])
+    y0, y1 = max(origin[1], end[1]), min(origin[1], end[1])
+
+    row = np.arange(x0, x1 + 1)
+    column = np.arange(y1 + 1, y0)
+
+    xs = [row]
+    ys = [np.full(len(row), y0)]
+    if y1 != y0:
+        xs.append(row)
+        ys.append(np.full(len(row), y1))
+    xs.append(np.full(len(column), x0))
+    ys.append(column)
+    if x1 != x0:
+        xs.append(np.full(len(column), x1))
+        ys.append(column)
+
+    return np.concatenate(xs), np.concatenate(ys)
+
+def rectangle_spans(origin, end, filled=False, width=1):
+    """
+    Filled or thick rectangle as horizontal runs (y, x0, x1), x1 exclusive.
+    """
+    x0, x1 = min(origin[0], end[0]), max(origin[0], end[0]) + 1
+    y0, y1 = min(origin[1], end[1]), max(origin[1], end[1]) + 1
+
+    spans = []
+    for y in range(y0, y1):
+        if filled or y < y0 + width or y >= y1 - width or x1 - x0 <= 2 * width:
+            spans.append((y, x0, x1))
+        else:
+            spans.append((y, x0, x0 + width))
+            spans.append((y, x1 - width, x1))
+
+    return spans
@@ -0,0 +1,139 @@
+"""
+Recovery files, so a crash loses at most the last AUTOSAVE_INTERVAL
+seconds of work.
+
+A changed canvas is snapshotted on the UI thread, which copies no pixels
+(see Canvas.snapshot), and written as a .pix31 project on a worker thread.
+Tiles that did not change since the last recovery file are copied from it
+instead of being compressed again. Each session rotates through
+AUTOSAVE_SLOTS files named <session>-<slot>.pix31 and removes them when it
+closes normally, so the files found at startup were left by a crash. Those
+are kept until the user recovers or discards them.
+"""
+import os
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import constants as const
+import export as exp
+import project as proj
+
+FILENAME = re.compile(r"(.+)-(\d+)\.{}$".format(re.escape(const.PROJECT_EXTENSION)))
+
+def canvas_state(canvas):
+    # changes whenever anything a recovery file holds does
+    colors = None if canvas.colorTable is None else (canvas.colorTable.count, canvas.colorTable.revision)
+    layers = tuple((layer.name, tuple(pixels.revision for pixels in layer.frames), layer.visible, layer.opacity,
+                    layer.blendMode) for layer in canvas.layers)
+    return (layers, canvas.activeLayer, tuple(canvas.frameDurations), canvas.activeFrame, canvas.preview.revision,
+            len(canvas.history.undoStack), len(canvas.history.redoStack), colors, tuple(canvas.backgroundColor))
+
+def discard(path):
+    """
+    Remove a recovery file and the other files of its session.
+    """
+    directory, session = os.path.dirname(path), FILENAME.match(os.path.basename(path)).group(1)
+    remove_session(directory, session)
+
+def find_recovery(directory=const.AUTOSAVE_DIRECTORY):
+    """
+    The newest readable recovery file in the directory, None when there is none.
+    """
+    if not os.path.isdir(directory):
+        return None
+
+    paths = [entry.path for entry in os.scandir(directory) if FILENAME.match(entry.name) and entry.is_file()]
+    for path in sorted(paths, key=os.path.getmtime, reverse=True):
+        try:
+            proj.ProjectFile(path).close()
+        except (OSError, proj.ProjectError):
+            continue
+        return path
+
+    return None
+
+def recover(path, directory=const.PROJECT_DIRECTORY):
+    """
+    Copy a recovery file to a new project in the directory and discard its
+    session. Returns the path of the project.
+    """
+    target = exp.allocate_filename(directory, const.FILENAME_DEFAULT, const.PROJECT_EXTENSION)
+    shutil.copyfile(path, target)
+    discard(path)
+    return target
+
+def remove_session(directory, session):
+    if not os.path.isdir(directory):
+        return
+
+    for entry in os.scandir(directory):
+        match = FILENAME.match(entry.name)
+        if match and match.group(1) == session:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+class Autosaver():
+    """
+    Writes the recovery files of one session, one at a time on a worker thread.
+    """
+    def __init__(self, directory=const.AUTOSAVE_DIRECTORY, slots=const.AUTOSAVE_SLOTS) -> None:
+        self.directory = directory
+        self.slots = slots
+        self.session = "{}-{}".format(time.strftime("%Y%m%d%H%M%S"), os.getpid())
+
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="autosave")
+        self.future = None
+        self.count = 0          # recovery files written so far
+        self.state = None       # canvas_state of the last snapshot
+        self.latest = None      # ProjectFile of the newest recovery file
+
+    def close(self):
+        # a normal exit, the recovery files are not needed anymore
+        self.wait()
+        self.executor.shutdown()
+        if self.latest is not None:
+            self.latest.close()
+            self.latest = None
+        remove_session(self.directory, self.session)
+
+    def save(self, canvas, project=None, palette=()):
+        """
+        Start writing a recovery file of the canvas. Returns its Future, or
+        None when the canvas did not change or the previous file is still
+        being written. The project the canvas was opened from is read by the
+        worker, call wait before closing it.
+        """
+        if self.future is not None and not self.future.done():
+            return None
+
+        state = canvas_state(canvas)
+        if state == self.state:
+            return None
+        self.state = state
+
+        path = os.path.join(self.directory, "{}-{}.{}".format(self.session, self.count % self.slots, const.PROJECT_EXTENSION))
+        self.count += 1
+        self.future = self.executor.submit(self.write, canvas.snapshot(), path, project, list(palette))
+        return self.future
+
+    def wait(self):
+        # let the file being written finish, e.g. before closing the project it reads from
+        if self.future is not None:
+            wait([self.future])
+
+    def write(self, canvas, path, project, palette):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            recovery = proj.save_snapshot(canvas, path, [self.latest, project], palette)
+        except BaseException:
+            self.state = None   # try again at the next interval
+            raise
+
+        if self.latest is not None:
+            self.latest.close()
+        self.latest = recovery
+        return path
@@ -0,0 +1,198 @@
+"""
+Benchmarks for the hot paths of the editor. Runs headless and prints JSON.
+
+    python benchmark.py -o baseline.json
+    python benchmark.py --compare baseline.json
+
+In compare mode every case whose fastest run got slower than the baseline's
+by more than the threshold, and by at least --min-delta milliseconds, is
+reported and the exit code is 1. The preview cases time
+Canvas.apply_preview/clear_preview, which Window.apply_preview/clear_preview
+call, so no window is needed.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import algorithms as algo
+import export as exp
+import importer as imp
+import palette_manager as palet
+from canvas import Canvas
+from pixel_buffer import PixelBuffer
+
+SHAPE_SIZES = [64, 256, 1024, 4096]
+FILL_SIZES = [64, 256, 1024, 2048]
+PREVIEW_SIZES = [64, 256, 1024]
+PREVIEW_DENSITIES = [0.01, 0.1, 0.5]
+EXPORT_SIZES = [64, 256, 1024, 4096]
+
+def random_pixels(size, density, seed=0):
+    # pixels of a small palette scattered over the canvas
+    rng = np.random.default_rng(seed)
+    pixels = PixelBuffer(size, size)
+    palette = rng.integers(0, 256, (8, 4), dtype=np.uint8)
+    palette[:, 3] = 255
+    painted = rng.random((size, size)) < density
+    pixels.data[painted] = palette[rng.integers(0, len(palette), int(painted.sum()))]
+    pixels.mask[...] = painted
+    pixels.paintedRect = [0, 0, size, size]
+    return pixels
+
+def blocky_pixels(size, block=8):
+    # sprite-like content: large areas of the same color compress like real art
+    small = random_pixels(max(size // block, 1), 0.5)
+    pixels = PixelBuffer(size, size)
+    pixels.data[...] = small.data.repeat(block, axis=0).repeat(block, axis=1)[:size, :size]
+    pixels.mask[...] = small.mask.repeat(block, axis=0).repeat(block, axis=1)[:size, :size]
+    pixels.paintedRect = [0, 0, size, size]
+    return pixels
+
+def shape_cases():
+    for size in SHAPE_SIZES:
+        end = (size - 1, size // 2)
+        yield f"bresenham_line/{size}", lambda end=end: algo.bresenham_line((0, 0), end)
+        yield f"ellipse/{size}", lambda size=size: algo.ellipse((0, 0), (size - 1, size - 1))
+        yield f"rectangle/{size}", lambda size=size: algo.rectangle((0, 0), (size - 1, size - 1))
+        yield f"line_points/{size}", lambda end=end: algo.line_points((0, 0), end)
+        yield f"ellipse_points/{size}", lambda size=size: algo.ellipse_points((0, 0), (size - 1, size - 1))
+        yield f"rectangle_points/{size}", lambda size=size: algo.rectangle_points((0, 0), (size - 1, size - 1))
+
+def fill_cases():
+    for size in FILL_SIZES:
+        empty = PixelBuffer(size, size)
+        yield f"flood_fill/empty/{size}", lambda pixels=empty: algo.flood_fill((0, 0), pixels)
+
+        # a maze of walls makes many short runs
+        maze = random_pixels(size, 0.3)
+        maze.data[...] = np.where(maze.mask[..., None], (0, 0, 0, 255), 0)
+        yield f"flood_fill/maze/{size}", lambda pixels=maze: algo.flood_fill((0, 0), pixels, 8)
+
+def preview_cases():
+    for size in PREVIEW_SIZES:
+        for density in PREVIEW_DENSITIES:
+            canvas = Canvas(size, size)
+            preview = random_pixels(size, density)
+
+            def setup(canvas=canvas, preview=preview):
+                canvas.preview = canvas.new_buffer(canvas.width, canvas.height)
+                canvas.preview.blit(preview, 0, 0, preview.width, preview.height, 0, 0)
+
+            yield f"apply_preview/{size}/{density}", canvas.apply_preview, setup
+            yield f"clear_preview/{size}/{density}", canvas.clear_preview, setup
+
+def export_cases(directory):
+    for size in EXPORT_SIZES:
+        pixels = blocky_pixels(size)
+        path = os.path.join(directory, f"export{size}.png")
+        yield f"export_image/{size}", lambda pixels=pixels, path=path: exp.export_image(pixels, path=path)
+
+def import_cases(directory):
+    for size in EXPORT_SIZES:
+        path = os.path.join(directory, f"import{size}.png")
+        exp.export_image(blocky_pixels(size), path=path)
+        yield f"read_image/{size}", lambda path=path: imp.read_image(path)
+
+def palette_cases():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "palette_default.hex")
+    yield "palette_load/default", lambda: palet.read_hex_to_rgb(path)
+    yield "palette_load/uncached", lambda: palet.load_palette(path, cacheDirectory=None)
+    with tempfile.TemporaryDirectory() as directory:
+        palet.load_palette(path, directory)
+        yield "palette_load/cached", lambda: palet.load_palette(path, directory)
+
+def measure(func, repeat, setup=None):
+    times = []
+    for run in range(repeat + 1):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        if run > 0:     # the first run is a warm up
+            times.append(time.perf_counter() - start)
+
+    return {"median": statistics.median(times), "min": min(times), "runs": repeat}
+
+def run(args):
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        groups = [shape_cases(), fill_cases(), preview_cases(), export_cases(directory), import_cases(directory),
+                  palette_cases()]
+        for group in groups:
+            for name, func, *setup in group:
+                if args.filter and args.filter not in name:
+                    continue
+                results[name] = measure(func, args.repeat, *setup)
+                print(f"{name:40} {results[name]['median'] * 1000:10.3f} ms", file=sys.stderr)
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "system": platform.system(),
+        },
+        "results": results,
+    }
+
+def compare(report, baseline, threshold, minDelta=0.001):
+    # the fastest of the repeats is the least disturbed by other load, and a
+    # few tenths of a millisecond on the small cases is noise however large
+    # the relative change
+    regressions = []
+
+    for name, result in sorted(report["results"].items()):
+        if name not in baseline["results"]:
+            continue
+        old = baseline["results"][name]["min"]
+        new = result["min"]
+        change = (new - old) / old if old > 0 else 0
+        flag = "REGRESSION" if change > threshold and new - old >= minDelta else ""
+        print(f"{name:40} {old * 1000:10.3f} ms {new * 1000:10.3f} ms {change:+8.1%} {flag}", file=sys.stderr)
+        if flag:
+            regressions.append(name)
+
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="pix31 benchmarks")
+    parser.add_argument("-o", "--output", help="write the JSON report to this file")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="timed runs per case")
+    parser.add_argument("-k", "--filter", help="only run cases whose name contains this")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare against a stored JSON report")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown before a case is flagged")
+    parser.add_argument("--min-delta", type=float, default=1.0,
+                        help="smallest slowdown in milliseconds that is flagged")
+    args = parser.parse_args(argv)
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    report = run(args)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold, args.min_delta / 1000)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}", file=sys.stderr)
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,572 @@
+import weakref
+
+import numpy as np
+
+import algorithms as algo
+import constants as const
+import transform
+from history import History, Transform
+from layers import Compositor, Layer
+from pixel_buffer import ColorTable, TiledPixelBuffer
+from selection import Floating, Selection, select_rectangle, select_runs
+
+class Canvas():
+    def __init__(self, width, height, palette=None) -> None:
+        self.width = width
+        self.height = height
+        self.origin = [0, 0]
+        self.backgroundColor = (255, 255, 255, 255)
+
+        # with a palette the canvas stores palette indices instead of RGBA colors
+        self.colorTable = None if palette is None else ColorTable(palette)
+        self.layers = [Layer("Layer 1", [self.new_buffer(width, height)])]   # bottom to top
+        self.activeLayer = 0        # index of the layer the tools paint on
+        self.frameDurations = [const.FRAME_DURATION]    # milliseconds each animation frame is shown
+        self.activeFrame = 0
+        self.preview = self.new_buffer(width, height)
+        self.compositor = Compositor(self)
+        self.history = History()
+        self.erasedPixels = []      # (ys, xs, colors) arrays removed by the current eraser stroke
+        self.selection = None       # Selection the clipboard and move work on, None when nothing is selected
+        self.floating = None        # Floating pixels of a paste or move, shown on the preview layer
+
+        self.mousePos = [0, 0]      # mouse coordinates on canvas
+        self.beginningPos = [0, 0]  # beginning coordinates of action
+        self.endPos = [0, 0]        # end coordinates of action
+
+        self.gridOn = False
+
+    @property
+    def pixels(self):
+        return self.layers[self.activeLayer].pixels
+
+    def add_frame(self, copy=True):
+        """
+        Add a frame after the active one and make it the active frame. A copy
+        of the active frame shares its tiles until either of them changes
+        them, see TiledPixelBuffer.snapshot. Returns None when there are
+        FRAMES_MAX frames already.
+        """
+        if len(self.frameDurations) >= const.FRAMES_MAX:
+            return None
+
+        index = self.activeFrame + 1
+        self.history.remap(frames=[i if i < index else i + 1 for i in range(len(self.frameDurations))])
+        for layer in self.layers:
+            layer.frames.insert(index, layer.pixels.snapshot() if copy else self.new_buffer(self.width, self.height))
+        self.frameDurations.insert(index, self.frameDurations[self.activeFrame])
+        self.select_frame(index)
+        return index
+
+    def add_layer(self, name=None):
+        """
+        Add an empty layer above the active one and make it the active layer.
+        Returns None when there are LAYERS_MAX layers already.
+        """
+        if len(self.layers) >= const.LAYERS_MAX:
+            return None
+
+        index = self.activeLayer + 1
+        self.history.remap(layers=[i if i < index else i + 1 for i in range(len(self.layers))])
+        frames = [self.new_buffer(self.width, self.height) for _ in self.frameDurations]
+        layer = Layer(name or f"Layer {len(self.layers) + 1}", frames)
+        layer.select_frame(self.activeFrame)
+        self.layers.insert(index, layer)
+        self.activeLayer = index
+        return layer
+
+    def add_pixel(self, pos, color, matrix):
+        matrixPosY = self.height - 1 - pos[1]
+
+        if matrix == "pixel":
+            if self.pixels.contains(pos[0], matrixPosY):
+                self.pixels.set(pos[0], matrixPosY, color)
+        elif matrix == "preview":
+            if self.preview.contains(pos[0], matrixPosY):
+                self.preview.set(pos[0], matrixPosY, color)
+
+    def apply_preview(self):
+        if self.preview.paintedRect is None:
+            return
+
+        ys, xs = self.preview.painted_positions()
+        runs = self.preview_runs(ys, xs)
+        if runs is not None:
+            color = self.preview.raw_value(int(xs[0]), int(ys[0]))
+            self.preview.clear()
+            self.paint_runs(runs, color)
+            return
+
+        oldData, oldMask = self.pixels.read(ys, xs)
+        self.pixels.merge(self.preview)
+        self.preview.clear()
+        self.history.record(self.pixels, ys, xs, oldData, oldMask, self.activeLayer, self.activeFrame)
+
+    def clear_preview(self):
+        self.preview.clear()
+
+    def color_pick(self, pos, artist, button):
+        matrixPosY = self.height - 1 - pos[1]
+        if self.pixels.contains(pos[0], matrixPosY) and not self.pixels.is_empty(pos[0], matrixPosY):
+            if button == 0:
+                artist.primaryColor = self.pixels.get(pos[0], matrixPosY)
+            elif button == 1:
+                artist.secondaryColor = self.pixels.get(pos[0], matrixPosY)
+
+    def commit_floating(self):
+        """
+        Make the floating pixels part of the active layer. A move is a single
+        undo step, together with lifting the pixels off their old place.
+        """
+        floating = self.floating
+        if floating is None:
+            return
+        self.floating = None
+
+        ys, xs = self.preview.painted_positions()
+        oldData, oldMask = self.pixels.read(ys, xs)
+        if floating.lifted is not None:
+            liftedYs, liftedXs, liftedData, liftedMask = floating.lifted
+            ys, xs = np.concatenate([liftedYs, ys]), np.concatenate([liftedXs, xs])
+            oldData, oldMask = np.concatenate([liftedData, oldData]), np.concatenate([liftedMask, oldMask])
+            # pixels landing where pixels were lifted from had the lifted colors before the move
+            _, first = np.unique(ys*self.width + xs, return_index=True)
+            ys, xs, oldData, oldMask = ys[first], xs[first], oldData[first], oldMask[first]
+
+        self.pixels.merge(self.preview)
+        self.preview.clear()
+        self.history.record(self.pixels, ys, xs, oldData, oldMask, self.activeLayer, self.activeFrame)
+
+    def commit_erase(self):
+        if not self.erasedPixels:
+            return
+
+        ys, xs, colors = (np.concatenate(arrays) for arrays in zip(*self.erasedPixels))
+        self.erasedPixels = []
+        self.history.record(self.pixels, ys, xs, colors, np.ones(len(ys), dtype=bool), self.activeLayer, self.activeFrame)
+
+    def copy_selection(self):
+        """
+        The selected pixels of the active layer as Floating pixels, a dense
+        buffer the size of the selection at its position. None without a
+        selection.
+        """
+        if self.selection is None:
+            return None
+        x0, y0, x1, y1 = self.selection.rect()
+        pixels = self.pixels.crop(x0, y0, x1, y1)
+        pixels.erase(0, 0, ~self.selection.mask)
+        return Floating(pixels, x0, y0)
+
+    def cut_selection(self):
+        clip = self.copy_selection()
+        if clip is not None:
+            self.erase_selection()
+        return clip
+
+    def delete_frame(self, index):
+        """
+        Remove a frame, together with its undo history. The last frame can not be removed.
+        """
+        if len(self.frameDurations) == 1:
+            return False
+
+        self.history.remap(frames=[None if i == index else i - (i > index) for i in range(len(self.frameDurations))])
+        for layer in self.layers:
+            del layer.frames[index]
+        del self.frameDurations[index]
+        self.select_frame(min(self.activeFrame - (self.activeFrame > index), len(self.frameDurations) - 1))
+        return True
+
+    def delete_layer(self, index):
+        """
+        Remove a layer, together with its undo history. The last layer can not be removed.
+        """
+        if len(self.layers) == 1:
+            return False
+
+        self.history.remap(layers=[None if i == index else i - (i > index) for i in range(len(self.layers))])
+        del self.layers[index]
+        self.activeLayer = min(self.activeLayer - (self.activeLayer > index), len(self.layers) - 1)
+        return True
+
+    def delete_pixel(self, pos):
+        self.delete_pixels(np.array([pos[0]]), np.array([pos[1]]))
+
+    def delete_pixels(self, xs, ys):
+        rows = self.height - 1 - ys
+        inside = (xs >= 0) & (xs < self.width) & (rows >= 0) & (rows < self.height)
+        xs, rows = xs[inside], rows[inside]
+
+        # only painted pixels need erasing, and remembering for undo
+        colors, painted = self.pixels.read(rows, xs)
+        xs, rows, colors = xs[painted], rows[painted], colors[painted]
+        if len(xs) == 0:
+            return
+
+        self.erasedPixels.append((rows, xs, colors))
+        self.pixels.write(rows, xs, colors, np.zeros(len(xs), dtype=bool))
+
+    def deselect(self):
+        self.commit_floating()
+        self.selection = None
+
+    def draw_ellipse(self, color, width=1, filled=False):
+        if width > 1 or filled:
+            self.fill_spans(algo.ellipse_spans(self.beginningPos, self.endPos, filled, width), color, "preview")
+        else:
+            xs, ys = algo.ellipse_points(self.beginningPos, self.endPos)
+            self.plot(xs, ys, color, "preview")
+
+    def draw_point(self, color):
+        self.add_pixel(self.mousePos, color, "preview")
+
+    def draw_line(self, color, width=1):
+        if width > 1:
+            self.fill_spans(algo.line_spans(self.beginningPos, self.endPos, width), color, "preview")
+        else:
+            xs, ys = algo.line_points(self.beginningPos, self.endPos)
+            self.plot(xs, ys, color, "preview")
+
+    def draw_polyline(self, points, color):
+        xs, ys = algo.polyline_points(points)
+        self.plot(xs, ys, color, "preview")
+
+    def draw_rectangle(self, color, width=1, filled=False):
+        if width > 1 or filled:
+            self.fill_spans(algo.rectangle_spans(self.beginningPos, self.endPos, filled, width), color, "preview")
+        else:
+            xs, ys = algo.rectangle_points(self.beginningPos, self.endPos)
+            self.plot(xs, ys, color, "preview")
+
+    def erase_selection(self):
+        if self.selection is not None:
+            self.history.record(self.pixels, *self.remove_selection(), self.activeLayer, self.activeFrame)
+
+    def erase_point(self):
+        self.delete_pixel(self.mousePos)
+
+    def erase_line(self):
+        xs, ys = algo.line_points(self.beginningPos, self.endPos)
+        self.delete_pixels(xs, ys)
+
+    def erase_polyline(self, points):
+        xs, ys = algo.polyline_points(points)
+        self.delete_pixels(xs, ys)
+
+    def fill(self, color, connectivity=4, tolerance=0):
+        if not self.pixels.contains(self.mousePos[0], self.height - 1 - self.mousePos[1]):
+            return
+        runs = algo.flood_fill(self.mousePos, self.pixels, connectivity, tolerance)
+        runs[:, 0] = self.height - 1 - runs[:, 0]
+        self.paint_runs(runs, color)
+
+    def fill_spans(self, spans, color, matrix):
+        """
+        Paint (y, x0, x1) runs in canvas coordinates, clipped to the canvas.
+        """
+        buffer = self.pixels if matrix == "pixel" else self.preview
+
+        spans = np.asarray(spans, dtype=np.intp).reshape(-1, 3)
+        spans = spans[(spans[:, 0] >= 0) & (spans[:, 0] < self.height)]
+        x0s, x1s = np.maximum(spans[:, 1], 0), np.minimum(spans[:, 2], self.width)
+        inside = x0s < x1s
+        buffer.fill_runs(np.column_stack((self.height - 1 - spans[inside, 0], x0s[inside], x1s[inside])), color)
+
+    def flip(self, horizontal=True):
+        self.transform_layers(self.width, self.height, lambda pixels, cache: transform.flip(pixels, horizontal, cache))
+
+    def flatten(self, frame=None):
+        """
+        The image of a frame, the active one by default, as shown and
+        exported. A single plain layer is returned as it is, so an indexed
+        canvas still exports palette indices.
+        """
+        if frame is None:
+            frame = self.activeFrame
+        visible = [layer for layer in self.layers if layer.visible]
+        if len(visible) == 1 and visible[0].is_plain():
+            return visible[0].frames[frame]
+        if frame == self.activeFrame:
+            return self.compositor.flatten()
+        return Compositor(self, self.frame_buffers(frame)).flatten()
+
+    def frame_buffers(self, index):
+        # the pixels of every layer in a frame
+        return [layer.frames[index] for layer in self.layers]
+
+    def is_mouse_on_canvas(self, x, y):
+        wWd2, wHd2 = const.WINDOW_START_WIDTH/2, const.WINDOW_START_HEIGHT/2
+        if wWd2 - self.width/2 < x < wWd2 + self.width/2 and wHd2 - self.height/2 < y < wHd2 + self.height/2:
+            return True
+        return False
+
+    def lift_selection(self):
+        """
+        Start moving the selected pixels, they float over the layer until
+        commit_floating. Floating pixels are moved as they are.
+        """
+        if self.floating is not None or self.selection is None:
+            return
+        clip = self.copy_selection()
+        self.floating = Floating(clip.pixels, clip.x, clip.y, self.remove_selection())
+        self.show_floating()
+
+    def load_pixels(self, pixels):
+        """
+        Replace the image with a PixelBuffer of any size, e.g. an imported
+        file. The layers and frames are replaced by a single one and the
+        history is cleared.
+        """
+        self.width = pixels.width
+        self.height = pixels.height
+        self.layers = [Layer("Layer 1", [self.new_buffer(pixels.width, pixels.height)])]
+        self.activeLayer = 0
+        self.frameDurations = [const.FRAME_DURATION]
+        self.activeFrame = 0
+        self.pixels.blit(pixels, 0, 0, pixels.width, pixels.height, 0, 0)
+        self.preview = self.new_buffer(pixels.width, pixels.height)
+        self.compositor = Compositor(self)
+
+        self.history.clear()
+        self.erasedPixels = []
+        self.selection = None
+        self.floating = None
+
+    def move_floating(self, dx, dy):
+        """
+        Move the floating pixels and the selection by an offset in canvas coordinates.
+        """
+        self.floating.x += dx
+        self.floating.y -= dy
+        self.selection.x += dx
+        self.selection.y -= dy
+        self.show_floating()
+
+    def move_frame(self, index, offset):
+        """
+        Move a frame later (positive offset) or earlier in the animation.
+        """
+        target = index + offset
+        if not 0 <= target < len(self.frameDurations):
+            return False
+
+        order = list(range(len(self.frameDurations)))   # new index -> old index
+        order.insert(target, order.pop(index))
+        mapping = [order.index(i) for i in range(len(order))]
+        self.history.remap(frames=mapping)
+        for layer in self.layers:
+            layer.frames = [layer.frames[i] for i in order]
+        self.frameDurations = [self.frameDurations[i] for i in order]
+        self.select_frame(mapping[self.activeFrame])
+        return True
+
+    def move_layer(self, index, offset):
+        """
+        Move a layer up (positive offset) or down the stack.
+        """
+        target = index + offset
+        if not 0 <= target < len(self.layers):
+            return False
+
+        order = list(range(len(self.layers)))      # new index -> old index
+        order.insert(target, order.pop(index))
+        mapping = [order.index(i) for i in range(len(order))]
+        self.history.remap(layers=mapping)
+        self.layers = [self.layers[i] for i in order]
+        self.activeLayer = mapping[self.activeLayer]
+        return True
+
+    def new_buffer(self, width, height):
+        return TiledPixelBuffer(width, height, self.colorTable)
+
+    def set_palette_color(self, old, color):
+        # recolors the image in indexed mode, the pixels of the old color keep their index and show the new one
+        if self.colorTable is not None:
+            index = self.colorTable.indices.get(tuple(int(c) for c in old))
+            if index is not None:
+                self.colorTable.set_color(index, color)
+
+    def paint_runs(self, runs, color):
+        # (row, x0, x1) runs on the active layer, remembered as the runs and the tiles they change, see RunDelta
+        keys = [key for key, *_ in self.pixels.split_runs(runs)]
+        old = self.pixels.read_tiles(keys)
+        self.pixels.fill_runs(runs, color)
+        self.history.record_runs(self.pixels, runs, keys, *old, self.activeLayer, self.activeFrame)
+
+    def paste(self, clip):
+        """
+        Float copied pixels where they were copied from, to be moved and
+        then committed. Pixels of an RGBA canvas do not fit an indexed one
+        and the other way around, those are not pasted.
+        """
+        if not (clip.pixels.data.ndim == 2) == (self.colorTable is not None):
+            return False
+        self.commit_floating()
+        self.floating = Floating(clip.pixels, clip.x, clip.y)
+        self.selection = self.floating.selection()
+        self.show_floating()
+        return True
+
+    def plot(self, xs, ys, color, matrix):
+        """
+        Paint every pixel of the coordinate arrays at once, clipped to the canvas.
+        """
+        rows = self.height - 1 - ys
+        inside = (xs >= 0) & (xs < self.width) & (rows >= 0) & (rows < self.height)
+
+        if matrix == "pixel":
+            self.pixels.plot(xs[inside], rows[inside], color)
+        elif matrix == "preview":
+            self.preview.plot(xs[inside], rows[inside], color)
+
+    def remove_selection(self):
+        # empty the selected pixels of the active layer, returns where they were and what they held
+        x0, y0, x1, y1 = self.selection.rect()
+        ys, xs = np.nonzero(self.selection.mask & self.pixels.mask_region(x0, y0, x1, y1))
+        ys, xs = ys + y0, xs + x0
+        oldData, oldMask = self.pixels.read(ys, xs)
+        self.pixels.erase(x0, y0, self.selection.mask)
+        return ys, xs, oldData, oldMask
+
+    def preview_runs(self, ys, xs):
+        """
+        The painted pixels of the preview at the positions as (row, x0, x1)
+        runs, when they are of one color and the runs plus the tiles they
+        change take less history memory than the single pixels. None otherwise.
+        """
+        colors, _ = self.preview.read(ys, xs)
+        if len(ys) < self.pixels.tileSize**2 or not (colors == colors[0]).all():
+            return None
+
+        # painted_positions goes through the tiles row by row, a run ends where a row or a gap does
+        breaks = np.flatnonzero((np.diff(ys) != 0) | (np.diff(xs) != 1)) + 1
+        starts, ends = np.r_[0, breaks], np.r_[breaks, len(ys)]
+        runs = np.column_stack((ys[starts], xs[starts], xs[ends - 1] + 1))
+
+        changed = self.preview.stored_tiles() & self.pixels.stored_tiles()
+        tileBytes = self.pixels.tileSize**2 * (5 if self.colorTable is None else 1)
+        if runs.nbytes + len(changed)*tileBytes >= len(ys)*4:
+            return None
+        return runs
+
+    def redo(self):
+        # show the frame the change is on
+        if self.history.can_redo():
+            self.select_frame(self.history.redoStack[-1].frame)
+        return self.history.redo(self)
+
+    def resize(self, width, height, anchor=(0, 0)):
+        """
+        Change the size of the canvas. anchor is the point of the image that
+        stays in place, (0, 0) its top left corner, (0.5, 0.5) its center and
+        (1, 1) its bottom right corner. Returns False for a size outside
+        1-CANVAS_SIZE_MAX.
+        """
+        if not (0 < width <= const.CANVAS_SIZE_MAX and 0 < height <= const.CANVAS_SIZE_MAX):
+            return False
+        x, y = round((width - self.width)*anchor[0]), round((height - self.height)*anchor[1])
+        self.transform_layers(width, height, lambda pixels, cache: transform.resize(pixels, width, height, x, y, cache))
+        return True
+
+    def rotate(self, turns=1):
+        # clockwise quarter turns
+        width, height = (self.height, self.width) if turns % 2 else (self.width, self.height)
+        self.transform_layers(width, height, lambda pixels, cache: transform.rotate(pixels, turns, cache))
+
+    def scale(self, factor):
+        """
+        Enlarge the image by a whole factor, nearest neighbour. Returns False
+        when the canvas would get larger than CANVAS_SIZE_MAX.
+        """
+        width, height = self.width*factor, self.height*factor
+        if factor < 1 or width > const.CANVAS_SIZE_MAX or height > const.CANVAS_SIZE_MAX:
+            return False
+        self.transform_layers(width, height, lambda pixels, cache: transform.scale(pixels, factor, cache))
+        return True
+
+    def select_all(self):
+        self.commit_floating()
+        self.selection = Selection(0, 0, np.ones((self.height, self.width), dtype=bool))
+
+    def select_area(self, connectivity=4, tolerance=0):
+        # the magic wand, selects what the paint bucket would fill
+        self.commit_floating()
+        if not self.pixels.contains(self.mousePos[0], self.height - 1 - self.mousePos[1]):
+            self.selection = None
+            return
+        self.selection = select_runs(algo.flood_fill(self.mousePos, self.pixels, connectivity, tolerance), self.height)
+
+    def select_frame(self, index):
+        self.activeFrame = index
+        for layer in self.layers:
+            layer.select_frame(index)
+
+    def select_rectangle(self):
+        # the rectangle between beginningPos and endPos
+        self.commit_floating()
+        (x0, y0), (x1, y1) = self.beginningPos, self.endPos
+        self.selection = select_rectangle(x0, self.height - 1 - y0, x1, self.height - 1 - y1, self.width, self.height)
+
+    def show_floating(self):
+        floating = self.floating
+        self.preview.clear()
+        self.preview.blit(floating.pixels, 0, 0, floating.pixels.width, floating.pixels.height, floating.x, floating.y)
+
+    def snapshot(self):
+        """
+        A copy of the document to save on another thread while this one keeps
+        changing. The pixels are shared until changed, see TiledPixelBuffer.snapshot.
+        """
+        canvas = Canvas(self.width, self.height)
+        canvas.backgroundColor = self.backgroundColor
+        canvas.colorTable = None if self.colorTable is None else self.colorTable.copy()
+        canvas.layers = [layer.snapshot() for layer in self.layers]
+        canvas.activeLayer = self.activeLayer
+        canvas.frameDurations = list(self.frameDurations)
+        canvas.select_frame(self.activeFrame)
+        canvas.preview = self.preview.snapshot()
+        canvas.history.restore(self.history.undoStack, self.history.redoStack)
+        return canvas
+
+    def swap_pixels(self, buffers, width, height):
+        """
+        Make buffers, (frame, layer) -> TiledPixelBuffer of the size, the
+        pixels of every layer in every frame. Layers and frames without one
+        start empty. Returns the replaced buffers and their size the same way.
+        """
+        replaced = {}
+        for index, layer in enumerate(self.layers):
+            for frame, pixels in enumerate(layer.frames):
+                replaced[(frame, index)] = pixels
+                layer.frames[frame] = buffers[(frame, index)] if (frame, index) in buffers else self.new_buffer(width, height)
+            layer.select_frame(self.activeFrame)
+        oldWidth, oldHeight = self.width, self.height
+
+        self.width = width
+        self.height = height
+        self.preview = self.new_buffer(width, height)
+        self.compositor = Compositor(self)
+        self.erasedPixels = []
+        self.selection = None
+        return replaced, oldWidth, oldHeight
+
+    def transform_layers(self, width, height, function):
+        """
+        Replace the pixels of every layer in every frame by function(pixels,
+        cache), one of the transforms of transform.py giving a buffer of the
+        new size. The old pixels are kept in the history, see Transform.
+        """
+        self.commit_floating()
+        cache = weakref.WeakValueDictionary()
+        transformed = {}
+        for index, layer in enumerate(self.layers):
+            for frame, pixels in enumerate(layer.frames):
+                transformed[(frame, index)] = function(pixels, cache)
+        replaced, oldWidth, oldHeight = self.swap_pixels(transformed, width, height)
+        self.history.push(Transform(replaced, oldWidth, oldHeight, self.activeFrame))
+
+    def undo(self):
+        if self.history.can_undo():
+            self.select_frame(self.history.undoStack[-1].frame)
+        return self.history.undo(self)
@@ -22,6 +22,49 @@ ZOOM_LIMIT_LOW = 0.03125
 ZOOM_LIMIT_HIGH = 2
 
 CANVAS_BACKGROUND_COLOR = (255, 255, 255, 255)
+SELECTION_OUTLINE_COLOR = (0, 120, 215, 255)
 
 CANVAS_SIZE_X = 64
 CANVAS_SIZE_Y = 64
+CANVAS_SIZE_MAX = 16384   # widest and highest canvas resizing and scaling make
+CANVAS_RESIZE_STEP = 16   # pixels Alt+arrow adds to or removes from a side of the canvas
+CANVAS_INDEXED = False   # store one palette index per pixel instead of RGBA
+LAYERS_MAX = 255          # a project numbers the layers with a byte, the preview being 255
+FRAMES_MAX = 65535        # a project numbers the animation frames with 16 bits
+FRAME_DURATION = 100      # milliseconds a new animation frame is shown
+FRAME_DURATION_STEP = 10  # milliseconds a key press changes the duration by
+ONION_SKIN_FRAMES = 1     # frames shown faintly before and after the active one
+ONION_SKIN_OPACITY = 80   # 0-255
+CANVAS_TILE_SIZE = 64    # the canvas is stored in tiles of this many pixels a side, allocated when painted
+TEXTURE_CHUNK_SIZE = 512  # the canvas is drawn as textures of this many pixels a side
+COMPOSITE_BATCH = 32      # tiles the layer compositing blends per numpy operation
+
+PALETTE_PATH = "./palette_default.hex"
+PALETTE_DIRECTORY = "./palettes"   # .hex, .gpl, .pal and .ase palettes, P and Shift+P switch between them
+PALETTE_ROWS = 3
+PALETTE_CACHE_DIRECTORY = "./.palette_cache"   # parsed palettes, rebuilt when the palette file changes
+
+HISTORY_BUDGET_BYTES = 64 * 1024 * 1024   # memory the undo/redo history may use
+
+EXPORT_DIRECTORY = "./images"
+EXPORT_FILENAME = "image"     # exports are named image.png, image1.png, image2.png, ...
+
+EXPORT_COMPRESS_LEVEL = 6   # zlib level 0-9 used for PNG export
+EXPORT_OPTIMIZE = False     # let Pillow search for a smaller PNG encoding (slow)
+EXPORT_SCALES = (1, 2, 4, 8) # sizes export_sizes writes, each pixel this many pixels wide
+
+EXPORT_WORKERS = 2          # exports that can be encoded at the same time
+EXPORT_PROCESSES = None     # processes encoding animation frames and export sizes, None for one per core
+
+PROJECT_DIRECTORY = "./projects"
+PROJECT_EXTENSION = "pix31"
+PROJECT_COMPRESSION = "zlib"    # "none", "zlib" or "lz4" (needs the lz4 package)
+
+AUTOSAVE_DIRECTORY = "./.recovery"
+AUTOSAVE_INTERVAL = 60      # seconds between recovery files, only written when the canvas changed
+AUTOSAVE_SLOTS = 3          # recovery files kept, the oldest is overwritten
+
+STATUS_MESSAGE_TIME = 4     # seconds a status bar message stays visible
+RECOVERY_MESSAGE_TIME = 30  # seconds the offer to recover a crashed session stays visible
+
+STROKE_WIDTH_MAX = 64
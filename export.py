@@ -1,21 +1,368 @@
+import functools
+import hashlib
+import json
+import math
 import os
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+import numpy as np
 from PIL import Image
 
-def export_image(matrix, width, height):
-    img = Image.new('RGBA', (width, height), 255)
+import constants as const
+from pixel_buffer import EMPTY_INDEX, IndexedPixelBuffer, TiledPixelBuffer
+from transform import packed
 
-    # add pixels from the canvas matrix to the PNG
-    for y in range(0, height):
-        for x in range(0, width):
-            img.putpixel((x, y), matrix[y][x])
+executor = None
+processPool = None                  # encodes animation frames, see process_map
+processPoolLock = threading.Lock()
 
-    fCount = 0
-    for f in os.listdir("."):
-        if f.startswith("image"):      # check if filename already exists
-            fCount += 1                # calculate a number to filename if duplicate names
+ANIMATION_FORMATS = {"gif": "gif", "apng": "png", "sheet": "png"}   # format -> file extension
+IMAGE_FORMATS = {"png": "PNG", "webp": "WEBP"}                      # file extension -> Pillow format
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
 
-    if fCount == 0:
-        fCount = ""
+fileCounters = {}                   # next free file number per output directory
+fileCounterLock = threading.Lock()
 
-    img.save("./images/image{}.png".format(fCount), "PNG")
+# permissions open() gives a new file, mkstemp makes its files private. Read once, as reading the umask
+# means changing it for every thread
+umask = os.umask(0)
+os.umask(umask)
+newFileMode = 0o666 & ~umask
+
+def allocate_filename(directory, prefix=const.EXPORT_FILENAME, extension="png"):
+    """
+    Reserve a new numbered file in the directory and return its path. The
+    directory is scanned only the first time it is used, after that the
+    cached counter is incremented.
+    """
+    key = os.path.abspath(directory)
+
+    with fileCounterLock:
+        if key not in fileCounters:
+            os.makedirs(directory, exist_ok=True)
+            fileCounters[key] = scan_file_counter(directory, prefix, extension)
+
+        while True:
+            number = fileCounters[key]
+            fileCounters[key] += 1
+
+            path = os.path.join(directory, "{}{}.{}".format(prefix, number if number > 0 else "", extension))
+            try:
+                # exclusive create, so another exporter can never get the same name
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+                return path
+            except FileExistsError:
+                continue
+
+def animation_frames(canvas):
+    # RGBA arrays of the flattened frames of a canvas snapshot, see Canvas.snapshot
+    return [canvas.flatten(index).to_rgba() for index in range(len(canvas.frameDurations))]
+
+def build_image(pixels, scale=1):
+    """
+    The pixels as a Pillow image, each pixel scale x scale pixels large.
+    """
+    if isinstance(pixels, TiledPixelBuffer):
+        pixels = pixels.crop(0, 0, pixels.width, pixels.height)
+    if isinstance(pixels, IndexedPixelBuffer):
+        return build_indexed_image(upscale(pixels.data, scale), pixels.colorTable.lut)
+
+    # empty pixels are stored as transparent zeros, so the buffer maps directly to an RGBA image
+    data = np.ascontiguousarray(upscale(pixels.to_rgba(), scale))
+    return Image.frombuffer('RGBA', (data.shape[1], data.shape[0]), data, 'raw', 'RGBA', 0, 1)
+
+def build_indexed_image(data, lut):
+    # palette images are written as "P" mode PNGs, empty pixels use the transparent EMPTY_INDEX
+    data = np.ascontiguousarray(data)
+    img = Image.frombuffer('P', (data.shape[1], data.shape[0]), data, 'raw', 'P', 0, 1)
+
+    img.putpalette(lut[:, :3].tobytes())
+    alpha = lut[:, 3].copy()
+    alpha[EMPTY_INDEX] = 0
+    img.info["transparency"] = alpha.tobytes()
+
+    return img
+
+def encode_apng_frame(rgba, compress_level):
+    # the image data of one frame, rows unfiltered as pixel art compresses well without
+    rows = np.zeros((rgba.shape[0], rgba.shape[1]*4 + 1), dtype=np.uint8)
+    rows[:, 1:] = rgba.reshape(rgba.shape[0], -1)
+    return zlib.compress(rows.tobytes(), compress_level)
+
+def encoder_options(format, compress_level, optimize):
+    # what Pillow saves an image format with, WebP losslessly as blurred pixels make no sense for pixel art
+    if format == "webp":
+        return {"lossless": True, "quality": 100 if optimize else 80, "method": 6 if optimize else 4}
+    return {"compress_level": compress_level, "optimize": optimize}
+
+def png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+def process_map(function, items, parallel=True):
+    """
+    The function applied to every item, in EXPORT_PROCESSES worker
+    processes when there is more than one and parallel is set. The pool
+    is started on first use.
+    """
+    global processPool
+    if not parallel or const.EXPORT_PROCESSES == 1 or len(items) < 2:
+        return [function(item) for item in items]
+
+    with processPoolLock:
+        if processPool is None:
+            processPool = ProcessPoolExecutor(max_workers=const.EXPORT_PROCESSES)
+    return list(processPool.map(function, items))
+
+def quantize_gif_frame(rgba):
+    """
+    A frame as GIF palette indices and its palette, index 0 being
+    transparent. Up to 255 colors are kept exactly, more are reduced.
+    """
+    opaque = rgba[..., 3] >= 128
+    colors = rgba[..., :3][opaque].astype(np.uint32)
+    unique, inverse = np.unique(colors[:, 0] << 16 | colors[:, 1] << 8 | colors[:, 2], return_inverse=True)
+
+    indices = np.zeros(opaque.shape, dtype=np.uint8)
+    if len(unique) <= 255:
+        indices[opaque] = inverse.ravel() + 1
+        palette = np.stack([unique >> 16, unique >> 8 & 255, unique & 255], axis=1)
+    else:
+        img = Image.fromarray(np.ascontiguousarray(rgba[..., :3])).quantize(255)
+        indices[opaque] = np.asarray(img)[opaque] + 1
+        palette = np.array(img.getpalette()[:255*3]).reshape(-1, 3)
+
+    return indices, np.concatenate([np.zeros((1, 3)), palette]).astype(np.uint8)
+
+def save_apng(frames, durations, path, compress_level):
+    height, width = frames[0].shape[:2]
+    streams = process_map(functools.partial(encode_apng_frame, compress_level=compress_level), frames)
+
+    chunks = [PNG_SIGNATURE, png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)),
+              png_chunk(b"acTL", struct.pack(">II", len(frames), 0))]
+    sequence = 0    # fcTL and fdAT chunks are numbered together
+    for index, (stream, duration) in enumerate(zip(streams, durations)):
+        # every frame covers the whole image and replaces the one before
+        chunks.append(png_chunk(b"fcTL", struct.pack(">IIIIIHHBB", sequence, width, height, 0, 0,
+                                                     min(duration, 0xffff), 1000, 0, 0)))
+        sequence += 1
+        if index == 0:
+            chunks.append(png_chunk(b"IDAT", stream))
+        else:
+            chunks.append(png_chunk(b"fdAT", struct.pack(">I", sequence) + stream))
+            sequence += 1
+    chunks.append(png_chunk(b"IEND", b""))
+
+    write_atomic(path, lambda f: f.write(b"".join(chunks)))
+
+def save_atomic(img, path, *args, **kwargs):
+    write_atomic(path, lambda f: img.save(f, *args, **kwargs))
+
+def save_scaled(job):
+    # one size of export_sizes, written in a worker process
+    pixels, scale, path, format, options = job
+    save_atomic(build_image(pixels, scale), path, IMAGE_FORMATS[format], **options)
+    return path
+
+def save_gif(frames, durations, path):
+    height, width = frames[0].shape[:2]
+    images = []
+    for indices, palette in process_map(quantize_gif_frame, frames):
+        img = Image.frombuffer('P', (width, height), indices, 'raw', 'P', 0, 1)
+        img.putpalette(palette.tobytes())
+        images.append(img)
+
+    # each frame has its own palette, disposing of it shows the transparent pixels of the next one
+    save_atomic(images[0], path, "GIF", save_all=True, append_images=images[1:], duration=list(durations),
+                loop=0, disposal=2, transparency=0, optimize=False)
+
+def save_sprite_sheet(frames, durations, path, columns, compress_level, optimize):
+    """
+    Pack the frames into a grid, identical frames only once, and describe
+    where each frame is in a JSON file next to the image.
+    """
+    height, width = frames[0].shape[:2]
+    cells = {}      # digest of a frame -> its cell in the grid
+    frameCells = [cells.setdefault(hashlib.sha1(rgba).digest(), len(cells)) for rgba in frames]
+    columns = columns or math.ceil(math.sqrt(len(cells)))
+    rows = -(-len(cells) // columns)
+
+    sheet = np.zeros((rows*height, columns*width, 4), dtype=np.uint8)
+    described = []
+    for rgba, cell, duration in zip(frames, frameCells, durations):
+        y, x = divmod(cell, columns)
+        sheet[y*height:(y + 1)*height, x*width:(x + 1)*width] = rgba
+        described.append({"x": x*width, "y": y*height, "w": width, "h": height, "duration": duration})
+
+    img = Image.frombuffer('RGBA', (sheet.shape[1], sheet.shape[0]), sheet, 'raw', 'RGBA', 0, 1)
+    save_atomic(img, path, "PNG", compress_level=compress_level, optimize=optimize)
+
+    description = {"image": os.path.basename(path), "size": [sheet.shape[1], sheet.shape[0]], "frames": described}
+    write_atomic(os.path.splitext(path)[0] + ".json", lambda f: f.write(json.dumps(description, indent=1).encode("utf-8")))
+
+def write_atomic(path, write):
+    # write to a temporary file first, so a half written file never shows up under the real name
+    fd, tempPath = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        if os.path.exists(path):
+            shutil.copymode(path, tempPath)     # keep the permissions of the reserved file
+        else:
+            os.chmod(tempPath, newFileMode)
+        os.replace(tempPath, path)
+    except BaseException:
+        os.remove(tempPath)
+        raise
+
+def write_reserved(path, directory, extension, write):
+    """
+    Call write with the path and return its result. Without a path the next
+    free numbered filename in the directory is reserved for it, and given
+    back if writing fails.
+    """
+    if path is not None:
+        return write(path)
+
+    path = allocate_filename(directory, extension=extension)
+    try:
+        return write(path)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)     # give back the reserved name
+        raise
+
+def scaled_path(path, scale):
+    # image.png, image@2x.png, image@4x.png, ...
+    if scale == 1:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}@{scale}x{extension}"
+
+def scan_file_counter(directory, prefix, extension):
+    # scaled copies count too, see scaled_path
+    pattern = re.compile(r"{}(\d*)(@\d+x)?\.{}$".format(re.escape(prefix), re.escape(extension)))
+
+    counter = 0
+    for f in os.listdir(directory):
+        match = pattern.match(f)
+        if match:
+            counter = max(counter, int(match.group(1) or 0) + 1)
+
+    return counter
+
+def submit(function, *args, **options):
+    # runs function on the export thread, which is started by the first export
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=const.EXPORT_WORKERS, thread_name_prefix="export")
+
+    return executor.submit(function, *args, **options)
+
+def upscale(data, scale):
+    # nearest neighbour, every pixel repeated scale times both ways
+    if scale < 1 or not scale == int(scale):
+        raise ValueError(f"scale must be a whole number of at least 1, not {scale!r}")
+    if scale == 1:
+        return data
+    scaled = np.repeat(np.repeat(packed(data), scale, axis=0), scale, axis=1)
+    return scaled.view(np.uint8).reshape(scaled.shape + data.shape[2:])
+
+def export_image(pixels, path=None, directory=const.EXPORT_DIRECTORY, scale=1, format="png",
+                 compress_level=const.EXPORT_COMPRESS_LEVEL, optimize=const.EXPORT_OPTIMIZE):
+    """
+    Write the pixels to a PNG or WebP, each pixel scale x scale pixels
+    large. Without a path the next free numbered filename in the directory
+    is used.
+    """
+    if format not in IMAGE_FORMATS:
+        raise ValueError(f"unknown image format '{format}'")
+    img = build_image(pixels, scale)
+    options = encoder_options(format, compress_level, optimize)
+
+
+    def write(path):
+        save_atomic(img, path, IMAGE_FORMATS[format], **options)
+        return path
+
+    return write_reserved(path, directory, format, write)
+
+def export_image_async(pixels, **options):
+    """
+    Export a snapshot of the pixels on a worker thread. Returns a Future
+    that resolves to the written path.
+    """
+    # copy the pixels so the canvas can keep changing while the export runs
+    return submit(export_image, pixels.copy(), **options)
+
+def export_sizes(pixels, scales=const.EXPORT_SCALES, path=None, directory=const.EXPORT_DIRECTORY, format="png",
+                 compress_level=const.EXPORT_COMPRESS_LEVEL, optimize=const.EXPORT_OPTIMIZE, parallel=True):
+    """
+    Write the pixels at several sizes at once, a file per scale named
+    after the path the way scaled_path does. The pixels are read once and
+    each size is scaled and encoded in its own worker process unless
+    parallel is off. Without a path the next free numbered filename in the
+    directory is used. Returns the paths in the order of the scales.
+    """
+    if format not in IMAGE_FORMATS:
+        raise ValueError(f"unknown image format '{format}'")
+    if isinstance(pixels, TiledPixelBuffer):
+        pixels = pixels.crop(0, 0, pixels.width, pixels.height)
+
+    reserved = path is None
+    options = encoder_options(format, compress_level, optimize)
+
+    def write(path):
+        jobs = [(pixels, scale, scaled_path(path, scale), format, options) for scale in scales]
+        paths = process_map(save_scaled, jobs, parallel)
+        if reserved and 1 not in scales:
+            os.remove(path)     # it only held the number until the scaled files took it, see scan_file_counter
+        return paths
+
+    return write_reserved(path, directory, format, write)
+
+def export_sizes_async(pixels, **options):
+    """
+    Export a snapshot of the pixels at several sizes on a worker thread,
+    see export_sizes. Returns a Future that resolves to the written paths.
+    """
+    return submit(export_sizes, pixels.copy(), **options)
+
+def export_animation(frames, durations, format="gif", path=None, directory=const.EXPORT_DIRECTORY, columns=None,
+                     compress_level=const.EXPORT_COMPRESS_LEVEL, optimize=const.EXPORT_OPTIMIZE):
+    """
+    Write frames, RGBA arrays of the same size (see animation_frames), as
+    an animated "gif" or "apng", or as a sprite "sheet" of the given number
+    of columns. durations are in milliseconds. The frames are encoded in
+    worker processes. Without a path the next free numbered filename in
+    the directory is used.
+    """
+    if format not in ANIMATION_FORMATS:
+        raise ValueError(f"unknown animation format '{format}'")
+
+    def write(path):
+        if format == "gif":
+            save_gif(frames, durations, path)
+        elif format == "apng":
+            save_apng(frames, durations, path, compress_level)
+        else:
+            save_sprite_sheet(frames, durations, path, columns, compress_level, optimize)
+        return path
+
+    return write_reserved(path, directory, ANIMATION_FORMATS[format], write)
+
+def export_animation_async(canvas, **options):
+    """
+    Export the frames of a canvas snapshot (see Canvas.snapshot) on a
+    worker thread, which also flattens them. Returns a Future that resolves
+    to the written path.
+    """
+    return submit(export_canvas_animation, canvas, **options)
+
+def export_canvas_animation(canvas, **options):
+    return export_animation(animation_frames(canvas), canvas.frameDurations, **options)
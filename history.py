@@ -0,0 +1,259 @@
+from collections import deque
+
+import numpy as np
+
+import constants as const
+
+PIXELS = 0  # kinds of written deltas, a Delta
+RUNS = 1    # and a RunDelta
+
+def pack_colors(colors):
+    # fills and strokes usually write a single color, store it only once then
+    if len(colors) > 0 and (colors == colors[0]).all():
+        return colors[:1].copy()
+    return colors
+
+def pack_delta(width, ys, xs, oldData, oldMask, newData, newMask, layer=0, frame=0):
+    indices = (ys.astype(np.uint32) * width + xs).astype(np.uint32)
+    return Delta(width, indices, pack_colors(oldData), pack_colors(newData), np.packbits(oldMask), np.packbits(newMask),
+                 layer, frame)
+
+def moved_index(index, mapping):
+    return index if mapping is None else mapping[index]
+
+def read_delta(f):
+    """
+    Read a delta written by write_delta from a binary file object.
+    """
+    width, layer, frame, kind = (int(value) for value in np.load(f))
+    if kind == RUNS:
+        runs, color, keys, found, data, mask = (np.load(f) for _ in range(6))
+        return RunDelta(runs, color, [tuple(key) for key in keys.tolist()], found, data, None if data.ndim == 3 else mask,
+                        layer, frame)
+    return Delta(width, *(np.load(f) for _ in range(5)), layer, frame)
+
+def unpack_colors(colors, count):
+    return np.broadcast_to(colors, (count,) + colors.shape[1:])
+
+def write_delta(delta, f):
+    if isinstance(delta, RunDelta):
+        np.save(f, np.array([0, delta.layer, delta.frame, RUNS], dtype=np.uint32))
+        mask = np.zeros(0, dtype=bool) if delta.mask is None else delta.mask
+        arrays = (delta.runs, delta.color, np.array(delta.keys, dtype=np.int32).reshape(-1, 2), delta.found, delta.data, mask)
+    else:
+        np.save(f, np.array([delta.width, delta.layer, delta.frame, PIXELS], dtype=np.uint32))
+        arrays = (delta.indices, delta.oldData, delta.newData, delta.oldMask, delta.newMask)
+    for array in arrays:
+        np.save(f, array, allow_pickle=False)
+
+class Delta():
+    """
+    The pixels one operation changed on one layer of one frame: their
+    positions plus old and new colors (palette indices for indexed buffers)
+    and occupancy, kept as packed arrays. See pack_delta.
+    """
+    def __init__(self, width, indices, oldData, newData, oldMask, newMask, layer=0, frame=0) -> None:
+        self.width = width
+        self.layer = layer      # index of the layer in the canvas
+        self.frame = frame      # index of the animation frame
+        self.count = len(indices)
+        self.indices = indices
+        self.oldData = oldData
+        self.newData = newData
+        self.oldMask = oldMask
+        self.newMask = newMask
+
+        self.size = self.indices.nbytes + self.oldData.nbytes + self.newData.nbytes \
+                    + self.oldMask.nbytes + self.newMask.nbytes
+
+    def apply(self, canvas, undo):
+        pixels = canvas.layers[self.layer].frames[self.frame]
+        ys, xs = np.divmod(self.indices, self.width)
+        if undo:
+            data, mask = self.oldData, self.oldMask
+        else:
+            data, mask = self.newData, self.newMask
+        pixels.write(ys, xs, unpack_colors(data, self.count), np.unpackbits(mask, count=self.count).astype(bool))
+
+    def remapped(self, layers, frames):
+        # a new delta instead of changing this one, a snapshot of the history may still be saving it
+        layer, frame = moved_index(self.layer, layers), moved_index(self.frame, frames)
+        if layer is None or frame is None:
+            return None
+        return Delta(self.width, self.indices, self.oldData, self.newData, self.oldMask, self.newMask, layer, frame)
+
+class RunDelta():
+    """
+    (y, x0, x1) row runs of one raw color painted on one layer of one
+    frame, e.g. a fill: the runs plus the tiles they cross as they were
+    before, see TiledPixelBuffer.read_tiles. Tiles that were empty take
+    nothing, so a large fill costs little more than its runs. Undo puts the
+    tiles back, redo paints the runs again.
+    """
+    def __init__(self, runs, color, keys, found, data, mask, layer=0, frame=0) -> None:
+        self.layer = layer
+        self.frame = frame
+        self.count = len(runs)
+        self.runs = runs
+        self.color = color
+        self.keys = keys        # every tile the runs cross
+        self.found = found      # those that held pixels, with their data and masks
+        self.data = data
+        self.mask = mask
+
+        self.size = self.runs.nbytes + self.color.nbytes + len(self.keys)*8 + self.found.nbytes + self.data.nbytes \
+                    + (0 if self.mask is None else self.mask.nbytes)
+
+    def apply(self, canvas, undo):
+        pixels = canvas.layers[self.layer].frames[self.frame]
+        if undo:
+            pixels.restore_tiles(self.keys, self.found, self.data, self.mask)
+        else:
+            pixels.fill_runs(self.runs, self.color)
+
+    def remapped(self, layers, frames):
+        layer, frame = moved_index(self.layer, layers), moved_index(self.frame, frames)
+        if layer is None or frame is None:
+            return None
+        return RunDelta(self.runs, self.color, self.keys, self.found, self.data, self.mask, layer, frame)
+
+class Transform():
+    """
+    A whole-image transform, e.g. a flip or a resize: the pixels of every
+    layer in every frame on the other side of it, (frame, layer) ->
+    TiledPixelBuffer, and their size. Applying it either way swaps them with
+    those of the canvas, so what a crop cut off comes back with undo. Layers
+    and frames added since have no pixels on the other side and start empty.
+    Projects do not store transforms, see History.savable.
+    """
+    def __init__(self, buffers, width, height, frame=0) -> None:
+        self.buffers = buffers
+        self.width = width
+        self.height = height
+        self.layer = 0
+        self.frame = frame      # the active frame, shown again when undone
+        self.count = 1
+
+        # the tiles are shared with the transformed buffers until changed, count them all to stay on the safe side
+        tiles = set()
+        self.size = 0
+        for pixels in buffers.values():
+            tileBytes = pixels.tileSize**2 * (5 if pixels.colorTable is None else 1)
+            tiles.update(id(tile) for tile in pixels.tiles.values())
+            self.size += len(pixels.sourceTiles)*tileBytes
+        self.size += len(tiles)*tileBytes if buffers else 0
+
+    def apply(self, canvas, undo):
+        self.buffers, self.width, self.height = canvas.swap_pixels(self.buffers, self.width, self.height)
+
+    def remapped(self, layers, frames):
+        buffers = {}
+        for (frame, layer), pixels in self.buffers.items():
+            frame, layer = moved_index(frame, frames), moved_index(layer, layers)
+            if frame is not None and layer is not None:
+                buffers[(frame, layer)] = pixels
+        frame = moved_index(self.frame, frames)
+        transform = Transform(buffers, self.width, self.height, 0 if frame is None else frame)
+        transform.size = self.size
+        return transform
+
+class History():
+    def __init__(self, budget=const.HISTORY_BUDGET_BYTES) -> None:
+        self.budget = budget
+        self.size = 0
+        self.undoStack = deque()
+        self.redoStack = []
+
+    def can_redo(self):
+        return len(self.redoStack) > 0
+
+    def can_undo(self):
+        return len(self.undoStack) > 0
+
+    def clear(self):
+        self.undoStack.clear()
+        self.redoStack.clear()
+        self.size = 0
+
+    def push(self, delta):
+        if delta.count == 0:
+            return
+
+        # a new operation makes the redo stack unreachable
+        for entry in self.redoStack:
+            self.size -= entry.size
+        self.redoStack.clear()
+
+        self.undoStack.append(delta)
+        self.size += delta.size
+
+        # forget the oldest operations when over the memory budget
+        while self.size > self.budget and self.undoStack:
+            self.size -= self.undoStack.popleft().size
+
+    def record(self, pixels, ys, xs, oldData, oldMask, layer=0, frame=0):
+        """
+        Push the change at the given positions, reading the new colors from the buffer.
+        """
+        newData, newMask = pixels.read(ys, xs)
+        self.push(pack_delta(pixels.width, ys, xs, oldData, oldMask, newData, newMask, layer, frame))
+
+    def record_runs(self, pixels, runs, keys, found, data, mask, layer=0, frame=0):
+        """
+        Push runs painted with one color, keys being the tiles they cross
+        and found, data and mask what read_tiles returned for them before.
+        """
+        if len(runs) == 0:
+            return
+        color = np.array(pixels.raw_value(int(runs[0, 1]), int(runs[0, 0])), dtype=np.uint8)
+        self.push(RunDelta(np.array(runs, dtype=np.int32), color, keys, found, data, mask, layer, frame))
+
+    def redo(self, canvas):
+        """
+        Apply the last undone entry to the canvas again.
+        """
+        if not self.redoStack:
+            return False
+        delta = self.redoStack.pop()
+        delta.apply(canvas, False)
+        self.undoStack.append(delta)
+        return True
+
+    def remap(self, layers=None, frames=None):
+        """
+        Follow layers or frames being moved or deleted. Each mapping gives
+        the new index of every old one, None for a deleted one, whose deltas
+        are dropped. Without a mapping the indices stay as they are.
+        """
+        for stack in (self.undoStack, self.redoStack):
+            kept = [delta for delta in (delta.remapped(layers, frames) for delta in stack) if delta is not None]
+            stack.clear()
+            stack.extend(kept)
+        self.size = sum(delta.size for delta in self.undoStack) + sum(delta.size for delta in self.redoStack)
+
+    def restore(self, undo, redo):
+        """
+        Replace both stacks, e.g. with the deltas of a saved project.
+        """
+        self.undoStack = deque(undo)
+        self.redoStack = list(redo)
+        self.size = sum(delta.size for delta in self.undoStack) + sum(delta.size for delta in self.redoStack)
+
+    def savable(self):
+        """
+        The undo and redo entries a project can store, those up to the
+        nearest transform either way.
+        """
+        def after_transforms(stack):
+            # the last entry of a stack is the next one undone or redone
+            return stack[max((i + 1 for i, delta in enumerate(stack) if isinstance(delta, Transform)), default=0):]
+
+        return after_transforms(list(self.undoStack)), after_transforms(self.redoStack)
+
+    def undo(self, canvas):
+        if not self.undoStack:
+            return False
+        delta = self.undoStack.pop()
+        delta.apply(canvas, True)
+        self.redoStack.append(delta)
+        return True
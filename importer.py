@@ -0,0 +1,39 @@
+import numpy as np
+from PIL import Image
+
+from pixel_buffer import IndexedPixelBuffer, PixelBuffer
+
+def pixels_from_rgba(rgba, colorTable=None):
+    """
+    Build a pixel buffer from an HxWx4 RGBA array. Fully transparent pixels
+    become empty, with a color table the colors are stored as palette indices.
+    """
+    height, width = rgba.shape[:2]
+    mask = rgba[..., 3] > 0
+
+    if colorTable is None:
+        pixels = PixelBuffer(width, height)
+        np.multiply(rgba, mask[..., None], out=pixels.data)   # copy and zero the empty pixels in one pass
+        pixels.mask[...] = mask
+    else:
+        pixels = IndexedPixelBuffer(width, height, colorTable)
+        # look up every distinct color once instead of every pixel
+        packed = np.ascontiguousarray(rgba).view(np.uint32)[..., 0]
+        colors, inverse = np.unique(packed[mask], return_inverse=True)
+        indices = [colorTable.index_of(c) for c in colors.view(np.uint8).reshape(-1, 4)]
+        pixels.data[mask] = np.array(indices, dtype=np.uint8)[inverse]
+
+    ys, xs = np.nonzero(mask.any(axis=1))[0], np.nonzero(mask.any(axis=0))[0]
+    if len(ys) > 0:
+        pixels.paintedRect = [int(xs[0]), int(ys[0]), int(xs[-1]) + 1, int(ys[-1]) + 1]
+    pixels.mark_dirty(0, 0, width, height)
+    return pixels
+
+def read_image(path, colorTable=None):
+    """
+    Decode a PNG, GIF, BMP or any other image Pillow can open. Only the first frame of an animation is read.
+    """
+    with Image.open(path) as img:
+        img.seek(0)
+        rgba = np.asarray(img.convert("RGBA"))
+    return pixels_from_rgba(rgba, colorTable)
@@ -0,0 +1,325 @@
+"""
+Canvas layers and their compositing.
+
+Layers are blended bottom to top in one of BLEND_MODES at an opacity,
+following the separable blend modes of the W3C compositing spec. The
+Compositor keeps the flattened image, and per tile the flattened layers
+below the active layer and those above it. An edit of the active layer
+then only blends these three on the changed tiles, however many layers
+there are.
+"""
+import numpy as np
+
+import constants as const
+from pixel_buffer import TiledPixelBuffer
+
+BLEND_MODES = ("normal", "multiply", "add")
+
+def blend(dst, src, opacity, mode):
+    """
+    Blend straight alpha RGBA uint8 pixels onto premultiplied float32
+    pixels (0.0-1.0) in place. opacity is 0-255.
+    """
+    painted = np.flatnonzero(src[..., 3])
+    if len(painted) < src[..., 3].size // 4 and dst.flags.c_contiguous:
+        # mostly transparent, only the painted pixels are worth blending
+        pixels = dst.reshape(-1, 4)
+        part = np.take(pixels, painted, axis=0)
+        blend_pixels(part, np.take(src.reshape(-1, 4), painted, axis=0), opacity, mode)
+        pixels[painted] = part
+    else:
+        blend_pixels(dst, src, opacity, mode)
+
+def blend_pixels(dst, src, opacity, mode):
+    a = src[..., 3:4] * np.float32(opacity / 255**2)
+
+    # with the source alpha taken as 1 the same formula blends the alpha channel too
+    s = src.astype(np.float32)
+    s *= np.float32(1/255)
+    s[..., 3] = 1
+    ad = dst[..., 3:4]
+
+    if mode == "normal":
+        s -= dst
+    elif mode == "multiply":
+        s = (1 - ad)*s + s*dst - dst
+    elif mode == "add":
+        s = (1 - ad)*s + np.minimum(ad*s + dst, ad) - dst
+    else:
+        raise ValueError(f"unknown blend mode '{mode}'")
+    s *= a
+    dst += s
+
+class Layer():
+    def __init__(self, name, frames, visible=True, opacity=255, blendMode="normal") -> None:
+        self.name = name
+        self.frames = frames        # a TiledPixelBuffer per animation frame
+        self.pixels = frames[0]     # those of the active frame, see select_frame
+        self.visible = visible
+        self.opacity = opacity      # 0-255
+        self.blendMode = blendMode
+
+    def is_plain(self):
+        # drawn exactly as its pixels are
+        return self.visible and self.opacity == 255 and self.blendMode == "normal"
+
+    def select_frame(self, index):
+        self.pixels = self.frames[index]
+
+    def snapshot(self):
+        return Layer(self.name, [pixels.snapshot() for pixels in self.frames], self.visible, self.opacity, self.blendMode)
+
+class Compositor():
+    """
+    The flattened image of the layers of a canvas, kept in result for the
+    renderer and export. Tiles are composited again only when a layer
+    changed them, and with sync(view) only once they are in view, up to
+    COMPOSITE_BATCH tiles per numpy operation.
+
+    The caches of a tile are made once the active layer changes on it, a
+    tile nobody edits is cheaper to composite from all its layers. When
+    every layer above the active one blends normally they are cached as a
+    single group, as normal blending is associative. Otherwise the layers
+    above are blended one by one, still only on the changed tiles.
+
+    Given buffers, the pixels of each layer in another animation frame, the
+    compositor shows that frame instead, e.g. for onion skinning. As such a
+    frame is not being edited, any change to it composites it again.
+    """
+    def __init__(self, canvas, buffers=None) -> None:
+        self.canvas = canvas
+        self.buffers = buffers
+        self.result = TiledPixelBuffer(canvas.width, canvas.height)
+        self.pending = set()    # tiles to composite again
+        self.cacheTiles = set() # pending tiles to composite through the caches
+        self.below = {}         # tile -> premultiplied float32 layers under the active one, None when empty
+        self.above = {}         # tile -> the same for the layers over it, while they are a group
+        self.groupAbove = True
+        self.cacheState = None  # settings of the layers the caches were made of
+        self.imageState = None  # settings of all layers the result was made with
+        self.colorRevision = None   # of the color table the tiles were composited with, see recolor
+
+    def blend_layers(self, out, keys, layers):
+        """
+        Blend the layers onto out, the premultiplied tiles at keys stacked.
+        Returns which of the tiles any layer had pixels on.
+        """
+        size = self.result.tileSize
+        blended = np.zeros(len(keys), dtype=bool)
+        for layer in layers:
+            if not layer.visible:
+                continue
+            found = [(i, tile) for i, tile in enumerate(layer.pixels.tile(key) for key in keys) if tile is not None]
+            if not found:
+                continue
+
+            index = [i for i, _ in found]
+            src = np.stack([tile.rgba_region(0, 0, size, size) for _, tile in found])
+            if len(found) == len(keys):
+                blend(out, src, layer.opacity, layer.blendMode)
+            else:
+                part = out[index]
+                blend(part, src, layer.opacity, layer.blendMode)
+                out[index] = part
+            blended[index] = True
+        return blended
+
+    def cached(self, cache, keys, layers):
+        # the cache entries of the tiles, made for those missing
+        missing = [key for key in keys if key not in cache]
+        if missing:
+            out = self.new_stack(len(missing))
+            blended = self.blend_layers(out, missing, layers)
+            # kept as float, rounding them would make the result depend on which tiles were edited
+            for i, key in enumerate(missing):
+                cache[key] = out[i].copy() if blended[i] else None
+        return [cache[key] for key in keys]
+
+    def check_state(self):
+        """
+        Drop what layer changes made stale. Choosing another active layer
+        only drops the caches, changing the active layer itself keeps them
+        but composites every tile again, any other change does both.
+        """
+        canvas = self.canvas
+        active = canvas.activeLayer
+        layers = tuple((id(layer.pixels), layer.visible, layer.opacity, layer.blendMode) for layer in self.layers())
+
+        colorTable = canvas.colorTable
+        if colorTable is not None and not colorTable.revision == self.colorRevision:
+            if self.colorRevision is not None:
+                self.recolor(colorTable.changed_since(self.colorRevision))
+            self.colorRevision = colorTable.revision
+
+        if self.buffers is None:
+            cacheState = (active, layers[:active], layers[active + 1:])
+            if not cacheState == self.cacheState:
+                self.cacheState = cacheState
+                self.below.clear()
+                self.above.clear()
+                self.groupAbove = all(layer.blendMode == "normal" for layer in canvas.layers[active + 1:])
+            imageState = layers
+        else:
+            imageState = (layers, tuple(pixels.revision for pixels in self.buffers))
+
+        if not imageState == self.imageState:
+            tiles = self.result.stored_tiles()
+            for layer in self.layers():
+                tiles |= layer.pixels.stored_tiles()
+            self.pending |= tiles
+            if self.buffers is None and self.imageState is not None \
+                    and self.imageState[:active] + self.imageState[active + 1:] == layers[:active] + layers[active + 1:]:
+                self.cacheTiles |= tiles    # only the active layer changed, what the caches are for
+            self.imageState = imageState
+
+    def composite(self, keys):
+        # tiles without caches, from all their layers
+        layers = [layer for layer in self.layers() if layer.visible]
+        blended = []
+        for key in keys:
+            tiles = [(layer, tile) for layer, tile in ((layer, layer.pixels.tile(key)) for layer in layers) if tile is not None]
+            if not tiles:
+                self.store_tile(key, None)
+            elif len(tiles) == 1 and tiles[0][0].opacity == 255:
+                # a single opaque layer looks the same in any blend mode
+                width, height = self.tile_size(key)
+                self.store_tile(key, tiles[0][1].rgba_region(0, 0, width, height))
+            else:
+                blended.append(key)
+
+        if blended:
+            out = self.new_stack(len(blended))
+            self.blend_layers(out, blended, layers)
+            self.store(blended, out)
+
+    def composite_cached(self, keys):
+        # tiles the active layer changed on, from the caches and the active layer
+        layers = self.canvas.layers
+        active = self.canvas.activeLayer
+
+        out = self.new_stack(len(keys))
+        for i, tile in enumerate(self.cached(self.below, keys, layers[:active])):
+            if tile is not None:
+                out[i] = tile
+
+        self.blend_layers(out, keys, [layers[active]])
+        if not self.groupAbove:
+            self.blend_layers(out, keys, layers[active + 1:])
+        else:
+            above = self.cached(self.above, keys, layers[active + 1:])
+            if any(tile is not None for tile in above):
+                group = self.new_stack(len(keys))
+                for i, tile in enumerate(above):
+                    if tile is not None:
+                        group[i] = tile
+                out *= 1 - group[..., 3:4]
+                out += group
+
+        self.store(keys, out)
+
+    def flatten(self):
+        """
+        The whole flattened image, as a TiledPixelBuffer.
+        """
+        self.sync()
+        return self.result
+
+    def layers(self):
+        # the layers of the frame shown, with the settings of the canvas layers
+        if self.buffers is None:
+            return self.canvas.layers
+        return [Layer(layer.name, [pixels], layer.visible, layer.opacity, layer.blendMode)
+                for layer, pixels in zip(self.canvas.layers, self.buffers)]
+
+    def new_stack(self, count):
+        size = self.result.tileSize
+        return np.zeros((count, size, size, 4), dtype=np.float32)
+
+    def recolor(self, indices):
+        # changed palette colors, only the tiles using them are composited again and lose their caches
+        for index, layer in enumerate(self.layers()):
+            keys = layer.pixels.tiles_using(indices)
+            self.pending |= keys
+            if self.buffers is not None:
+                continue
+            if index == self.canvas.activeLayer:
+                self.cacheTiles |= keys
+            else:
+                for key in keys:
+                    self.below.pop(key, None)
+                    self.above.pop(key, None)
+
+    def store(self, keys, out):
+        rgba = self.unpremultiply(out)
+        for key, tile in zip(keys, rgba):
+            width, height = self.tile_size(key)
+            self.store_tile(key, tile[:height, :width])
+
+    def store_tile(self, key, rgba):
+        result = self.result
+        if rgba is None or not rgba[..., 3].any():
+            if result.tiles.pop(key, None) is not None:
+                result.touch(key)
+            return
+
+        height, width = rgba.shape[:2]
+        tile = result.tile(key, True)
+        tile.data[:height, :width] = rgba
+        tile.mask[:height, :width] = rgba[..., 3] > 0
+        tile.paintedRect = [0, 0, width, height]
+        result.touch(key)
+
+        x0, y0 = key[0]*result.tileSize, key[1]*result.tileSize
+        result.grow(x0, y0, x0 + width, y0 + height, True)
+
+    def sync(self, view=None):
+        """
+        Composite the changed tiles. With a view (x0, y0, x1, y1) in canvas
+        coordinates only the tiles it overlaps are, like LayerTexture.sync.
+        """
+        self.check_state()
+        canvas = self.canvas
+        if self.buffers is None:
+            # the changes of another frame are found by check_state, it does not take the dirty tiles of its buffers
+            for index, layer in enumerate(canvas.layers):
+                pixels = layer.pixels
+                if not index == canvas.activeLayer:
+                    for key in pixels.dirtyTiles:
+                        self.below.pop(key, None)
+                        self.above.pop(key, None)
+                else:
+                    self.cacheTiles |= pixels.dirtyTiles
+                self.pending |= pixels.dirtyTiles
+                pixels.dirtyTiles = set()
+                pixels.dirtyRect = None
+
+        size = self.result.tileSize
+        keys = [key for key in self.pending if view is None or not (
+                key[0]*size >= view[2] or (key[0] + 1)*size <= view[0] or
+                canvas.height - key[1]*size <= view[1] or canvas.height - (key[1] + 1)*size >= view[3])]
+        self.pending.difference_update(keys)
+
+        cached = [key for key in keys if key in self.cacheTiles or key in self.below]
+        direct = [key for key in keys if not (key in self.cacheTiles or key in self.below)]
+        self.cacheTiles.difference_update(keys)
+
+        batch = const.COMPOSITE_BATCH
+        for i in range(0, len(cached), batch):
+            self.composite_cached(cached[i:i + batch])
+        for i in range(0, len(direct), batch):
+            self.composite(direct[i:i + batch])
+
+    def tile_size(self, key):
+        size = self.result.tileSize
+        return min(size, self.canvas.width - key[0]*size), min(size, self.canvas.height - key[1]*size)
+
+    def unpremultiply(self, out):
+        # straight alpha uint8, transparent pixels get the zero color PixelBuffer stores them with
+        alpha = out[..., 3].copy()
+        scale = np.zeros_like(alpha)
+        np.divide(255, alpha, out=scale, where=alpha > 0)
+        out *= scale[..., None]
+        out[..., 3] = alpha*255
+        np.minimum(out, 255, out=out)
+        out += 0.5
+        return out.astype(np.uint8)
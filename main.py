@@ -1,159 +1,40 @@
 import math
+import os
+import sys
 import pyglet
 import pyglet.gl as gl
 
-import algorithms as algo
+import autosave
 import constants as const
 import export as exp
+import importer as imp
 import palette_manager as palet
+import project as proj
+from canvas import Canvas
+from layers import BLEND_MODES, Compositor
+from renderer import LayerTexture
 
 class Artist():
     def __init__(self) -> None:
         self.primaryColor = (0, 0, 0, 255)
         self.secondaryColor = (255, 0, 0, 255)
         self.mode = "pencil"
-        self.palette = palet.read_hex_to_rgb("./palette_default.hex")
+        self.fillConnectivity = 4   # 4 or 8 connected paint bucket
+        self.fillTolerance = 0      # max color channel difference still filled
+        self.strokeWidth = 1        # line, rectangle and ellipse outline width
+        self.fillShapes = False     # draw rectangles and ellipses filled
+        self.palette = palet.load_palette(const.PALETTE_PATH)
 
-class Canvas():
-    def __init__(self, width, height) -> None:
-        self.width = width
-        self.height = height
-        self.origin = [0, 0]
-        self.backgroundColor = (255, 255, 255, 255)
-
-        self.pixelMatrix = []
-        self.pixelBatchMatrix = []
-        self.previewMatrix = []
-        self.previewBatchMatrix = []
-
-        self.mousePos = [0, 0]      # mouse coordinates on canvas
-        self.beginningPos = [0, 0]  # beginning coordinates of action
-        self.endPos = [0, 0]        # end coordinates of action
-
-        self.gridOn = False
-
-    def add_pixel(self, pos, color, matrix, batch):
-        if matrix == "pixel":
-            matrixPosY = len(self.pixelMatrix) - 1 - pos[1]
-
-            if 0 <= matrixPosY < const.CANVAS_SIZE_Y and 0 <= pos[0] < const.CANVAS_SIZE_X:
-                self.add_pixel_to_batch((pos[0], matrixPosY), color, matrix, batch)
-                self.pixelMatrix[matrixPosY][pos[0]] = color
-        elif matrix == "preview":
-            matrixPosY = len(self.previewMatrix) - 1 - pos[1]
-
-            if 0 <= matrixPosY < const.CANVAS_SIZE_Y and 0 <= pos[0] < const.CANVAS_SIZE_X:
-                self.add_pixel_to_batch((pos[0], matrixPosY), color, matrix, batch)
-                self.previewMatrix[matrixPosY][pos[0]] = color
-
-    def add_pixel_to_batch(self, pos, color, matrix, batch):
-        x = pos[0] + self.origin[0]                              # convert pixel position to canvas position
-        y = (self.height - pos[1]) + self.origin[1]
-
-        if matrix == "pixel":
-            if not self.pixelBatchMatrix[pos[1]][pos[0]] == None:                              
-                self.pixelBatchMatrix[pos[1]][pos[0]].delete()   # delete pixel from batch before replacing it                 
-            
-            self.pixelBatchMatrix[pos[1]][pos[0]] = batch.add(4, pyglet.gl.GL_QUADS, None,   # add a pixel to the batch
-                ('v2f', [x, 
-                        y - 1, 
-                        x + 1, 
-                        y - 1, 
-                        x + 1, 
-                        y, 
-                        x, 
-                        y]),
-                ('c4B', (color[0], color[1], color[2], color[3], 
-                        color[0], color[1], color[2], color[3], 
-                        color[0], color[1], color[2], color[3], 
-                        color[0], color[1], color[2], color[3])))
-        elif matrix == "preview":
-            #color = (0, 255, 0, 0) # debug color for testing batch transfer
-            if not self.previewBatchMatrix[pos[1]][pos[0]] == None:                              
-                self.previewBatchMatrix[pos[1]][pos[0]].delete()   # delete pixel from batch before replacing it                 
-            
-            self.previewBatchMatrix[pos[1]][pos[0]] = batch.add(4, pyglet.gl.GL_QUADS, None,   # add a pixel to the batch
-                ('v2f', [x, 
-                        y - 1, 
-                        x + 1, 
-                        y - 1, 
-                        x + 1, 
-                        y, 
-                        x, 
-                        y]),
-                ('c4B', (color[0], color[1], color[2], color[3], 
-                        color[0], color[1], color[2], color[3], 
-                        color[0], color[1], color[2], color[3], 
-                        color[0], color[1], color[2], color[3])))
-
-    def color_pick(self, pos, artist, button):
-        matrixPosY = len(self.pixelMatrix) - 1 - pos[1]
-        if not self.pixelMatrix[matrixPosY][pos[0]] == (-1, -1, -1, -1):
-            if button == 0:
-                artist.primaryColor = self.pixelMatrix[matrixPosY][pos[0]]
-            elif button == 1:
-                artist.secondaryColor = self.pixelMatrix[matrixPosY][pos[0]]
-
-    def delete_pixel(self, pos):
-        matrixPosY = len(self.pixelMatrix) - 1 - pos[1]
-
-        if 0 <= matrixPosY < const.CANVAS_SIZE_Y and 0 <= pos[0] < const.CANVAS_SIZE_X:
-            if not self.pixelBatchMatrix[matrixPosY][pos[0]] == None:                              
-                self.pixelBatchMatrix[matrixPosY][pos[0]].delete()
-                self.pixelBatchMatrix[matrixPosY][pos[0]] = None
-                self.pixelMatrix[matrixPosY][pos[0]] = (-1, -1, -1, -1)
-
-    def draw_ellipse(self, color, batch):
-        pixels = algo.ellipse(self.beginningPos, self.endPos)
-        for pixel in pixels:
-            self.add_pixel(pixel, color, "preview", batch)
-
-    def draw_point(self, color, batch):
-        self.add_pixel(self.mousePos, color, "preview", batch)
-
-    def draw_line(self, color, batch):
-        pixels = algo.bresenham_line(self.beginningPos, self.endPos)
-        for pixel in pixels:
-            self.add_pixel(pixel, color, "preview", batch)
-
-    def draw_rectangle(self, color, batch):
-        pixels = algo.rectangle(self.beginningPos, self.endPos)
-        for pixel in pixels:
-            self.add_pixel(pixel, color, "preview", batch)
-
-    def erase_point(self):
-        self.delete_pixel(self.mousePos)
-
-    def erase_line(self):
-        pixels = algo.bresenham_line(self.beginningPos, self.endPos)
-        for pixel in pixels:
-            self.delete_pixel(pixel)
-
-    def fill(self, color, batch):
-        pixels = algo.flood_fill(self.mousePos, self.pixelMatrix)
-        for pixel in pixels:
-            self.add_pixel(pixel, color, "pixel", batch)
-
-    def is_mouse_on_canvas(self, x, y):
-        wWd2, wHd2 = const.WINDOW_START_WIDTH/2, const.WINDOW_START_HEIGHT/2
-        if wWd2 - self.width/2 < x < wWd2 + self.width/2 and wHd2 - self.height/2 < y < wHd2 + self.height/2:
-            return True
-        return False
-
-    def update_background(self):
-        self.canvasBgImage = pyglet.image.SolidColorImagePattern(self.backgroundColor).create_image(self.width, self.height)
-
-        # remove gl interpolation for sharp canvas edges when zoomed
-        canvasBgTexture = self.canvasBgImage.get_texture()
-        gl.glBindTexture(gl.GL_TEXTURE_2D, canvasBgTexture.id)
-        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
+def set_sprite_color(sprite, color):
+    sprite.color = color[:3]
+    sprite.opacity = int(color[3])
 
-        self.canvasBgSprite = pyglet.sprite.Sprite(self.canvasBgImage, x=self.origin[0], y=self.origin[1])
-
-        self.background = self.canvasBgSprite
+def swatch_image(size):
+    # white, to be tinted by the color of a sprite
+    return pyglet.image.SolidColorImagePattern((255, 255, 255, 255)).create_image(size, size)
 
 class ModeButton():
-    def __init__(self, x, y, baseBatch, batch, index = 0):
+    def __init__(self, x, y, batch, baseGroup, iconGroup, index = 0):
         self.x = 14 + x * 28
         self.y = 14 + y * 28
         self.mode = ""
@@ -162,45 +43,85 @@ class ModeButton():
         self.color = (120, 120, 120, 255)
 
         self.image = pyglet.image.SolidColorImagePattern(self.color).create_image(24, 24)
-        self.sprite = pyglet.sprite.Sprite(self.image, x=self.x, y=self.y, batch=baseBatch)
+        self.sprite = pyglet.sprite.Sprite(self.image, x=self.x, y=self.y, batch=batch, group=baseGroup)
 
         if self.index == 0:
             self.mode = "pencil"
             img = pyglet.image.load('./icons/pencil.png')
-            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch)
+            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch, group=iconGroup)
         elif self.index == 1:
             self.mode = "eraser"
             img = pyglet.image.load('./icons/eraser.png')
-            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch)
+            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch, group=iconGroup)
         elif self.index == 2:
             self.mode = "dropper"
             img = pyglet.image.load('./icons/dropper.png')
-            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch)
+            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch, group=iconGroup)
         elif self.index == 3:
             self.mode = "line"
             img = pyglet.image.load('./icons/line.png')
-            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch)
+            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch, group=iconGroup)
         elif self.index == 5:
             self.mode = "rectangle"
             img = pyglet.image.load('./icons/rect.png')
-            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch)
+            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch, group=iconGroup)
         elif self.index == 6:
             self.mode = "ellipse"
             img = pyglet.image.load('./icons/ellipse.png')
-            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch)
+            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch, group=iconGroup)
         elif self.index == 7:
             self.mode = "fill"
             img = pyglet.image.load('./icons/paint-bucket.png')
-            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch)
+            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch, group=iconGroup)
+        elif self.index == 8:
+            self.mode = "select"
+            img = pyglet.image.load('./icons/select.png')
+            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch, group=iconGroup)
+        elif self.index == 9:
+            self.mode = "wand"
+            img = pyglet.image.load('./icons/wand.png')
+            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch, group=iconGroup)
 
 class PaletteButton():
-    def __init__(self, x, y, color, batch):
+    def __init__(self, x, y, color, batch, group, index = 0):
         self.x = x
         self.y = y
+        self.index = index
+
+        # a white square tinted with the color, changing the color does not make a new image
+        self.sprite = pyglet.sprite.Sprite(swatch_image(16), x=x, y=y, batch=batch, group=group)
+        self.set_color(color)
+
+    def place(self, x, y, visible=True):
+        self.x = x
+        self.y = y
+        self.sprite.update(x=x, y=y)
+        self.sprite.visible = visible
+
+    def set_color(self, color):
         self.color = color
+        set_sprite_color(self.sprite, color)
+
+class ToolbarGroup(pyglet.graphics.OrderedGroup):
+    """
+    Window chrome drawn in a toolbar strip at the top or bottom of the
+    window, in coordinates relative to the strip. All the chrome is in one
+    batch, each strip setting up its own viewport.
+    """
+    def __init__(self, order, window, height, top) -> None:
+        super().__init__(order)
+        self.window = window
+        self.height = height
+        self.top = top
 
-        self.image = pyglet.image.SolidColorImagePattern(self.color).create_image(16, 16)
-        self.sprite = pyglet.sprite.Sprite(self.image, x=x, y=y, batch=batch)
+    def set_state(self):
+        y = self.window.height - self.height if self.top else 0
+        gl.glViewport(0, y, self.window.width, self.height)
+        gl.glMatrixMode(gl.GL_PROJECTION)
+        gl.glLoadIdentity()
+        gl.gluOrtho2D(0, self.window.width, 0, self.height)
+        gl.glMatrixMode(gl.GL_MODELVIEW)
+        gl.glLoadIdentity()
 
 class Window(pyglet.window.Window):
     def __init__(self, width, height, canvas, artist, *args, **kwargs):
@@ -214,41 +135,84 @@ class Window(pyglet.window.Window):
 
         self.init_canvas(canvas)
 
-        self.pixelBatch = pyglet.graphics.Batch()
-        self.previewBatch = pyglet.graphics.Batch()
-        self.topToolbarBatch = pyglet.graphics.Batch()
-        self.topToolbarIconBatch = pyglet.graphics.Batch()
+        # toolbars, buttons, swatches and labels, made once and drawn together in one batch
+        self.chromeBatch = pyglet.graphics.Batch()
+        bottom = ToolbarGroup(0, self, const.WINDOW_BOTTOM_TOOLBAR_HEIGHT, top=False)
+        top = ToolbarGroup(1, self, const.WINDOW_TOP_TOOLBAR_HEIGHT, top=True)
+        self.bottomBackgroundGroup = pyglet.graphics.OrderedGroup(0, bottom)
+        self.bottomTextGroup = pyglet.graphics.OrderedGroup(1, bottom)
+        self.topBackgroundGroup = pyglet.graphics.OrderedGroup(0, top)
+        self.topButtonGroup = pyglet.graphics.OrderedGroup(1, top)
+        self.topIconGroup = pyglet.graphics.OrderedGroup(2, top)
+        self.topShadowGroup = pyglet.graphics.OrderedGroup(3, top)
 
         self.modeButtons = []
         self.init_modebuttons()
 
-        # pixel cursor
-        self.pixelCursorImage = pyglet.image.SolidColorImagePattern(
-                    (0,0,0,96)).create_image(
-                    1,
-                    1)
-        self.pixelCursorSprite = None
+        # drawn over the canvas, in world coordinates
+        self.overlayBatch = pyglet.graphics.Batch()
+
+        # outline of the selection, one sprite per edge stretched to one screen pixel thick
+        selectionImage = pyglet.image.SolidColorImagePattern(const.SELECTION_OUTLINE_COLOR).create_image(1, 1)
+        self.selectionSprites = [pyglet.sprite.Sprite(selectionImage, batch=self.overlayBatch) for _ in range(4)]
+        for sprite in self.selectionSprites:
+            sprite.visible = False
+
+        # pixel cursor, moved around rather than made again
+        pixelCursorImage = pyglet.image.SolidColorImagePattern((0, 0, 0, 96)).create_image(1, 1)
+        self.pixelCursorSprite = pyglet.sprite.Sprite(pixelCursorImage, batch=self.overlayBatch)
+        self.pixelCursorSprite.visible = False
+
+        # pixels copied or cut, pasted with Ctrl+V
+        self.clipboard = None
+
+        # canvas position a move of the selected pixels has reached, None when not moving
+        self.movePos = None
+
+        # status bar, the labels only get new text
+        self.zoomLabel = self.new_status_label(4, 'left')
+        self.statusLabel = self.new_status_label(60, 'left')
+        self.positionLabel = self.new_status_label(self.width/2, 'center')
+        self.sizeLabel = self.new_status_label(self.width-4, 'right')
+
+        # project file the canvas was opened from or last saved to
+        self.project = None
+
+        # animation playback, and the frames around the active one shown faintly
+        self.playing = False
+        self.onionSkin = False
+        self.onionLayers = {}   # ids of the buffers of a frame -> its compositor and texture
+
+        # recovery files of this session, and the one a crashed session left behind
+        self.autosaver = autosave.Autosaver()
+        self.recoveryPath = autosave.find_recovery()
+        pyglet.clock.schedule_interval(self.autosave, const.AUTOSAVE_INTERVAL)
+
+        # drag input collected between frames
+        self.dragButton = None
+        self.dragPoints = []
+        self.dragShapePending = False
+        pyglet.clock.schedule(self.process_drag)
 
         # shadow for pressing mode buttons
         self.buttonShadowImage = pyglet.image.SolidColorImagePattern((0, 0, 0, 96)).create_image(24, 24)
-        self.buttonShadowSprite = pyglet.sprite.Sprite(self.buttonShadowImage, x=14, y=42)
+        self.buttonShadowSprite = pyglet.sprite.Sprite(self.buttonShadowImage, x=14, y=42,
+                                                       batch=self.chromeBatch, group=self.topShadowGroup)
 
         # shadow for palette
         self.paletteShadowImage = pyglet.image.SolidColorImagePattern((0, 0, 0, 96)).create_image(16, 16)
-        self.paletteShadowSprite = pyglet.sprite.Sprite(self.paletteShadowImage, x=0, y=100) 
-
-        for y in range(0, const.CANVAS_SIZE_Y):
-            self.canvas.pixelMatrix.append([])
-            self.canvas.pixelBatchMatrix.append([])
-            self.canvas.previewMatrix.append([])
-            self.canvas.previewBatchMatrix.append([])
-            for _ in range(0, const.CANVAS_SIZE_X):
-                self.canvas.pixelMatrix[y].append((-1, -1, -1, -1))
-                self.canvas.pixelBatchMatrix[y].append(None)
-                self.canvas.previewMatrix[y].append((-1, -1, -1, -1))
-                self.canvas.previewBatchMatrix[y].append(None)
+        self.paletteShadowSprite = pyglet.sprite.Sprite(self.paletteShadowImage, x=0, y=100,
+                                                        batch=self.chromeBatch, group=self.topShadowGroup)
+
+        # current colors, tinted in place when they change
+        self.paletteLeftColorSprite = pyglet.sprite.Sprite(swatch_image(24), x=180, y=22,
+                                                           batch=self.chromeBatch, group=self.topButtonGroup)
+        self.paletteRightColorSprite = pyglet.sprite.Sprite(swatch_image(24), x=180 + 38, y=22,
+                                                            batch=self.chromeBatch, group=self.topButtonGroup)
 
         self.init_artist(artist)
+        self.paletteLibrary = palet.PaletteLibrary(const.PALETTE_DIRECTORY)
+        self.paletteName = None     # library palette in use, None for the default one or a project's
         self.init_camera()
         self.init_toolbar_backgrounds()
         self.init_palette()
@@ -258,27 +222,28 @@ class Window(pyglet.window.Window):
         self.update_zoom_percentage_label()
         self.update_canvas_size_label()
 
+        if self.recoveryPath is not None:
+            self.set_status_message("Unsaved work from the last session was found, press Ctrl+R to recover it "
+                                    "or Ctrl+Shift+R to discard it", const.RECOVERY_MESSAGE_TIME)
+
     def apply_preview(self):
-        for y in range(len(self.canvas.previewMatrix)):
-            for x in range(len(self.canvas.previewMatrix[y])):
-                if not self.canvas.previewMatrix[y][x] == (-1, -1, -1, -1):
-                    self.canvas.pixelMatrix[y][x] = self.canvas.previewMatrix[y][x]
-                    self.canvas.previewMatrix[y][x] = (-1, -1, -1, -1)
+        self.canvas.apply_preview()
+
+    def autosave(self, dt):
+        future = self.autosaver.save(self.canvas, self.project, self.artist.palette)
+        if future is not None:
+            future.add_done_callback(lambda f: pyglet.clock.schedule_once(self.on_autosave_done, 0, f))
 
-                    canvasY = len(self.canvas.previewMatrix[y]) - 1 - y
-                    self.canvas.add_pixel((x, canvasY), self.canvas.pixelMatrix[y][x], "pixel", self.pixelBatch)
-                    self.canvas.previewBatchMatrix[y][x].delete()
-                    self.canvas.previewBatchMatrix[y][x] = None
+    def clear_onion_skin(self):
+        for compositor, texture in self.onionLayers.values():
+            texture.delete()
+        self.onionLayers = {}
 
     def clear_preview(self):
-        for y in range(len(self.canvas.previewMatrix)):
-            for x in range(len(self.canvas.previewMatrix[y])):
-                if not self.canvas.previewMatrix[y][x] == (-1, -1, -1, -1):
-                    self.canvas.previewMatrix[y][x] = (-1, -1, -1, -1)
+        self.canvas.clear_preview()
 
-                    canvasY = len(self.canvas.previewMatrix[y]) - 1 - y
-                    self.canvas.previewBatchMatrix[y][x].delete()
-                    self.canvas.previewBatchMatrix[y][x] = None
+    def clear_status_message(self, dt=0):
+        self.set_label_text(self.statusLabel, "")
 
     def convert_mouse_to_canvas_coordinates(self, x, y):
         # position of the mouse relative to window (0.0-1.0)
@@ -295,18 +260,6 @@ class Window(pyglet.window.Window):
 
         return mouseCanvasX, mouseCanvasY
 
-    def draw_bottom_toolbar_background(self):
-        # set gl stuff
-        gl.glViewport(0, 0, self.width, 20)
-        gl.glMatrixMode(gl.GL_PROJECTION)
-        gl.glLoadIdentity()
-        gl.gluOrtho2D(0, self.width, 0, 20)
-        gl.glMatrixMode(gl.GL_MODELVIEW)
-        gl.glLoadIdentity()
-
-        # draw background
-        self.bottomToolbarBgSprite.draw()
-
     def draw_grid():
         pass
 
@@ -323,26 +276,49 @@ class Window(pyglet.window.Window):
         gl.glClear(gl.GL_COLOR_BUFFER_BIT)
 
         # draw blank canvas
-        self.canvas.background.draw()
-
-        self.pixelBatch.draw()
-        self.previewBatch.draw()
-
-    def draw_top_toolbar_background(self):
-        # set gl stuff
-        gl.glViewport(0, self.height - 80, self.width, 80)
-        gl.glMatrixMode(gl.GL_PROJECTION)
-        gl.glLoadIdentity()
-        gl.gluOrtho2D(0, self.width, 0, 80)
-        gl.glMatrixMode(gl.GL_MODELVIEW)
-        gl.glLoadIdentity()
-
-        # draw background
-        self.topToolbarBgSprite.draw()
-
-    def draw_top_toolbar_icons(self):
-        self.topToolbarBatch.draw()
-        self.topToolbarIconBatch.draw()
+        self.canvasBgSprite.draw()
+
+        # draw the flattened layers and the preview, only the part in view is brought up to date
+        view = (self.left - self.canvas.origin[0], self.bottom - self.canvas.origin[1],
+                self.right - self.canvas.origin[0], self.top - self.canvas.origin[1])
+        self.draw_onion_skin(view)
+        self.canvas.compositor.sync(view)
+        self.pixelLayer.draw(view)
+        self.previewLayer.draw(view)
+        self.update_selection_outline()
+        self.overlayBatch.draw()
+
+    def draw_onion_skin(self, view):
+        # a frame keeps its texture while it is shown, it is composited and uploaded again only when it changes
+        if not self.onionSkin or self.playing:
+            return
+
+        canvas = self.canvas
+        shown = {}
+        for offset in range(-const.ONION_SKIN_FRAMES, const.ONION_SKIN_FRAMES + 1):
+            index = canvas.activeFrame + offset
+            if offset == 0 or not 0 <= index < len(canvas.frameDurations):
+                continue
+            buffers = canvas.frame_buffers(index)
+            key = tuple(id(pixels) for pixels in buffers)
+            shown[key] = self.onionLayers.pop(key) if key in self.onionLayers else self.new_onion_layer(buffers)
+
+        self.clear_onion_skin()
+        self.onionLayers = shown
+        for compositor, texture in shown.values():
+            compositor.sync(view)
+            texture.draw(view)
+
+    def export_animation(self, format):
+        # the snapshot shares the pixels, the frames are flattened on the worker
+        future = exp.export_animation_async(self.canvas.snapshot(), format=format)
+        future.add_done_callback(lambda f: pyglet.clock.schedule_once(self.on_export_done, 0, f))
+        self.set_status_message("Exporting...")
+
+    def export_sizes(self, format):
+        future = exp.export_sizes_async(self.canvas.flatten(), format=format)
+        future.add_done_callback(lambda f: pyglet.clock.schedule_once(self.on_export_done, 0, f))
+        self.set_status_message("Exporting...")
 
     def init_artist(self, artist):
         self.artist = artist
@@ -359,152 +335,279 @@ class Window(pyglet.window.Window):
     def init_canvas(self, canvas):
         self.canvas = canvas
 
-        self.canvas.origin[0] = self.width/2 - self.canvas.width/2
-        self.canvas.origin[1] = self.height/2 - self.canvas.height/2
+        # same world position is_mouse_on_canvas expects, whatever the current window size is
+        self.canvas.origin[0] = const.WINDOW_START_WIDTH/2 - self.canvas.width/2
+        self.canvas.origin[1] = const.WINDOW_START_HEIGHT/2 - self.canvas.height/2
+
+        self.update_canvas_background()
 
-        self.canvas.update_background()
+        self.pixelLayer = LayerTexture(self.canvas.compositor.result, self.canvas.origin[0], self.canvas.origin[1])
+        self.previewLayer = LayerTexture(self.canvas.preview, self.canvas.origin[0], self.canvas.origin[1])
 
     def init_modebuttons(self):
         cut = 5
         for i in range(0, 10):
             if i < cut:
-                self.modeButtons.append(ModeButton(i, 1, self.topToolbarBatch, self.topToolbarIconBatch, i))
+                self.modeButtons.append(ModeButton(i, 1, self.chromeBatch, self.topButtonGroup, self.topIconGroup, i))
             else:
-                self.modeButtons.append(ModeButton(i-cut, 0, self.topToolbarBatch, self.topToolbarIconBatch, i))
+                self.modeButtons.append(ModeButton(i-cut, 0, self.chromeBatch, self.topButtonGroup, self.topIconGroup, i))
 
     def init_palette(self):
         x, y = 180, 0
-        cut = 11   # how many palette colors in one row
 
         # left color label
         self.colorleft_label = pyglet.text.Label("Left:",
                 font_name=const.FONT_NAME,
                 font_size=9,
                 x=x, y=y+48,
-                anchor_x='left', anchor_y='bottom', bold=const.FONT_BOLD, batch=self.topToolbarBatch)
+                anchor_x='left', anchor_y='bottom', bold=const.FONT_BOLD,
+                batch=self.chromeBatch, group=self.topButtonGroup)
 
         # right color label
         self.colorright_label = pyglet.text.Label("Right:",
                 font_name=const.FONT_NAME,
                 font_size=9,
                 x=x+35, y=y+48,
-                anchor_x='left', anchor_y='bottom', bold=const.FONT_BOLD, batch=self.topToolbarBatch)
+                anchor_x='left', anchor_y='bottom', bold=const.FONT_BOLD,
+                batch=self.chromeBatch, group=self.topButtonGroup)
 
         self.palette = []
-        self.paletteColors = []
-
-        for index in range(0, 33):
-            # first row
-            if index < cut:
-                xx = x + 92 + index*16 + index*4
-                yy = y + 52
-            else:
-                # second row
-                if index < 2*cut:
-                    xx = x + 92 + (index-cut)*16 + (index-cut)*4
-                    yy = y + 32
-                # third row
-                else:
-                    xx = x + 92 + (index-2*cut)*16 + (index-2*cut)*4
-                    yy = y + 12
-
-            self.paletteColors.append(PaletteButton(xx, yy, self.artist.palette[index], self.topToolbarBatch))
-
+        self.paletteColors = [PaletteButton(x, y, color, self.chromeBatch, self.topButtonGroup, index)
+                              for index, color in enumerate(self.artist.palette)]
+        self.paletteRow = 0     # first row shown, see layout_palette
+        self.layout_palette()
 
     def init_toolbar_backgrounds(self):
-        bgCol = const.WINDOW_TOOLBAR_COLOR
+        # one pixel stretched over each toolbar, resizing the window only stretches it further
+        bgImage = pyglet.image.SolidColorImagePattern(const.WINDOW_TOOLBAR_COLOR).create_image(1, 1)
 
         # top
-        self.topToolbarBgImage = pyglet.image.SolidColorImagePattern((bgCol[0], bgCol[1], bgCol[2], bgCol[3])).create_image(
-            self.width, const.WINDOW_TOP_TOOLBAR_HEIGHT)
-        self.topToolbarBgSprite = pyglet.sprite.Sprite(self.topToolbarBgImage, x=0, y=0)
+        self.topToolbarBgSprite = pyglet.sprite.Sprite(bgImage, x=0, y=0, batch=self.chromeBatch, group=self.topBackgroundGroup)
+        self.topToolbarBgSprite.update(scale_x=self.width, scale_y=const.WINDOW_TOP_TOOLBAR_HEIGHT)
 
         # bottom
-        self.bottomToolbarBgImage = pyglet.image.SolidColorImagePattern((bgCol[0], bgCol[1], bgCol[2], bgCol[3])).create_image(
-            self.width, const.WINDOW_BOTTOM_TOOLBAR_HEIGHT)
-        self.bottomToolbarBgSprite = pyglet.sprite.Sprite(self.bottomToolbarBgImage, x=0, y=0)
+        self.bottomToolbarBgSprite = pyglet.sprite.Sprite(bgImage, x=0, y=0, batch=self.chromeBatch, group=self.bottomBackgroundGroup)
+        self.bottomToolbarBgSprite.update(scale_x=self.width, scale_y=const.WINDOW_BOTTOM_TOOLBAR_HEIGHT)
+
+    def layout_palette(self):
+        # eleven colors a row, rows up to as wide as the window for more. What does not fit in the toolbar
+        # then is scrolled to with the mouse wheel
+        x, y = 180 + 92, 52
+        columns = max(min(max(math.ceil(len(self.paletteColors) / const.PALETTE_ROWS), 11), (self.width - x)//20), 1)
+        rows = math.ceil(len(self.paletteColors) / columns)
+        self.paletteRow = min(max(self.paletteRow, 0), max(rows - const.PALETTE_ROWS, 0))
+        for box in self.paletteColors:
+            row, column = divmod(box.index, columns)
+            row -= self.paletteRow
+            box.place(x + column*20, y - row*20, 0 <= row < const.PALETTE_ROWS)
+
+    def new_status_label(self, x, anchor):
+        return pyglet.text.Label("",
+                font_name=const.FONT_NAME,
+                font_size=const.FONT_SIZE,
+                x=x, y=0,
+                anchor_x=anchor, anchor_y='bottom', bold=const.FONT_BOLD,
+                batch=self.chromeBatch, group=self.bottomTextGroup)
+
+    def new_onion_layer(self, buffers):
+        compositor = Compositor(self.canvas, buffers)
+        texture = LayerTexture(compositor.result, self.canvas.origin[0], self.canvas.origin[1], const.ONION_SKIN_OPACITY)
+        return compositor, texture
 
     def on_draw(self):
         self.draw_main_area()
 
-        if not self.pixelCursorSprite == None:
-            self.pixelCursorSprite.draw()
-
         if self.canvas.gridOn and self.zoomLevel < 0.5:
             self.draw_grid()
 
-        self.draw_bottom_toolbar_background()
-        self.zoomLabel.draw()
-        self.sizeLabel.draw()
-        if self.canvas.is_mouse_on_canvas(self.mousePos[0], self.mousePos[1]):
-            self.positionLabel.draw()
+        # toolbars and status bar, each toolbar group sets up its own viewport
+        self.chromeBatch.draw()
+
+    def on_autosave_done(self, dt, future):
+        # only a failure is worth a message
+        if future.exception() is not None:
+            self.set_status_message(f"Autosave failed: {future.exception()}")
+
+    def on_close(self):
+        # a recovery nobody answered is kept and offered again at the next start
+        self.autosaver.close()
+        super().on_close()
+
+    def on_export_done(self, dt, future):
+        # called on the UI thread once an export worker has finished
+        if future.exception() is not None:
+            self.set_status_message(f"Export failed: {future.exception()}")
+        elif isinstance(future.result(), list):
+            self.set_status_message(f"Exported {', '.join(os.path.basename(path) for path in future.result())}")
+        else:
+            self.set_status_message(f"Exported {os.path.basename(future.result())}")
 
-        self.draw_top_toolbar_background()
-        self.draw_top_toolbar_icons()
-        self.paletteLeftColorSprite.draw()
-        self.paletteRightColorSprite.draw()
-        self.buttonShadowSprite.draw()
-        self.paletteShadowSprite.draw()
-        
+    def on_file_drop(self, x, y, paths):
+        self.open_file(paths[0])
 
     def on_key_press(self, symbol, modifiers):
-        if symbol == pyglet.window.key._0:   # debug export
-            exp.export_image(self.canvas.pixelMatrix, const.CANVAS_SIZE_X, const.CANVAS_SIZE_Y)
+        # floating pixels are put down before a key does anything else, Enter does only that
+        if symbol not in (pyglet.window.key.LSHIFT, pyglet.window.key.RSHIFT, pyglet.window.key.LCTRL,
+                          pyglet.window.key.RCTRL, pyglet.window.key.LALT, pyglet.window.key.RALT):
+            self.canvas.commit_floating()
+
+        if symbol == pyglet.window.key._0 and modifiers & pyglet.window.key.MOD_CTRL:
+            self.export_sizes("webp")
+        elif symbol == pyglet.window.key._0 and modifiers & pyglet.window.key.MOD_SHIFT:
+            self.export_sizes("png")
+        elif symbol == pyglet.window.key._0:   # debug export
+            future = exp.export_image_async(self.canvas.flatten())
+            future.add_done_callback(lambda f: pyglet.clock.schedule_once(self.on_export_done, 0, f))
+            self.set_status_message("Exporting...")
+        elif symbol == pyglet.window.key._9:
+            if modifiers & pyglet.window.key.MOD_CTRL:
+                self.export_animation("sheet")
+            elif modifiers & pyglet.window.key.MOD_SHIFT:
+                self.export_animation("apng")
+            else:
+                self.export_animation("gif")
+        elif symbol == pyglet.window.key.P:
+            self.switch_palette(-1 if modifiers & pyglet.window.key.MOD_SHIFT else 1)
+        elif symbol == pyglet.window.key.F:
+            self.artist.fillShapes = not self.artist.fillShapes
+            self.set_status_message("Filled shapes" if self.artist.fillShapes else "Outlined shapes")
+        elif symbol == pyglet.window.key.BRACKETLEFT:
+            self.artist.strokeWidth = max(self.artist.strokeWidth - 1, 1)
+            self.set_status_message(f"Stroke width {self.artist.strokeWidth}")
+        elif symbol == pyglet.window.key.BRACKETRIGHT:
+            self.artist.strokeWidth = min(self.artist.strokeWidth + 1, const.STROKE_WIDTH_MAX)
+            self.set_status_message(f"Stroke width {self.artist.strokeWidth}")
+        elif symbol == pyglet.window.key.Z and modifiers & pyglet.window.key.MOD_CTRL:
+            self.undo(redo=modifiers & pyglet.window.key.MOD_SHIFT)
+        elif symbol == pyglet.window.key.Y and modifiers & pyglet.window.key.MOD_CTRL:
+            self.undo(redo=True)
+        elif symbol == pyglet.window.key.S and modifiers & pyglet.window.key.MOD_CTRL:
+            self.save_project()
+        elif symbol == pyglet.window.key.R and modifiers & pyglet.window.key.MOD_CTRL:
+            self.recover(discard=modifiers & pyglet.window.key.MOD_SHIFT)
+        elif symbol == pyglet.window.key.C and modifiers & pyglet.window.key.MOD_CTRL:
+            if self.canvas.selection is not None:
+                self.clipboard = self.canvas.copy_selection()
+                self.set_status_message("Copied")
+        elif symbol == pyglet.window.key.X and modifiers & pyglet.window.key.MOD_CTRL:
+            if self.canvas.selection is not None:
+                self.clipboard = self.canvas.cut_selection()
+                self.set_status_message("Cut")
+        elif symbol == pyglet.window.key.V and modifiers & pyglet.window.key.MOD_CTRL:
+            if self.clipboard is not None and not self.canvas.paste(self.clipboard):
+                self.set_status_message("Indexed and RGBA pixels can not be pasted into each other")
+        elif symbol == pyglet.window.key.A and modifiers & pyglet.window.key.MOD_CTRL:
+            self.canvas.select_all()
+        elif symbol == pyglet.window.key.D and modifiers & pyglet.window.key.MOD_CTRL:
+            self.canvas.deselect()
+        elif symbol == pyglet.window.key.L:
+            if self.canvas.add_layer() is None:
+                self.set_status_message(f"At most {const.LAYERS_MAX} layers")
+            else:
+                self.show_layer_status()
+        elif symbol == pyglet.window.key.DELETE and modifiers & pyglet.window.key.MOD_SHIFT:
+            self.canvas.delete_frame(self.canvas.activeFrame)
+            self.show_frame_status()
+        elif symbol == pyglet.window.key.DELETE and self.canvas.selection is not None:
+            self.canvas.erase_selection()
+        elif symbol == pyglet.window.key.DELETE:
+            self.canvas.delete_layer(self.canvas.activeLayer)
+            self.show_layer_status()
+        elif symbol in (pyglet.window.key.PAGEUP, pyglet.window.key.PAGEDOWN):
+            offset = 1 if symbol == pyglet.window.key.PAGEUP else -1
+            if modifiers & pyglet.window.key.MOD_CTRL:
+                self.canvas.move_layer(self.canvas.activeLayer, offset)
+            else:
+                self.canvas.activeLayer = min(max(self.canvas.activeLayer + offset, 0), len(self.canvas.layers) - 1)
+            self.show_layer_status()
+        elif symbol == pyglet.window.key.H:
+            layer = self.canvas.layers[self.canvas.activeLayer]
+            layer.visible = not layer.visible
+            self.show_layer_status()
+        elif symbol == pyglet.window.key.B:
+            layer = self.canvas.layers[self.canvas.activeLayer]
+            layer.blendMode = BLEND_MODES[(BLEND_MODES.index(layer.blendMode) + 1) % len(BLEND_MODES)]
+            self.show_layer_status()
+        elif symbol == pyglet.window.key.O:
+            layer = self.canvas.layers[self.canvas.activeLayer]
+            layer.opacity = layer.opacity - 64 if layer.opacity > 64 else 255
+            self.show_layer_status()
+        elif symbol == pyglet.window.key.N:
+            if self.canvas.add_frame(not modifiers & pyglet.window.key.MOD_SHIFT) is None:
+                self.set_status_message(f"At most {const.FRAMES_MAX} frames")
+            else:
+                self.show_frame_status()
+        elif symbol == pyglet.window.key.M:
+            self.canvas.flip(not modifiers & pyglet.window.key.MOD_SHIFT)
+            self.replace_canvas(self.canvas, self.project)
+        elif symbol == pyglet.window.key.T:
+            self.canvas.rotate(-1 if modifiers & pyglet.window.key.MOD_SHIFT else 1)
+            self.replace_canvas(self.canvas, self.project)
+        elif symbol == pyglet.window.key.U:
+            if self.canvas.scale(2):
+                self.replace_canvas(self.canvas, self.project)
+            else:
+                self.set_status_message(f"The canvas can be at most {const.CANVAS_SIZE_MAX} px wide and high")
+        elif symbol in (pyglet.window.key.LEFT, pyglet.window.key.RIGHT, pyglet.window.key.UP, pyglet.window.key.DOWN) \
+                and modifiers & pyglet.window.key.MOD_ALT:
+            step = -const.CANVAS_RESIZE_STEP if modifiers & pyglet.window.key.MOD_SHIFT else const.CANVAS_RESIZE_STEP
+            self.resize_canvas(symbol, step)
+        elif symbol in (pyglet.window.key.LEFT, pyglet.window.key.RIGHT):
+            offset = 1 if symbol == pyglet.window.key.RIGHT else -1
+            if modifiers & pyglet.window.key.MOD_CTRL:
+                self.canvas.move_frame(self.canvas.activeFrame, offset)
+            else:
+                self.canvas.select_frame(min(max(self.canvas.activeFrame + offset, 0), len(self.canvas.frameDurations) - 1))
+            self.show_frame_status()
+        elif symbol in (pyglet.window.key.UP, pyglet.window.key.DOWN):
+            step = const.FRAME_DURATION_STEP if symbol == pyglet.window.key.UP else -const.FRAME_DURATION_STEP
+            durations = self.canvas.frameDurations
+            durations[self.canvas.activeFrame] = max(durations[self.canvas.activeFrame] + step, const.FRAME_DURATION_STEP)
+            self.show_frame_status()
+        elif symbol == pyglet.window.key.K:
+            self.onionSkin = not self.onionSkin
+            if not self.onionSkin:
+                self.clear_onion_skin()
+            self.set_status_message("Onion skin on" if self.onionSkin else "Onion skin off")
+        elif symbol == pyglet.window.key.SPACE:
+            self.toggle_playback()
 
     def on_mouse_drag(self, x, y, dx, dy, button, modifiers):
         self.set_mouse_coordinates(x, y)
         self.update_pixel_cursor_position()
         self.canvas.endPos[0], self.canvas.endPos[1] = self.convert_mouse_to_canvas_coordinates(x, y)
 
-        if abs(self.canvas.endPos[0] - self.canvas.beginningPos[0]) > 0 \
+        # only collect the drag here, process_drag does the drawing once per frame
+        self.dragButton = button
+        if self.artist.mode == "pencil" or self.artist.mode == "eraser":
+            lastPos = self.dragPoints[-1] if self.dragPoints else tuple(self.canvas.beginningPos)
+            if not tuple(self.canvas.endPos) == lastPos:
+                self.dragPoints.append(tuple(self.canvas.endPos))
+        elif abs(self.canvas.endPos[0] - self.canvas.beginningPos[0]) > 0 \
         or abs(self.canvas.endPos[1] - self.canvas.beginningPos[1]) > 0:
-            if self.artist.mode == "pencil":
-                if button == pyglet.window.mouse.LEFT:
-                    self.canvas.draw_line(self.artist.primaryColor, self.previewBatch)
-                elif button == pyglet.window.mouse.RIGHT:
-                    self.canvas.draw_line(self.artist.secondaryColor, self.previewBatch)
-                self.canvas.beginningPos[0], self.canvas.beginningPos[1] = self.canvas.endPos[0], self.canvas.endPos[1]
-            elif self.artist.mode == "eraser":
-                if button == pyglet.window.mouse.LEFT:
-                    self.canvas.erase_line()
-                self.canvas.beginningPos[0], self.canvas.beginningPos[1] = self.canvas.endPos[0], self.canvas.endPos[1]
-            elif self.artist.mode == "line":
-                self.clear_preview()
-                if button == pyglet.window.mouse.LEFT:
-                    self.canvas.draw_line(self.artist.primaryColor, self.previewBatch)
-                elif button == pyglet.window.mouse.RIGHT:
-                    self.canvas.draw_line(self.artist.secondaryColor, self.previewBatch)
-            elif self.artist.mode == "rectangle":
-                self.clear_preview()
-                if button == pyglet.window.mouse.LEFT:
-                    self.canvas.draw_rectangle(self.artist.primaryColor, self.previewBatch)
-                elif button == pyglet.window.mouse.RIGHT:
-                    self.canvas.draw_rectangle(self.artist.secondaryColor, self.previewBatch)
-            elif self.artist.mode == "ellipse":
-                self.clear_preview()
-                if button == pyglet.window.mouse.LEFT:
-                    self.canvas.draw_ellipse(self.artist.primaryColor, self.previewBatch)
-                elif button == pyglet.window.mouse.RIGHT:
-                    self.canvas.draw_ellipse(self.artist.secondaryColor, self.previewBatch)
+            self.dragShapePending = True
 
     def on_mouse_press(self, x, y, button, modifiers):
         self.set_mouse_coordinates(x, y)
         if 48 < y < self.height - 80:   # inside main area
             if self.canvas.is_mouse_on_canvas(self.mousePos[0], self.mousePos[1]):   # inside canvas
                 self.canvas.beginningPos[0], self.canvas.beginningPos[1] = self.canvas.mousePos[0], self.canvas.mousePos[1]
+                if not self.artist.mode == "select":
+                    self.canvas.commit_floating()   # the other tools draw on the preview layer the floating pixels are on
+
                 if self.artist.mode == "pencil":
                     if button == pyglet.window.mouse.LEFT:
-                        self.canvas.draw_point(self.artist.primaryColor, self.previewBatch)
+                        self.canvas.draw_point(self.artist.primaryColor)
                     elif button == pyglet.window.mouse.RIGHT:
-                        self.canvas.draw_point(self.artist.secondaryColor, self.previewBatch)
+                        self.canvas.draw_point(self.artist.secondaryColor)
                 elif self.artist.mode == "eraser":
                     if button == pyglet.window.mouse.LEFT:
                         self.canvas.erase_point()
                 elif self.artist.mode == "line":
                     if button == pyglet.window.mouse.LEFT:
-                        self.canvas.draw_point(self.artist.primaryColor, self.previewBatch)
+                        self.canvas.draw_point(self.artist.primaryColor)
                     elif button == pyglet.window.mouse.RIGHT:
-                        self.canvas.draw_point(self.artist.secondaryColor, self.previewBatch)
+                        self.canvas.draw_point(self.artist.secondaryColor)
                 elif self.artist.mode == "dropper":
                     if button == pyglet.window.mouse.LEFT:
                         self.canvas.color_pick(self.canvas.mousePos, self.artist, 0)
@@ -513,20 +616,35 @@ class Window(pyglet.window.Window):
                     self.set_color_display()
                 elif self.artist.mode == "rectangle":
                     if button == pyglet.window.mouse.LEFT:
-                        self.canvas.draw_point(self.artist.primaryColor, self.previewBatch)
+                        self.canvas.draw_point(self.artist.primaryColor)
                     elif button == pyglet.window.mouse.RIGHT:
-                        self.canvas.draw_point(self.artist.secondaryColor, self.previewBatch)
+                        self.canvas.draw_point(self.artist.secondaryColor)
                 elif self.artist.mode == "fill":
                     if button == pyglet.window.mouse.LEFT:
-                        self.canvas.fill(self.artist.primaryColor, self.pixelBatch)
+                        self.canvas.fill(self.artist.primaryColor, self.artist.fillConnectivity, self.artist.fillTolerance)
                     elif button == pyglet.window.mouse.RIGHT:
-                        self.canvas.fill(self.artist.secondaryColor, self.pixelBatch)
+                        self.canvas.fill(self.artist.secondaryColor, self.artist.fillConnectivity, self.artist.fillTolerance)
+                elif self.artist.mode == "select":
+                    if button == pyglet.window.mouse.LEFT:
+                        # dragging from inside the selection moves its pixels, from elsewhere selects anew
+                        selection = self.canvas.selection
+                        if selection is not None and selection.contains(
+                                self.canvas.mousePos[0], self.canvas.height - 1 - self.canvas.mousePos[1]):
+                            self.canvas.lift_selection()
+                            self.movePos = tuple(self.canvas.mousePos)
+                        else:
+                            self.canvas.deselect()
+                elif self.artist.mode == "wand":
+                    if button == pyglet.window.mouse.LEFT:
+                        self.canvas.select_area(self.artist.fillConnectivity, self.artist.fillTolerance)
         else:
             if y > self.height - 80:   # inside top toolbar
                 found = False
                 for box in self.paletteColors:
-                    if box.x < x < box.x + 16 and self.height - 80 + box.y < y < self.height - 80 + box.y + 16:
-                        if button == pyglet.window.mouse.LEFT:
+                    if box.sprite.visible and box.x < x < box.x + 16 and self.height - 80 + box.y < y < self.height - 80 + box.y + 16:
+                        if button == pyglet.window.mouse.LEFT and modifiers & pyglet.window.key.MOD_SHIFT:
+                            self.set_palette_color(box, self.artist.primaryColor)   # replace the palette entry
+                        elif button == pyglet.window.mouse.LEFT:
                             self.artist.primaryColor = box.color
                         elif button == pyglet.window.mouse.RIGHT:
                             self.artist.secondaryColor = box.color
@@ -553,24 +671,126 @@ class Window(pyglet.window.Window):
     def on_mouse_motion(self, x, y, dx, dy):
         self.set_mouse_coordinates(x, y)
         self.update_pixel_cursor_position()
-        if self.canvas.is_mouse_on_canvas(self.mousePos[0], self.mousePos[1]):
-            self.update_coordinates_label()
+        self.update_coordinates_label()
 
     def on_mouse_release(self, x, y, button, modifiers):
-        # apply preview layer to image layer
-        self.apply_preview()
+        # draw what is left of the drag, then apply preview layer to image layer
+        self.process_drag(0)
+        self.movePos = None
+        if self.canvas.floating is None:    # floating pixels stay on the preview layer until committed
+            self.apply_preview()
+        self.canvas.commit_erase()
 
         # remove shadow from palette item
         self.paletteShadowSprite.x = 0
         self.paletteShadowSprite.y = 100
 
     def on_mouse_scroll(self, x, y, dx, dy):
+        if y > self.height - 80 and x > 180 + 92:    # over the palette
+            self.paletteRow -= int(math.copysign(1, dy)) if dy else 0
+            self.layout_palette()
+            return
         self.zoom(x, y, dy)
         self.update_zoom_percentage_label()
 
     def on_resize(self, width, height):
         self.resize_content(width, height)
     
+    def open_image(self, path):
+        try:
+            pixels = imp.read_image(path, self.canvas.colorTable)
+        except (OSError, ValueError) as e:
+            self.set_status_message(f"Open failed: {e}")
+            return
+
+        self.canvas.load_pixels(pixels)
+        self.replace_canvas(self.canvas, None)
+        self.set_status_message(f"Opened {os.path.basename(path)}")
+
+    def open_file(self, path):
+        if path.lower().endswith("." + const.PROJECT_EXTENSION):
+            self.open_project(path)
+        else:
+            self.open_image(path)
+
+    def open_project(self, path):
+        try:
+            canvas, project = proj.open_project(path)
+        except (OSError, ValueError) as e:
+            self.set_status_message(f"Open failed: {e}")
+            return
+
+        if project.palette:
+            self.set_palette(project.palette)
+        self.replace_canvas(canvas, project)
+        self.set_status_message(f"Opened {os.path.basename(path)}")
+
+    def play_frame(self, dt):
+        canvas = self.canvas
+        canvas.select_frame((canvas.activeFrame + 1) % len(canvas.frameDurations))
+        pyglet.clock.schedule_once(self.play_frame, canvas.frameDurations[canvas.activeFrame]/1000)
+
+    def process_drag(self, dt):
+        # join the pencil and eraser positions of this frame into one polyline
+        if self.dragPoints:
+            points = [tuple(self.canvas.beginningPos)] + self.dragPoints
+            self.dragPoints = []
+
+            if self.artist.mode == "pencil":
+                if self.dragButton == pyglet.window.mouse.LEFT:
+                    self.canvas.draw_polyline(points, self.artist.primaryColor)
+                elif self.dragButton == pyglet.window.mouse.RIGHT:
+                    self.canvas.draw_polyline(points, self.artist.secondaryColor)
+            elif self.artist.mode == "eraser":
+                if self.dragButton == pyglet.window.mouse.LEFT:
+                    self.canvas.erase_polyline(points)
+            self.canvas.beginningPos[0], self.canvas.beginningPos[1] = points[-1]
+
+        # shapes only need the latest drag position
+        if self.dragShapePending:
+            self.dragShapePending = False
+
+            if self.artist.mode == "line":
+                self.clear_preview()
+                if self.dragButton == pyglet.window.mouse.LEFT:
+                    self.canvas.draw_line(self.artist.primaryColor, self.artist.strokeWidth)
+                elif self.dragButton == pyglet.window.mouse.RIGHT:
+                    self.canvas.draw_line(self.artist.secondaryColor, self.artist.strokeWidth)
+            elif self.artist.mode == "rectangle":
+                self.clear_preview()
+                if self.dragButton == pyglet.window.mouse.LEFT:
+                    self.canvas.draw_rectangle(self.artist.primaryColor, self.artist.strokeWidth, self.artist.fillShapes)
+                elif self.dragButton == pyglet.window.mouse.RIGHT:
+                    self.canvas.draw_rectangle(self.artist.secondaryColor, self.artist.strokeWidth, self.artist.fillShapes)
+            elif self.artist.mode == "ellipse":
+                self.clear_preview()
+                if self.dragButton == pyglet.window.mouse.LEFT:
+                    self.canvas.draw_ellipse(self.artist.primaryColor, self.artist.strokeWidth, self.artist.fillShapes)
+                elif self.dragButton == pyglet.window.mouse.RIGHT:
+                    self.canvas.draw_ellipse(self.artist.secondaryColor, self.artist.strokeWidth, self.artist.fillShapes)
+            elif self.artist.mode == "select" and self.dragButton == pyglet.window.mouse.LEFT:
+                if self.movePos is None:
+                    self.canvas.select_rectangle()
+                elif not tuple(self.canvas.endPos) == self.movePos:
+                    self.canvas.move_floating(self.canvas.endPos[0] - self.movePos[0], self.canvas.endPos[1] - self.movePos[1])
+                    self.movePos = tuple(self.canvas.endPos)
+
+    def resize_canvas(self, symbol, step):
+        # move the edge of the canvas an arrow key points to out by step pixels, in for a negative step
+        canvas = self.canvas
+        width, height, anchor = canvas.width, canvas.height, [0, 0]
+        if symbol in (pyglet.window.key.LEFT, pyglet.window.key.RIGHT):
+            width += step
+            anchor[0] = 1 if symbol == pyglet.window.key.LEFT else 0
+        else:
+            height += step
+            anchor[1] = 1 if symbol == pyglet.window.key.UP else 0
+
+        if canvas.resize(width, height, anchor):
+            self.replace_canvas(canvas, self.project)
+        else:
+            self.set_status_message(f"The canvas can be 1 to {const.CANVAS_SIZE_MAX} px wide and high")
+
     def resize_content(self, width, height):
         fx = width/self.lastWidth
         fy = height/self.lastHeight
@@ -593,25 +813,78 @@ class Window(pyglet.window.Window):
         self.lastWidth = width
         self.lastHeight = height
 
-        # resize toolbars to match new window size
-        self.init_toolbar_backgrounds()
+        # stretch toolbars to match new window size, and keep the labels at their edges
+        self.topToolbarBgSprite.scale_x = width
+        self.bottomToolbarBgSprite.scale_x = width
+        self.positionLabel.x = width/2
+        self.sizeLabel.x = width-4
+        self.layout_palette()
+
+    def recover(self, discard=False):
+        # the recovery files are only removed once recovered or declined
+        if self.recoveryPath is None:
+            return
+
+        if discard:
+            autosave.discard(self.recoveryPath)
+            self.recoveryPath = None
+            self.set_status_message("Discarded the unsaved work of the last session")
+            return
+
+        try:
+            path = autosave.recover(self.recoveryPath)
+        except OSError as e:
+            self.set_status_message(f"Recovery failed: {e}")
+            return
+        self.recoveryPath = None
+        self.open_project(path)
+
+    def replace_canvas(self, canvas, project):
+        if self.project is not None and self.project is not project:
+            self.autosaver.wait()   # an autosave may still be reading it
+            self.project.close()
+        self.project = project
+
+        if self.playing:
+            self.toggle_playback()
+
+        # the layers are rebuilt at the new size, each uploads the whole image once
+        self.clear_onion_skin()
+        self.pixelLayer.delete()
+        self.previewLayer.delete()
+        self.init_canvas(canvas)
+        self.update_canvas_size_label()
 
     def run(self):
         # start the window
         pyglet.app.run()
 
+    def save_project(self):
+        try:
+            if self.project is None:
+                path = exp.allocate_filename(const.PROJECT_DIRECTORY, const.FILENAME_DEFAULT, const.PROJECT_EXTENSION)
+            else:
+                path = self.project.path
+            self.autosaver.wait()
+            self.project = proj.save_project(self.canvas, path, self.project, self.artist.palette)
+        except (OSError, ValueError) as e:
+            self.set_status_message(f"Save failed: {e}")
+            return
+
+        self.set_status_message(f"Saved {os.path.basename(path)}")
+
     def set_app_icon(self):
         self.icon = pyglet.image.load(const.APP_ICON_PATH)
         self.set_icon(self.icon)
 
     def set_color_display(self):
-        # left color display
-        self.paletteLeftColorImage = pyglet.image.SolidColorImagePattern(self.artist.primaryColor).create_image(24, 24)
-        self.paletteLeftColorSprite = pyglet.sprite.Sprite(self.paletteLeftColorImage, x = 180, y = 22)
+        set_sprite_color(self.paletteLeftColorSprite, self.artist.primaryColor)
+        set_sprite_color(self.paletteRightColorSprite, self.artist.secondaryColor)
 
-        # right color display
-        self.paletteRightColorImage = pyglet.image.SolidColorImagePattern(self.artist.secondaryColor).create_image(24, 24)
-        self.paletteRightColorSprite = pyglet.sprite.Sprite(self.paletteRightColorImage, x = 180 + 38, y = 22)
+    def set_label_text(self, label, text):
+        # setting the text lays the label out again, even when it is the same
+        if label.text != text:
+            label.text = text
 
     def set_mouse_coordinates(self, x, y):
         # position of the mouse relative to window (0.0-1.0)
@@ -626,38 +899,129 @@ class Window(pyglet.window.Window):
         self.canvas.mousePos[0] = math.floor(self.mousePos[0] - const.WINDOW_START_WIDTH/2 + self.canvas.width/2)
         self.canvas.mousePos[1] = math.floor(self.mousePos[1] - const.WINDOW_START_HEIGHT/2 + self.canvas.height/2)
 
+    def set_palette(self, colors):
+        # swatches and labels live in the toolbar batch, so the old ones have to be removed
+        for box in self.paletteColors:
+            box.sprite.delete()
+        self.colorleft_label.delete()
+        self.colorright_label.delete()
+
+        self.artist.palette = list(colors)
+        self.init_palette()
+
+    def set_palette_color(self, box, color):
+        # a palette switched to or loaded since need not be in the order of the color table, the color finds its entry
+        self.canvas.set_palette_color(box.color, color)
+        self.artist.palette[box.index] = color
+        box.set_color(color)
+
+    def set_status_message(self, text, duration=const.STATUS_MESSAGE_TIME):
+        self.set_label_text(self.statusLabel, text)
+        pyglet.clock.unschedule(self.clear_status_message)
+        pyglet.clock.schedule_once(self.clear_status_message, duration)
+
     def set_window_background_color(self):
         bg = const.WINDOW_BACKGROUND_COLOR
         gl.glClearColor(bg[0], bg[1], bg[2], bg[3])
 
+    def show_frame_status(self):
+        playing = ", playing" if self.playing else ""
+        self.set_status_message(f"Frame {self.canvas.activeFrame + 1}/{len(self.canvas.frameDurations)}, "
+                                f"{self.canvas.frameDurations[self.canvas.activeFrame]} ms{playing}")
+
+    def show_layer_status(self):
+        layer = self.canvas.layers[self.canvas.activeLayer]
+        hidden = ", hidden" if not layer.visible else ""
+        self.set_status_message(f"{layer.name} ({self.canvas.activeLayer + 1}/{len(self.canvas.layers)}), "
+                                f"{layer.blendMode} {round(layer.opacity/2.55)}%{hidden}")
+
+    def switch_palette(self, offset):
+        # to the next or previous palette of the library, each is parsed the first time it is shown
+        names = self.paletteLibrary.names()
+        if not names:
+            self.set_status_message(f"No palettes in {const.PALETTE_DIRECTORY}")
+            return
+
+        if self.paletteName in names:
+            index = names.index(self.paletteName) + offset
+        else:
+            index = 0 if offset > 0 else -1
+        self.paletteName = names[index % len(names)]
+        try:
+            colors = self.paletteLibrary.get(self.paletteName)
+        except (OSError, palet.PaletteError) as e:
+            self.set_status_message(f"Palette failed: {e}")
+            return
+        self.set_palette(colors)
+        self.set_status_message(f"Palette {self.paletteName}")
+
+    def toggle_playback(self):
+        self.playing = not self.playing
+        pyglet.clock.unschedule(self.play_frame)
+        if self.playing:
+            pyglet.clock.schedule_once(self.play_frame, self.canvas.frameDurations[self.canvas.activeFrame]/1000)
+        self.show_frame_status()
+
+    def undo(self, redo=False):
+        compositor = self.canvas.compositor
+        if redo:
+            self.canvas.redo()
+        else:
+            self.canvas.undo()
+
+        # a transform was undone or redone, the layers have other pixels and maybe another size
+        if self.canvas.compositor is not compositor:
+            self.replace_canvas(self.canvas, self.project)
+
     def update_coordinates_label(self):
-        # set mouse coordinates label
-        self.positionLabel = pyglet.text.Label(f"({self.canvas.mousePos[0]}, {self.canvas.mousePos[1]})",
-                font_name=const.FONT_NAME,
-                font_size=const.FONT_SIZE,
-                x=self.width/2, y=0,
-                anchor_x='center', anchor_y='bottom', bold=const.FONT_BOLD)
+        # set mouse coordinates label, empty when the mouse is off the canvas
+        if self.canvas.is_mouse_on_canvas(self.mousePos[0], self.mousePos[1]):
+            self.set_label_text(self.positionLabel, f"({self.canvas.mousePos[0]}, {self.canvas.mousePos[1]})")
+        else:
+            self.set_label_text(self.positionLabel, "")
+
+    def update_canvas_background(self):
+        # one pixel stretched over the canvas, a full size image would not fit in memory on large canvases
+        self.canvasBgImage = pyglet.image.SolidColorImagePattern(self.canvas.backgroundColor).create_image(1, 1)
+
+        # remove gl interpolation for sharp canvas edges when zoomed
+        canvasBgTexture = self.canvasBgImage.get_texture()
+        gl.glBindTexture(gl.GL_TEXTURE_2D, canvasBgTexture.id)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
+
+        self.canvasBgSprite = pyglet.sprite.Sprite(self.canvasBgImage, x=self.canvas.origin[0], y=self.canvas.origin[1])
+        self.canvasBgSprite.update(scale_x=self.canvas.width, scale_y=self.canvas.height)
 
     def update_canvas_size_label(self):
-        self.sizeLabel = pyglet.text.Label(f"{self.canvas.width} x {self.canvas.height} px",
-                font_name=const.FONT_NAME,
-                font_size=const.FONT_SIZE,
-                x=self.width-4, y=0,
-                anchor_x='right', anchor_y='bottom', bold=const.FONT_BOLD)
+        self.set_label_text(self.sizeLabel, f"{self.canvas.width} x {self.canvas.height} px")
 
     def update_pixel_cursor_position(self):
         if self.canvas.is_mouse_on_canvas(self.mousePos[0], self.mousePos[1]):
-            self.pixelCursorSprite = pyglet.sprite.Sprite(self.pixelCursorImage, x=self.canvas.origin[0]+self.canvas.mousePos[0],
-                                                        y=self.canvas.origin[1]+self.canvas.mousePos[1])
+            self.pixelCursorSprite.position = (self.canvas.origin[0]+self.canvas.mousePos[0],
+                                               self.canvas.origin[1]+self.canvas.mousePos[1])
+            self.pixelCursorSprite.visible = True
         else:
-            self.pixelCursorSprite = None
+            self.pixelCursorSprite.visible = False
+
+    def update_selection_outline(self):
+        # the bounding box of the selection, selections are kept with rows counting from the top
+        selection = self.canvas.selection
+        for sprite in self.selectionSprites:
+            sprite.visible = selection is not None
+        if selection is None:
+            return
+
+        x0, y0, x1, y1 = selection.rect()
+        left, right = self.canvas.origin[0] + x0, self.canvas.origin[0] + x1
+        bottom, top = self.canvas.origin[1] + self.canvas.height - y1, self.canvas.origin[1] + self.canvas.height - y0
+        thickness = self.zoomLevel
+        edges = ((left, bottom, right - left, thickness), (left, top - thickness, right - left, thickness),
+                 (left, bottom, thickness, top - bottom), (right - thickness, bottom, thickness, top - bottom))
+        for sprite, (x, y, width, height) in zip(self.selectionSprites, edges):
+            sprite.update(x=x, y=y, scale_x=width, scale_y=height)
 
     def update_zoom_percentage_label(self):
-        self.zoomLabel = pyglet.text.Label(f"{int(1/self.zoomLevel*100)}%",
-            font_name=const.FONT_NAME,
-            font_size=const.FONT_SIZE,
-            x=4, y=0,
-            anchor_x='left', anchor_y='bottom', bold=const.FONT_BOLD)
+        self.set_label_text(self.zoomLabel, f"{int(1/self.zoomLevel*100)}%")
 
     def zoom(self, x, y, dy):
         # get scale factor based on which direction the scroll was
@@ -710,6 +1074,9 @@ class Window(pyglet.window.Window):
 if __name__ == "__main__":
     appArtist = Artist()
     appCanvas = Canvas(
-        const.CANVAS_SIZE_X, const.CANVAS_SIZE_Y)
+        const.CANVAS_SIZE_X, const.CANVAS_SIZE_Y, appArtist.palette if const.CANVAS_INDEXED else None)
     appWindow = Window(
-        const.WINDOW_START_WIDTH, const.WINDOW_START_HEIGHT, appCanvas, appArtist, resizable=True, caption=const.APP_NAME).run()
+        const.WINDOW_START_WIDTH, const.WINDOW_START_HEIGHT, appCanvas, appArtist, resizable=True, caption=const.APP_NAME, file_drops=True)
+    if len(sys.argv) > 1:
+        appWindow.open_file(sys.argv[1])
+    appWindow.run()
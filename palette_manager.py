@@ -1,10 +1,237 @@
+import hashlib
+import os
+import re
+import struct
+import tempfile
+
+import numpy as np
+
+import constants as const
+
+CACHE_MAGIC = b"P31C"
+CACHE_VERSION = 1
+CACHE_HEADER = struct.Struct("<4sHqq20sI")   # magic, version, mtime_ns, size, sha1, color count
+
+HEX_LINE = re.compile(r"#?([0-9a-fA-F]{6})$")
+
+class PaletteError(ValueError):
+    pass
+
+def parse_ase(raw, name):
+    """
+    Adobe Swatch Exchange. Only the color entries are read, groups are flattened.
+    """
+    if raw[:4] != b"ASEF" or len(raw) < 12:
+        raise PaletteError(f"{name}: not an ASE file")
+
+    blocks, = struct.unpack_from(">I", raw, 8)
+    colors = []
+    offset = 12
+    for _ in range(blocks):
+        if offset + 6 > len(raw):
+            raise PaletteError(f"{name}: truncated block at byte {offset}")
+        blockType, length = struct.unpack_from(">HI", raw, offset)
+        offset += 6
+        end = offset + length
+        if end > len(raw):
+            raise PaletteError(f"{name}: truncated block at byte {offset}")
+
+        if blockType == 0x0001:
+            nameLength, = struct.unpack_from(">H", raw, offset)
+            position = offset + 2 + nameLength*2
+            model = raw[position:position + 4]
+            colors.append(ase_color(model, raw, position + 4, name))
+        offset = end
+
+    return colors
+
+def ase_color(model, raw, offset, name):
+    try:
+        if model == b"RGB ":
+            r, g, b = struct.unpack_from(">3f", raw, offset)
+        elif model == b"CMYK":
+            c, m, y, k = struct.unpack_from(">4f", raw, offset)
+            r, g, b = (1 - c)*(1 - k), (1 - m)*(1 - k), (1 - y)*(1 - k)
+        elif model == b"Gray":
+            r = g = b = struct.unpack_from(">f", raw, offset)[0]
+        else:
+            raise PaletteError(f"{name}: unsupported color model {model!r}")
+    except struct.error:
+        raise PaletteError(f"{name}: truncated color at byte {offset}")
+
+    return tuple(min(max(round(c*255), 0), 255) for c in (r, g, b)) + (255,)
+
+def parse_gpl(raw, name):
+    """
+    GIMP palette: a "GIMP Palette" header, then one "R G B [name]" per line.
+    """
+    lines = raw.decode("utf-8", "replace").splitlines()
+    if not lines or lines[0].strip() != "GIMP Palette":
+        raise PaletteError(f"{name}: not a GIMP palette")
+
+    colors = []
+    for number, line in enumerate(lines[1:], 2):
+        line = line.strip()
+        if not line or line.startswith("#") or line.startswith("Name:") or line.startswith("Columns:"):
+            continue
+        colors.append(parse_rgb(line.split()[:3], name, number))
+
+    return colors
+
+def parse_hex(raw, name):
+    """
+    One RRGGBB color per line, like the palettes from lospec.com.
+    """
+    colors = []
+    for number, line in enumerate(raw.decode("ascii", "replace").splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        match = HEX_LINE.match(line)
+        if match is None:
+            raise PaletteError(f"{name}:{number}: expected RRGGBB, got {line!r}")
+        value = int(match.group(1), 16)
+        colors.append((value >> 16, (value >> 8) & 255, value & 255, 255))
+
+    return colors
+
+def parse_jasc(raw, name):
+    """
+    JASC (Paint Shop Pro) palette: "JASC-PAL", a version, the color count, then "R G B" lines.
+    """
+    lines = [line.strip() for line in raw.decode("ascii", "replace").splitlines()]
+    if len(lines) < 3 or lines[0] != "JASC-PAL":
+        raise PaletteError(f"{name}: not a JASC palette")
+    if not lines[2].isdigit():
+        raise PaletteError(f"{name}:3: expected the color count, got {lines[2]!r}")
+
+    count = int(lines[2])
+    entries = [(number, line) for number, line in enumerate(lines[3:], 4) if line]
+    if len(entries) != count:
+        raise PaletteError(f"{name}: header says {count} colors, file has {len(entries)}")
+
+    return [parse_rgb(line.split()[:3], name, number) for number, line in entries]
+
+def parse_rgb(values, name, number):
+    if len(values) != 3 or not all(v.isdigit() and int(v) < 256 for v in values):
+        raise PaletteError(f"{name}:{number}: expected three values 0-255, got {' '.join(values)!r}")
+    return (int(values[0]), int(values[1]), int(values[2]), 255)
+
+PARSERS = {
+    ".ase": parse_ase,
+    ".gpl": parse_gpl,
+    ".hex": parse_hex,
+    ".pal": parse_jasc,
+}
+
+def cache_path(path, directory=const.PALETTE_CACHE_DIRECTORY):
+    key = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()
+    return os.path.join(directory, key + ".bin")
+
+def load_palette(path, cacheDirectory=const.PALETTE_CACHE_DIRECTORY):
+    """
+    Read a palette file as a list of RGBA tuples. Parsed palettes are cached,
+    a file whose mtime and size did not change is not opened at all.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in PARSERS:
+        raise PaletteError(f"{path}: unsupported palette format {extension!r}")
+
+    stat = os.stat(path)
+    cached = read_cache(cache_path(path, cacheDirectory)) if cacheDirectory else None
+    if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+
+    with open(path, "rb") as f:
+        raw = f.read()
+    digest = hashlib.sha1(raw).digest()
+
+    if cached is not None and cached[1] == digest:
+        colors = cached[2]      # touched but not changed
+    else:
+        colors = PARSERS[extension](raw, path)
+        if not colors:
+            raise PaletteError(f"{path}: palette has no colors")
+
+    if cacheDirectory:
+        write_cache(cache_path(path, cacheDirectory), stat, digest, colors)
+    return colors
+
+def read_cache(path):
+    # returns ((mtime_ns, size), sha1, colors), or None when there is no usable entry
+    try:
+        with open(path, "rb") as f:
+            raw = f.read()
+    except OSError:
+        return None
+
+    if len(raw) < CACHE_HEADER.size:
+        return None
+    magic, version, mtime, size, digest, count = CACHE_HEADER.unpack_from(raw)
+    if magic != CACHE_MAGIC or version != CACHE_VERSION or len(raw) != CACHE_HEADER.size + count*4:
+        return None
+
+    colors = np.frombuffer(raw, dtype=np.uint8, offset=CACHE_HEADER.size).reshape(count, 4)
+    return (mtime, size), digest, [tuple(c) for c in colors.tolist()]
+
 def read_hex_to_rgb(filename):
-    palette_colors = []
+    with open(filename, "rb") as f:
+        return parse_hex(f.read(), filename)
+
+def write_cache(path, stat, digest, colors):
+    # the cache is only a speed up, a read-only or full disk must not stop the palette from loading
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tempPath = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+    except OSError:
+        return
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, stat.st_mtime_ns, stat.st_size, digest, len(colors)))
+            f.write(np.array(colors, dtype=np.uint8).tobytes())
+        os.replace(tempPath, path)
+    except OSError:
+        try:
+            os.remove(tempPath)     # no half written files left in the cache directory
+        except OSError:
+            pass
+
+class PaletteLibrary():
+    """
+    Palette files of a directory. Only the file names are read up front,
+    each palette is parsed (or read from the cache) the first time it is used.
+    """
+    def __init__(self, directory, cacheDirectory=const.PALETTE_CACHE_DIRECTORY) -> None:
+        self.directory = directory
+        self.cacheDirectory = cacheDirectory
+        self.paths = {}         # palette name, the file name with its extension -> file path
+        self.palettes = {}      # palette name -> colors, for the palettes loaded so far
+
+        self.scan()
+
+    def __contains__(self, name):
+        return name in self.paths
+
+    def __len__(self):
+        return len(self.paths)
+
+    def get(self, name):
+        if name not in self.palettes:
+            self.palettes[name] = load_palette(self.paths[name], self.cacheDirectory)
+        return self.palettes[name]
+
+    def names(self):
+        return sorted(self.paths)
 
-    with open(filename) as f:
-            for _, line in enumerate(f):
-                stripped_line = line.strip("\n")
-                rgb = tuple(int(stripped_line[i:i+2], 16) for i in (0, 2, 4))
-                palette_colors.append((rgb[0], rgb[1], rgb[2], 255))
+    def scan(self):
+        self.paths.clear()
+        self.palettes.clear()
+        if not os.path.isdir(self.directory):
+            return
 
-    return palette_colors
+        # keyed by the whole file name, so foo.hex and foo.gpl are two palettes
+        for entry in os.scandir(self.directory):
+            extension = os.path.splitext(entry.name)[1]
+            if extension.lower() in PARSERS and entry.is_file():
+                self.paths[entry.name] = entry.path
@@ -0,0 +1,162 @@
+"""
+Headless command line tools, no window or GL needed.
+
+    python pix31.py render sprites.json -o out --jobs 8 --scales 1 2 4 8
+
+A render file holds one sprite, a list of sprites or {"sprites": [...]}.
+A sprite is {"name": "hero", "width": 32, "height": 32, "ops": [...]}, or
+just the list of ops. Each op is a dict such as
+
+    {"op": "pixel", "pos": [x, y], "color": [r, g, b, a]}
+    {"op": "line", "from": [x, y], "to": [x, y], "color": "#ff0000", "width": 1}
+    {"op": "rect", "from": [x, y], "to": [x, y], "color": ..., "width": 1, "filled": false}
+    {"op": "ellipse", "from": [x, y], "to": [x, y], "color": ..., "width": 1, "filled": false}
+    {"op": "fill", "pos": [x, y], "color": ..., "connectivity": 4, "tolerance": 0}
+    {"op": "erase", "pos": [x, y]}
+
+using the same coordinates as the editor, (0, 0) being the bottom left pixel.
+A sprite with a "palette" list of colors is stored and exported indexed.
+With --scales each sprite is also written enlarged, hero@2x.png and so on.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import constants as const
+import export as exp
+from canvas import Canvas
+from history import History
+
+HEX_COLOR = re.compile(r"#?([0-9a-fA-F]{6}|[0-9a-fA-F]{8})$")
+
+class RenderError(ValueError):
+    pass
+
+def parse_color(color):
+    if isinstance(color, str):
+        match = HEX_COLOR.match(color)
+        if not match:
+            raise RenderError(f"bad color '{color}', expected #rrggbb or #rrggbbaa")
+        color = match.group(1)
+        if len(color) == 6:
+            color += "ff"
+        return tuple(int(color[i:i+2], 16) for i in (0, 2, 4, 6))
+    if not isinstance(color, (list, tuple)) or len(color) not in (3, 4) or \
+            not all(isinstance(value, int) and 0 <= value <= 255 for value in color):
+        raise RenderError(f"bad color {color!r}, expected 3 or 4 values from 0 to 255")
+    if len(color) == 3:
+        return (color[0], color[1], color[2], 255)
+    return tuple(color)
+
+def run_op(canvas, op):
+    kind = op["op"]
+
+    if kind in ("line", "rect", "ellipse"):
+        canvas.beginningPos = list(op["from"])
+        canvas.endPos = list(op["to"])
+        color = parse_color(op["color"])
+        width = op.get("width", 1)
+        if kind == "line":
+            canvas.draw_line(color, width)
+        elif kind == "rect":
+            canvas.draw_rectangle(color, width, op.get("filled", False))
+        else:
+            canvas.draw_ellipse(color, width, op.get("filled", False))
+        canvas.apply_preview()
+    elif kind == "pixel":
+        canvas.add_pixel(op["pos"], parse_color(op["color"]), "pixel")
+    elif kind == "fill":
+        canvas.mousePos = list(op["pos"])
+        canvas.fill(parse_color(op["color"]), op.get("connectivity", 4), op.get("tolerance", 0))
+    elif kind == "erase":
+        canvas.delete_pixel(op["pos"])
+    else:
+        raise RenderError(f"unknown op '{kind}'")
+
+def render_sprite(sprite, outputDir, scales=(1,), format="png", parallel=False):
+    try:
+        palette = [parse_color(color) for color in sprite["palette"]] if "palette" in sprite else None
+    except RenderError as e:
+        raise RenderError(f"{sprite['name']}: palette: {e}") from None
+    canvas = Canvas(sprite.get("width", const.CANVAS_SIZE_X), sprite.get("height", const.CANVAS_SIZE_Y), palette)
+    canvas.history = History(budget=0)      # nothing to undo in batch mode
+
+    for index, op in enumerate(sprite["ops"]):
+        try:
+            run_op(canvas, op)
+        except RenderError as e:
+            raise RenderError(f"{sprite['name']}: op {index}: {e}") from None
+        except KeyError as e:
+            raise RenderError(f"{sprite['name']}: op {index}: missing {e}") from None
+
+    return exp.export_sizes(canvas.pixels, scales, os.path.join(outputDir, f"{sprite['name']}.{format}"), format=format,
+                            parallel=parallel)
+
+def read_sprites(path):
+    if path == "-":
+        content = json.load(sys.stdin)
+        stem = "sprite"
+    else:
+        with open(path) as f:
+            content = json.load(f)
+        stem = os.path.splitext(os.path.basename(path))[0]
+
+    if isinstance(content, dict):
+        content = content["sprites"] if "sprites" in content else [content]
+    elif content and "op" in content[0]:
+        content = [{"ops": content}]    # a bare list of ops
+
+    sprites = []
+    for index, sprite in enumerate(content):
+        if isinstance(sprite, list):
+            sprite = {"ops": sprite}
+        if "name" not in sprite:
+            sprite = dict(sprite, name=stem if len(content) == 1 else f"{stem}{index}")
+        sprites.append(sprite)
+
+    return sprites
+
+def render(args):
+    os.makedirs(args.output, exist_ok=True)
+
+    sprites = []
+    for path in args.files:
+        sprites.extend(read_sprites(path))
+
+    # the sizes of a sprite are encoded in parallel only when the sprites are not
+    if args.jobs > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            count = len(sprites)
+            paths = list(pool.map(render_sprite, sprites, [args.output] * count, [args.scales] * count,
+                                  [args.format] * count))
+    else:
+        paths = [render_sprite(sprite, args.output, args.scales, args.format, True) for sprite in sprites]
+
+    for spritePaths in paths:
+        for path in spritePaths:
+            print(path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog=const.APP_NAME)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    renderParser = commands.add_parser("render", help="render JSON draw ops to PNG files")
+    renderParser.add_argument("files", nargs="+", help="JSON render files, - for stdin")
+    renderParser.add_argument("-o", "--output", default=const.EXPORT_DIRECTORY, help="output directory")
+    renderParser.add_argument("-j", "--jobs", type=int, default=1, help="number of worker processes")
+    renderParser.add_argument("-s", "--scales", type=int, nargs="+", default=[1],
+                              help="sizes to write each sprite at, e.g. 1 2 4 8")
+    renderParser.add_argument("-f", "--format", choices=sorted(exp.IMAGE_FORMATS), default="png", help="image format")
+    renderParser.set_defaults(func=render)
+
+    args = parser.parse_args(argv)
+    try:
+        args.func(args)
+    except RenderError as e:
+        parser.exit(2, f"{parser.prog}: error: {e}\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,837 @@
+import itertools
+
+import numpy as np
+
+import constants as const
+
+EMPTY = (-1, -1, -1, -1)   # color returned for pixels that have not been painted
+EMPTY_INDEX = 255          # palette index of pixels that have not been painted
+
+revisions = itertools.count(1)
+
+def grow_rect(rect, x0, y0, x1, y1):
+    if rect is None:
+        return [x0, y0, x1, y1]
+    rect[0], rect[1] = min(rect[0], x0), min(rect[1], y0)
+    rect[2], rect[3] = max(rect[2], x1), max(rect[3], y1)
+    return rect
+
+def next_revision():
+    # unique across all buffers, so a revision identifies one change of one tile
+    return next(revisions)
+
+class PixelBuffer():
+    """
+    Contiguous RGBA pixel storage. Row 0 is the top row of the image,
+    the same way the PNG export reads it.
+    """
+    def __init__(self, width, height) -> None:
+        self.width = width
+        self.height = height
+
+        self.data = np.zeros((height, width, 4), dtype=np.uint8)   # color channels, zero where empty
+        self.mask = np.zeros((height, width), dtype=bool)           # True where a pixel is painted
+
+        self.dirtyRect = None     # [x0, y0, x1, y1) area changed since the renderer last synced
+        self.paintedRect = None   # [x0, y0, x1, y1) area written to since the last clear
+
+    def blit(self, other, x0, y0, x1, y1, x, y):
+        """
+        Copy the painted pixels of a region of another buffer to (x, y).
+        """
+        mask = other.mask[y0:y1, x0:x1]
+        height, width = mask.shape
+        if mask.all():
+            self.data[y:y+height, x:x+width] = other.data[y0:y1, x0:x1]    # a plain slice copy
+        else:
+            np.copyto(self.data[y:y+height, x:x+width], other.data[y0:y1, x0:x1], where=mask[..., None])
+        self.mask[y:y+height, x:x+width] |= mask
+        self.mark_painted(x, y, x + width, y + height)
+
+    def clear(self):
+        # only the painted area can hold pixels, so there is no need to visit the rest
+        if self.paintedRect is None:
+            return
+
+        x0, y0, x1, y1 = self.paintedRect
+        self.data[y0:y1, x0:x1] = 0
+        self.mask[y0:y1, x0:x1] = False
+        self.mark_dirty(x0, y0, x1, y1)
+        self.paintedRect = None
+
+    def contains(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def copy(self):
+        buffer = PixelBuffer(self.width, self.height)
+        buffer.data[...] = self.data
+        buffer.mask[...] = self.mask
+        buffer.paintedRect = None if self.paintedRect is None else list(self.paintedRect)
+        return buffer
+
+    def delete(self, x, y):
+        if self.mask[y, x]:
+            self.data[y, x] = 0
+            self.mask[y, x] = False
+            self.mark_dirty(x, y, x + 1, y + 1)
+            return True
+        return False
+
+    def erase(self, x, y, mask):
+        """
+        Empty the pixels of the region at (x, y) where mask, the size of the region, is True.
+        """
+        height, width = mask.shape
+        self.data[y:y+height, x:x+width][mask] = 0
+        self.mask[y:y+height, x:x+width] &= ~mask
+        self.mark_dirty(x, y, x + width, y + height)
+
+    def fill_mask(self, x, y, mask, color):
+        """
+        Paint the pixels of the region at (x, y) where mask, the size of the region, is True.
+        """
+        height, width = mask.shape
+        if mask.all():
+            # a plain slice assignment, of whole pixels
+            self.data.view(np.uint32)[y:y+height, x:x+width] = np.asarray(color, dtype=np.uint8).view(np.uint32)
+        else:
+            self.data[y:y+height, x:x+width][mask] = color
+        self.mask[y:y+height, x:x+width] |= mask
+        self.mark_painted(x, y, x + width, y + height)
+
+    def fill_span(self, y, x0, x1, color):
+        self.data[y, x0:x1] = color
+        self.mask[y, x0:x1] = True
+        self.mark_painted(x0, y, x1, y + 1)
+
+    def get(self, x, y):
+        if not self.mask[y, x]:
+            return EMPTY
+        return tuple(int(c) for c in self.data[y, x])
+
+    def is_empty(self, x, y):
+        return not self.mask[y, x]
+
+    def mask_region(self, x0, y0, x1, y1):
+        return self.mask[y0:y1, x0:x1]
+
+    def mark_dirty(self, x0, y0, x1, y1):
+        self.dirtyRect = grow_rect(self.dirtyRect, x0, y0, x1, y1)
+
+    def mark_painted(self, x0, y0, x1, y1):
+        self.paintedRect = grow_rect(self.paintedRect, x0, y0, x1, y1)
+        self.dirtyRect = grow_rect(self.dirtyRect, x0, y0, x1, y1)
+
+    def match_mask(self, value, tolerance=0, rect=None):
+        """
+        True for the pixels of rect holding the raw value, every empty pixel if value is None.
+        """
+        x0, y0, x1, y1 = rect or (0, 0, self.width, self.height)
+        mask = self.mask[y0:y1, x0:x1]
+        if value is None:
+            return ~mask
+        if tolerance > 0:
+            diff = np.abs(self.data[y0:y1, x0:x1].astype(np.int16) - np.asarray(value, dtype=np.int16))
+            return mask & (diff.max(axis=2) <= tolerance)
+
+        packed = self.data.view(np.uint32)[y0:y1, x0:x1, 0]    # compare whole RGBA pixels at once
+        return mask & (packed == np.asarray(value, dtype=np.uint8).view(np.uint32)[0])
+
+    def merge(self, other):
+        """
+        Copy the painted pixels of another buffer of the same size on top of this one.
+        """
+        if other.paintedRect is not None:
+            x0, y0, x1, y1 = other.paintedRect
+            self.blit(other, x0, y0, x1, y1, x0, y0)
+
+    def plot(self, xs, ys, color):
+        if len(xs) == 0:
+            return
+        self.data[ys, xs] = color
+        self.mask[ys, xs] = True
+        self.mark_painted(int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+
+    def read(self, ys, xs):
+        return self.data[ys, xs], self.mask[ys, xs]
+
+    def rgba_region(self, x0, y0, x1, y1):
+        return self.data[y0:y1, x0:x1]
+
+    def raw_value(self, x, y):
+        # the stored color of a pixel, None when it is empty
+        return self.data[y, x].copy() if self.mask[y, x] else None
+
+    def same_color_mask(self, x, y, tolerance=0, rect=None):
+        """
+        True for every pixel with the color of (x, y), or every empty pixel if (x, y) is empty.
+        """
+        return self.match_mask(self.raw_value(x, y), tolerance, rect)
+
+    def set(self, x, y, color):
+        self.data[y, x] = color
+        self.mask[y, x] = True
+        self.mark_painted(x, y, x + 1, y + 1)
+
+    def write(self, ys, xs, data, mask):
+        if len(ys) == 0:
+            return
+        self.data[ys, xs] = np.where(mask[:, None], data, 0)
+        self.mask[ys, xs] = mask
+
+        x0, x1, y0, y1 = int(xs.min()), int(xs.max()) + 1, int(ys.min()), int(ys.max()) + 1
+        if mask.any():
+            self.mark_painted(x0, y0, x1, y1)
+        else:
+            self.mark_dirty(x0, y0, x1, y1)
+
+    def to_rgba(self):
+        # empty pixels are stored as zeros, so the data is already a valid RGBA image
+        return self.data
+
+class ColorTable():
+    """
+    Palette shared by indexed buffers, up to 255 colors. Changing a color
+    recolors every pixel using it without touching the pixels themselves.
+    """
+    def __init__(self, colors=()) -> None:
+        self.lut = np.zeros((256, 4), dtype=np.uint8)   # lut[EMPTY_INDEX] stays transparent
+        self.count = 0
+        self.indices = {}       # color -> first index holding it
+        self.revision = 0       # increased whenever an existing color changes
+        self.changed = np.zeros(256, dtype=np.int64)    # revision each color last changed at
+
+        for color in colors:
+            self.add_color(color)
+
+    def copy(self):
+        table = ColorTable()
+        table.lut[...] = self.lut
+        table.count = self.count
+        table.indices = dict(self.indices)
+        table.revision = self.revision
+        table.changed = self.changed.copy()
+        return table
+
+    def add_color(self, color):
+        if self.count >= EMPTY_INDEX:
+            raise ValueError("palette is full")
+
+        index = self.count
+        self.lut[index] = color
+        self.indices.setdefault(tuple(int(c) for c in color), index)
+        self.count += 1
+        return index
+
+    def changed_since(self, revision):
+        # the indices of the colors changed after a revision
+        return np.flatnonzero(self.changed > revision)
+
+    def index_of(self, color):
+        color = tuple(int(c) for c in color)
+        if color in self.indices:
+            return self.indices[color]
+        if self.count < EMPTY_INDEX:
+            return self.add_color(color)
+
+        # the palette is full, use the closest color
+        diff = np.abs(self.lut[:self.count].astype(np.int16) - np.array(color, dtype=np.int16)).sum(axis=1)
+        return int(diff.argmin())
+
+    def set_color(self, index, color):
+        old = tuple(int(c) for c in self.lut[index])
+        if self.indices.get(old) == index:
+            del self.indices[old]
+
+        self.lut[index] = color
+        self.indices.setdefault(tuple(int(c) for c in color), index)
+        self.revision += 1
+        self.changed[index] = self.revision
+
+class IndexedPixelBuffer(PixelBuffer):
+    """
+    Pixel storage holding one palette index per pixel, EMPTY_INDEX where
+    nothing is painted. Colors go in and come out as RGBA like in
+    PixelBuffer, raw data and history entries hold the indices.
+    """
+    def __init__(self, width, height, colorTable) -> None:
+        self.width = width
+        self.height = height
+        self.colorTable = colorTable
+
+        self.data = np.full((height, width), EMPTY_INDEX, dtype=np.uint8)
+
+        self.dirtyRect = None
+        self.paintedRect = None
+
+    @property
+    def mask(self):
+        return self.data != EMPTY_INDEX
+
+    def blit(self, other, x0, y0, x1, y1, x, y):
+        indices = other.data[y0:y1, x0:x1]
+        if other.colorTable is not self.colorTable:
+            # translate the other palette into this one
+            indices = np.array([self.colorTable.index_of(c) for c in other.colorTable.lut[:other.colorTable.count]]
+                               + [EMPTY_INDEX] * (256 - other.colorTable.count), dtype=np.uint8)[indices]
+
+        mask = indices != EMPTY_INDEX
+        height, width = mask.shape
+        np.copyto(self.data[y:y+height, x:x+width], indices, where=mask)
+        self.mark_painted(x, y, x + width, y + height)
+
+    def clear(self):
+        if self.paintedRect is None:
+            return
+
+        x0, y0, x1, y1 = self.paintedRect
+        self.data[y0:y1, x0:x1] = EMPTY_INDEX
+        self.mark_dirty(x0, y0, x1, y1)
+        self.paintedRect = None
+
+    def copy(self):
+        buffer = IndexedPixelBuffer(self.width, self.height, self.colorTable)
+        buffer.data[...] = self.data
+        buffer.paintedRect = None if self.paintedRect is None else list(self.paintedRect)
+        return buffer
+
+    def delete(self, x, y):
+        if self.data[y, x] != EMPTY_INDEX:
+            self.data[y, x] = EMPTY_INDEX
+            self.mark_dirty(x, y, x + 1, y + 1)
+            return True
+        return False
+
+    def erase(self, x, y, mask):
+        height, width = mask.shape
+        self.data[y:y+height, x:x+width][mask] = EMPTY_INDEX
+        self.mark_dirty(x, y, x + width, y + height)
+
+    def fill_mask(self, x, y, mask, color):
+        height, width = mask.shape
+        index = color if np.ndim(color) == 0 else self.colorTable.index_of(color)   # or a raw index, e.g. of a RunDelta
+        if mask.all():
+            self.data[y:y+height, x:x+width] = index
+        else:
+            self.data[y:y+height, x:x+width][mask] = index
+        self.mark_painted(x, y, x + width, y + height)
+
+    def fill_span(self, y, x0, x1, color):
+        self.data[y, x0:x1] = self.colorTable.index_of(color)
+        self.mark_painted(x0, y, x1, y + 1)
+
+    def get(self, x, y):
+        if self.data[y, x] == EMPTY_INDEX:
+            return EMPTY
+        return tuple(int(c) for c in self.colorTable.lut[self.data[y, x]])
+
+    def is_empty(self, x, y):
+        return self.data[y, x] == EMPTY_INDEX
+
+    def mask_region(self, x0, y0, x1, y1):
+        return self.data[y0:y1, x0:x1] != EMPTY_INDEX
+
+    def match_mask(self, value, tolerance=0, rect=None):
+        x0, y0, x1, y1 = rect or (0, 0, self.width, self.height)
+        data = self.data[y0:y1, x0:x1]
+        if value is None:
+            return data == EMPTY_INDEX
+        if tolerance > 0:
+            lut = self.colorTable.lut.astype(np.int16)
+            close = np.abs(lut - lut[value]).max(axis=1) <= tolerance
+            close[EMPTY_INDEX] = False
+            return close[data]
+        return data == value
+
+    def plot(self, xs, ys, color):
+        if len(xs) == 0:
+            return
+        self.data[ys, xs] = self.colorTable.index_of(color)
+        self.mark_painted(int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+
+    def read(self, ys, xs):
+        indices = self.data[ys, xs]
+        return indices, indices != EMPTY_INDEX
+
+    def rgba_region(self, x0, y0, x1, y1):
+        # the lookup turns EMPTY_INDEX into transparent zeros
+        return self.colorTable.lut[self.data[y0:y1, x0:x1]]
+
+    def raw_value(self, x, y):
+        index = int(self.data[y, x])
+        return None if index == EMPTY_INDEX else index
+
+    def set(self, x, y, color):
+        self.data[y, x] = self.colorTable.index_of(color)
+        self.mark_painted(x, y, x + 1, y + 1)
+
+    def to_rgba(self):
+        return self.rgba_region(0, 0, self.width, self.height)
+
+    def write(self, ys, xs, data, mask):
+        if len(ys) == 0:
+            return
+        self.data[ys, xs] = np.where(mask, data, EMPTY_INDEX)
+
+        x0, x1, y0, y1 = int(xs.min()), int(xs.max()) + 1, int(ys.min()), int(ys.max()) + 1
+        if mask.any():
+            self.mark_painted(x0, y0, x1, y1)
+        else:
+            self.mark_dirty(x0, y0, x1, y1)
+
+class TiledPixelBuffer():
+    """
+    Sparse pixel storage split into square tiles, each a PixelBuffer (an
+    IndexedPixelBuffer with a color table) allocated the first time
+    something is painted on it. Empty regions take no memory. Has the
+    methods of PixelBuffer, plus tile-level dirty flags and revisions for
+    the renderer and project saving.
+
+    Tiles can be shared with snapshots, see snapshot. Everything changing a
+    tile gets it through edit, which copies a shared tile first.
+    """
+    def __init__(self, width, height, colorTable=None, tileSize=const.CANVAS_TILE_SIZE) -> None:
+        self.width = width
+        self.height = height
+        self.colorTable = colorTable
+        self.tileSize = tileSize
+        self.tilesX = -(-width // tileSize)
+
+        self.tiles = {}             # (tx, ty) -> tile buffer
+        self.tileRevisions = {}     # (tx, ty) -> revision of the last change, see next_revision
+        self.shared = set()         # tiles a snapshot holds too
+        self.revision = 0           # the newest tile revision
+
+        # tiles not read yet, loaded through source(tx, ty) when first used
+        self.source = None
+        self.sourceTiles = set()
+        self.sourceRevision = 0
+
+        self.dirtyRect = None
+        self.dirtyTiles = set()     # tiles changed since the renderer last synced
+        self.paintedRect = None
+
+    def blit(self, other, x0, y0, x1, y1, x, y):
+        """
+        Copy the painted pixels of a region of a PixelBuffer to (x, y), clipped to this buffer.
+        """
+        x0, y0 = x0 + max(-x, 0), y0 + max(-y, 0)
+        x, y = max(x, 0), max(y, 0)
+        x1, y1 = min(x1, x0 + self.width - x), min(y1, y0 + self.height - y)
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        dx, dy = x - x0, y - y0
+        for key, (tx0, ty0, tx1, ty1) in self.tile_rects(x, y, x + x1 - x0, y + y1 - y0):
+            if not other.mask_region(tx0 - dx, ty0 - dy, tx1 - dx, ty1 - dy).any():
+                continue
+            left, top = key[0]*self.tileSize, key[1]*self.tileSize
+            self.edit(key).blit(other, tx0 - dx, ty0 - dy, tx1 - dx, ty1 - dy, tx0 - left, ty0 - top)
+            self.touch(key)
+        self.grow(x, y, x + x1 - x0, y + y1 - y0, True)
+
+    def clear(self):
+        if self.paintedRect is None:
+            return
+
+        # dropping the tiles frees them, the renderer still has to blank them
+        for key in set(self.tiles) | self.sourceTiles:
+            self.touch(key)
+        self.tiles.clear()
+        self.sourceTiles.clear()
+        self.shared.clear()
+        self.grow(*self.paintedRect, False)
+        self.paintedRect = None
+
+    def contains(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def copy(self):
+        # the copy may outlive the source, e.g. a project file closed while exporting
+        for key in list(self.sourceTiles):
+            self.tile(key)
+
+        buffer = TiledPixelBuffer(self.width, self.height, self.colorTable, self.tileSize)
+        buffer.tiles = {key: tile.copy() for key, tile in self.tiles.items()}
+        buffer.tileRevisions = dict(self.tileRevisions)
+        buffer.paintedRect = None if self.paintedRect is None else list(self.paintedRect)
+        return buffer
+
+    def crop(self, x0, y0, x1, y1):
+        """
+        The region as a dense PixelBuffer (IndexedPixelBuffer with a color table).
+        """
+        buffer = self.new_tile(x1 - x0, y1 - y0)
+        for key, (tx0, ty0, tx1, ty1) in self.tile_rects(x0, y0, x1, y1):
+            tile = self.tile(key)
+            if tile is not None:
+                left, top = key[0]*self.tileSize, key[1]*self.tileSize
+                buffer.blit(tile, tx0 - left, ty0 - top, tx1 - left, ty1 - top, tx0 - x0, ty0 - y0)
+        buffer.dirtyRect = None
+        return buffer
+
+    def delete(self, x, y):
+        if self.is_empty(x, y):
+            return False
+        key = (x // self.tileSize, y // self.tileSize)
+        self.edit(key).delete(x - key[0]*self.tileSize, y - key[1]*self.tileSize)
+        self.touch(key)
+        self.grow(x, y, x + 1, y + 1, False)
+        return True
+
+    def edit(self, key, create=True):
+        # the tile about to be changed, a copy of it if a snapshot holds it
+        tile = self.tile(key, create)
+        if key in self.shared:
+            self.shared.discard(key)
+            if tile is not None:
+                tile = self.tiles[key] = tile.copy()
+        return tile
+
+    def erase(self, x, y, mask):
+        """
+        Empty the pixels of the region at (x, y) where mask, the size of the
+        region, is True. Tiles are changed a slice at a time.
+        """
+        height, width = mask.shape
+        for key, (tx0, ty0, tx1, ty1) in self.tile_rects(x, y, x + width, y + height):
+            part = mask[ty0 - y:ty1 - y, tx0 - x:tx1 - x]
+            if not part.any() or (key not in self.tiles and key not in self.sourceTiles):
+                continue
+            left, top = key[0]*self.tileSize, key[1]*self.tileSize
+            self.edit(key).erase(tx0 - left, ty0 - top, part)
+            self.touch(key)
+        self.grow(x, y, x + width, y + height, False)
+
+    def fill_runs(self, runs, color):
+        """
+        Paint (y, x0, x1) row runs. The runs are split at the tile edges and
+        grouped by tile, each tile is changed once with one masked assignment.
+        """
+        runs = np.asarray(runs, dtype=np.intp).reshape(-1, 3)
+        if len(runs) == 0:
+            return
+
+        size = self.tileSize
+        for key, rows, x0s, x1s in self.split_runs(runs):
+            if (x0s == 0).all() and (x1s == size).all() and np.bincount(rows, minlength=size).all():
+                mask = np.ones((size, size), dtype=bool)    # the inside of a large fill
+            else:
+                # +1 where a run starts and -1 where it ends, summed along each row
+                edges = np.zeros((size, size + 1), dtype=np.int16)
+                np.add.at(edges, (rows, x0s), 1)
+                np.add.at(edges, (rows, x1s), -1)
+                mask = np.cumsum(edges, axis=1)[:, :size] > 0
+            self.edit(key).fill_mask(0, 0, mask, color)
+            self.touch(key)
+        self.grow(int(runs[:, 1].min()), int(runs[:, 0].min()), int(runs[:, 2].max()), int(runs[:, 0].max()) + 1, True)
+
+    def fill_span(self, y, x0, x1, color):
+        size = self.tileSize
+        ty = y // size
+        for tx in range(x0 // size, (x1 - 1) // size + 1):
+            left = tx*size
+            self.edit((tx, ty)).fill_span(y - ty*size, max(x0, left) - left, min(x1, left + size) - left, color)
+            self.touch((tx, ty))
+        self.grow(x0, y, x1, y + 1, True)
+
+    def get(self, x, y):
+        key, tile = self.tile_at(x, y)
+        if tile is None:
+            return EMPTY
+        return tile.get(x - key[0]*self.tileSize, y - key[1]*self.tileSize)
+
+    def grow(self, x0, y0, x1, y1, painted):
+        if painted:
+            self.paintedRect = grow_rect(self.paintedRect, x0, y0, x1, y1)
+        self.dirtyRect = grow_rect(self.dirtyRect, x0, y0, x1, y1)
+
+    def group(self, ys, xs):
+        """
+        Split coordinate arrays by tile. Yields each tile key with the
+        positions of its pixels in the arrays and the coordinates inside the tile.
+        """
+        size = self.tileSize
+        tys, txs = ys // size, xs // size
+        keys = tys*self.tilesX + txs
+        if (keys == keys[0]).all():
+            # strokes mostly stay on one tile
+            yield (int(txs[0]), int(tys[0])), slice(None), ys - int(tys[0])*size, xs - int(txs[0])*size
+            return
+
+        order = np.argsort(keys, kind="stable")
+        bounds = np.flatnonzero(np.diff(keys[order])) + 1
+        for part in np.split(order, bounds):
+            tx, ty = int(txs[part[0]]), int(tys[part[0]])
+            yield (tx, ty), part, ys[part] - ty*size, xs[part] - tx*size
+
+    def is_empty(self, x, y):
+        key, tile = self.tile_at(x, y)
+        return tile is None or tile.is_empty(x - key[0]*self.tileSize, y - key[1]*self.tileSize)
+
+    def mark_dirty(self, x0, y0, x1, y1):
+        for key, _ in self.tile_rects(x0, y0, x1, y1):
+            if key in self.tiles or key in self.sourceTiles:
+                self.touch(key)
+        self.grow(x0, y0, x1, y1, False)
+
+    def mark_painted(self, x0, y0, x1, y1):
+        self.mark_dirty(x0, y0, x1, y1)
+        self.grow(x0, y0, x1, y1, True)
+
+    def mask_region(self, x0, y0, x1, y1):
+        return self.region(x0, y0, x1, y1, "mask_region", np.zeros((y1 - y0, x1 - x0), dtype=bool))
+
+    def match_mask(self, value, tolerance=0, rect=None):
+        x0, y0, x1, y1 = rect or (0, 0, self.width, self.height)
+        out = np.full((y1 - y0, x1 - x0), value is None, dtype=bool)   # how the missing tiles match
+        for key, (tx0, ty0, tx1, ty1) in self.tile_rects(x0, y0, x1, y1):
+            tile = self.tile(key)
+            if tile is not None:
+                left, top = key[0]*self.tileSize, key[1]*self.tileSize
+                out[ty0-y0:ty1-y0, tx0-x0:tx1-x0] = tile.match_mask(value, tolerance, (tx0 - left, ty0 - top, tx1 - left, ty1 - top))
+        return out
+
+    def merge(self, other):
+        """
+        Copy the painted pixels of another tiled buffer of the same size on top of this one.
+        """
+        if other.paintedRect is None:
+            return
+
+        for key in set(other.tiles) | other.sourceTiles:
+            tile = other.tile(key)
+            if tile.paintedRect is not None:
+                self.edit(key).merge(tile)
+                self.touch(key)
+        self.grow(*other.paintedRect, True)
+
+    def new_tile(self, width=None, height=None):
+        width = width or self.tileSize
+        height = height or self.tileSize
+        if self.colorTable is None:
+            return PixelBuffer(width, height)
+        return IndexedPixelBuffer(width, height, self.colorTable)
+
+    def painted_positions(self):
+        """
+        The rows and columns of every painted pixel, visiting only the stored tiles.
+        """
+        ys, xs = [np.zeros(0, dtype=np.intp)], [np.zeros(0, dtype=np.intp)]
+        for key in sorted(self.stored_tiles()):
+            tys, txs = np.nonzero(self.tile(key).mask_region(0, 0, self.tileSize, self.tileSize))
+            ys.append(tys + key[1]*self.tileSize)
+            xs.append(txs + key[0]*self.tileSize)
+        return np.concatenate(ys), np.concatenate(xs)
+
+    def plot(self, xs, ys, color):
+        if len(xs) == 0:
+            return
+        for key, _, tys, txs in self.group(ys, xs):
+            self.edit(key).plot(txs, tys, color)
+            self.touch(key)
+        self.grow(int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1, True)
+
+    def raw_value(self, x, y):
+        key, tile = self.tile_at(x, y)
+        if tile is None:
+            return None
+        return tile.raw_value(x - key[0]*self.tileSize, y - key[1]*self.tileSize)
+
+    def read(self, ys, xs):
+        if self.colorTable is None:
+            data = np.zeros((len(ys), 4), dtype=np.uint8)
+        else:
+            data = np.full(len(ys), EMPTY_INDEX, dtype=np.uint8)
+        mask = np.zeros(len(ys), dtype=bool)
+        if len(ys) == 0:
+            return data, mask
+
+        for key, part, tys, txs in self.group(ys, xs):
+            tile = self.tile(key)
+            if tile is not None:
+                data[part], mask[part] = tile.read(tys, txs)
+        return data, mask
+
+    def read_tiles(self, keys):
+        """
+        The tiles at keys that hold pixels, as arrays: their keys, and their
+        data and masks stacked, the masks None for indexed buffers. See restore_tiles.
+        """
+        found = [key for key in keys if self.tile(key) is not None]
+        size = self.tileSize
+        data = np.empty((len(found), size, size) + ((4,) if self.colorTable is None else ()), dtype=np.uint8)
+        mask = None if self.colorTable is not None else np.empty((len(found), size, size), dtype=bool)
+        for i, key in enumerate(found):
+            data[i] = self.tiles[key].data
+            if mask is not None:
+                mask[i] = self.tiles[key].mask
+        return np.array(found, dtype=np.int32).reshape(-1, 2), data, mask
+
+    def region(self, x0, y0, x1, y1, method, out):
+        # assemble the result of a region method of the tiles, missing tiles keep what out holds
+        for key, (tx0, ty0, tx1, ty1) in self.tile_rects(x0, y0, x1, y1):
+            tile = self.tile(key)
+            if tile is not None:
+                left, top = key[0]*self.tileSize, key[1]*self.tileSize
+                out[ty0-y0:ty1-y0, tx0-x0:tx1-x0] = getattr(tile, method)(tx0 - left, ty0 - top, tx1 - left, ty1 - top)
+        return out
+
+    def restore_tiles(self, keys, found, data, mask):
+        """
+        Put back the tiles read_tiles returned as found, data and mask. The
+        other tiles of keys become empty.
+        """
+        stored = {key: i for i, key in enumerate(map(tuple, found.tolist()))}
+        size = self.tileSize
+        for key in keys:
+            self.sourceTiles.discard(key)
+            self.shared.discard(key)
+            if key in stored:
+                tile = self.tiles[key] = self.new_tile()
+                tile.data[...] = data[stored[key]]
+                if mask is not None:
+                    tile.mask[...] = mask[stored[key]]
+                tile.paintedRect = [0, 0, size, size]
+            else:
+                self.tiles.pop(key, None)
+            self.touch(key)
+            x0, y0 = key[0]*size, key[1]*size
+            self.grow(x0, y0, min(x0 + size, self.width), min(y0 + size, self.height), key in stored)
+        if not self.sourceTiles:
+            self.source = None
+
+    def rgba_region(self, x0, y0, x1, y1):
+        return self.region(x0, y0, x1, y1, "rgba_region", np.zeros((y1 - y0, x1 - x0, 4), dtype=np.uint8))
+
+    def same_color_mask(self, x, y, tolerance=0, rect=None):
+        return self.match_mask(self.raw_value(x, y), tolerance, rect)
+
+    def set(self, x, y, color):
+        key = (x // self.tileSize, y // self.tileSize)
+        self.edit(key).set(x - key[0]*self.tileSize, y - key[1]*self.tileSize, color)
+        self.touch(key)
+        self.grow(x, y, x + 1, y + 1, True)
+
+    def set_source(self, source, keys, revision):
+        """
+        Let the tiles at keys be loaded by source(tx, ty) the first time they are used.
+        """
+        self.source = source
+        self.sourceTiles = set(keys)
+        self.sourceRevision = revision
+        self.revision = max(self.revision, revision)
+        self.dirtyTiles |= self.sourceTiles
+
+        if self.sourceTiles:
+            size = self.tileSize
+            x0, y0 = min(tx for tx, _ in self.sourceTiles)*size, min(ty for _, ty in self.sourceTiles)*size
+            x1, y1 = (max(tx for tx, _ in self.sourceTiles) + 1)*size, (max(ty for _, ty in self.sourceTiles) + 1)*size
+            self.grow(x0, y0, min(x1, self.width), min(y1, self.height), True)
+
+    def split_runs(self, runs):
+        """
+        Split (y, x0, x1) row runs, an array, at the tile edges and group
+        them by tile. Yields each tile key with the rows and column ranges of
+        its runs inside the tile.
+        """
+        size = self.tileSize
+        first, last = runs[:, 1] // size, (runs[:, 2] - 1) // size
+        counts = last - first + 1
+        index = np.repeat(np.arange(len(runs)), counts)
+        txs = first[index] + np.arange(len(index)) - np.repeat(np.cumsum(counts) - counts, counts)
+        ys = runs[index, 0]
+        tys = ys // size
+        x0s = np.maximum(runs[index, 1], txs*size) - txs*size
+        x1s = np.minimum(runs[index, 2], (txs + 1)*size) - txs*size
+
+        keys = tys*self.tilesX + txs
+        order = np.argsort(keys, kind="stable")
+        bounds = np.flatnonzero(np.diff(keys[order])) + 1
+        for part in np.split(order, bounds):
+            tx, ty = int(txs[part[0]]), int(tys[part[0]])
+            yield (tx, ty), ys[part] - ty*size, x0s[part], x1s[part]
+
+    def snapshot(self):
+        """
+        A copy of the buffer as it is now, made without copying any pixels.
+        The tiles are shared until one of the two buffers changes them.
+        """
+        buffer = TiledPixelBuffer(self.width, self.height, self.colorTable, self.tileSize)
+        buffer.tiles = dict(self.tiles)
+        buffer.tileRevisions = dict(self.tileRevisions)
+        buffer.source = self.source
+        buffer.sourceTiles = set(self.sourceTiles)
+        buffer.sourceRevision = self.sourceRevision
+        buffer.revision = self.revision
+        buffer.paintedRect = None if self.paintedRect is None else list(self.paintedRect)
+
+        self.shared = set(self.tiles)
+        buffer.shared = set(self.tiles)
+        return buffer
+
+    def stored_tiles(self):
+        # every tile that may hold pixels, loaded or not
+        return set(self.tiles) | self.sourceTiles
+
+    def tile(self, key, create=False):
+        tile = self.tiles.get(key)
+        if tile is None:
+            if key in self.sourceTiles:
+                self.sourceTiles.discard(key)
+                tile = self.tiles[key] = self.source(*key)
+                self.tileRevisions[key] = self.sourceRevision
+                self.shared.add(key)    # the source may hand the same tile to other buffers
+                if not self.sourceTiles:
+                    self.source = None  # let go of what it reads from
+            elif create:
+                tile = self.tiles[key] = self.new_tile()
+        return tile
+
+    def tile_at(self, x, y):
+        key = (x // self.tileSize, y // self.tileSize)
+        return key, self.tile(key)
+
+    def tile_rects(self, x0, y0, x1, y1):
+        """
+        The keys of the tiles overlapping a region, each with the part of the region on it.
+        """
+        size = self.tileSize
+        for ty in range(y0 // size, (y1 - 1) // size + 1):
+            for tx in range(x0 // size, (x1 - 1) // size + 1):
+                yield (tx, ty), (max(x0, tx*size), max(y0, ty*size), min(x1, (tx + 1)*size), min(y1, (ty + 1)*size))
+
+    def tile_revision(self, key):
+        if key in self.sourceTiles:
+            return self.sourceRevision
+        return self.tileRevisions.get(key)
+
+    def tiles_using(self, indices):
+        """
+        The loaded tiles holding any of the palette indices. Tiles loaded
+        later are read with the colors the table has then.
+        """
+        if self.colorTable is None or len(indices) == 0:
+            return set()
+        used = np.zeros(256, dtype=bool)
+        used[indices] = True
+        return {key for key, tile in self.tiles.items() if used[tile.data].any()}
+
+    def to_rgba(self):
+        return self.rgba_region(0, 0, self.width, self.height)
+
+    def touch(self, key):
+        self.revision = self.tileRevisions[key] = next_revision()
+        self.dirtyTiles.add(key)
+
+    def write(self, ys, xs, data, mask):
+        if len(ys) == 0:
+            return
+        for key, part, tys, txs in self.group(ys, xs):
+            tile = self.edit(key, mask[part].any())
+            if tile is not None:
+                tile.write(tys, txs, data[part], mask[part])
+                self.touch(key)
+
+        x0, x1, y0, y1 = int(xs.min()), int(xs.max()) + 1, int(ys.min()), int(ys.max()) + 1
+        self.grow(x0, y0, x1, y1, mask.any())
@@ -0,0 +1,468 @@
+"""
+.pix31 project files, holding everything needed to continue working:
+the canvas size, palette, layers, animation frames, preview layer and the
+undo history.
+
+    header | chunk | chunk | ... | index chunk
+
+The fixed size header points to the index chunk, which holds the layer
+settings and frame durations and lists where the tiles of every layer in
+every frame and the undo history entries are stored. Empty tiles are not
+stored at all, a tile frames share is stored once, and stored tiles are
+only decompressed once the canvas first uses them. A save appends the chunks that changed and a new
+index and only then rewrites the header, so an interrupted save leaves the
+previous version readable. Once the chunks no longer referenced outgrow the live
+ones the next save writes a compacted copy instead.
+"""
+import functools
+import io
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import weakref
+import zlib
+
+import numpy as np
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+import constants as const
+import export as exp
+from canvas import Canvas
+from history import History, read_delta, write_delta
+from layers import BLEND_MODES, Layer
+from pixel_buffer import next_revision
+
+MAGIC = b"PIX31\x00\r\n"
+VERSION = 1
+HEADER = struct.Struct("<8sHHIIHQII")   # magic, version, flags, width, height, tile size, index offset, length, crc
+INDEX = struct.Struct("<4BIIHIHHHH")     # background color, undo count, redo count, palette size, tile count,
+                                         # layer count, active layer, frame count, active frame
+LAYER = struct.Struct("<?BBH")           # visible, opacity, blend mode, name length, followed by the utf-8 name
+DURATION = np.dtype("<u4")               # milliseconds, one per frame after the layers
+FLAG_INDEXED = 1
+
+PREVIEW_LAYER = 255     # layer number of the preview tiles
+
+CODECS = {"none": 0, "zlib": 1, "lz4": 2}
+
+# one entry per stored tile, the crc is of the uncompressed tile
+TILE_ENTRY = np.dtype([("layer", "u1"), ("codec", "u1"), ("tx", "<u2"), ("ty", "<u2"),
+                       ("offset", "<u8"), ("length", "<u4"), ("crc", "<u4"), ("frame", "<u2")])
+# one entry per history delta, undo stack first
+DELTA_ENTRY = np.dtype([("offset", "<u8"), ("length", "<u4"), ("crc", "<u4")])
+
+class ProjectError(ValueError):
+    pass
+
+def compress(raw, codec):
+    if codec == CODECS["zlib"]:
+        return zlib.compress(raw, 1)
+    if codec == CODECS["lz4"]:
+        return lz4.block.compress(raw)
+    return raw
+
+def decompress(data, codec):
+    if codec == CODECS["none"]:
+        return bytes(data)
+    if codec == CODECS["zlib"]:
+        return zlib.decompress(data)
+    if codec == CODECS["lz4"]:
+        if lz4 is None:
+            raise ProjectError("the project is lz4 compressed, install the lz4 package to open it")
+        return lz4.block.decompress(data)
+    raise ProjectError(f"unknown compression {codec}")
+
+def find_tile(projects, key, revision):
+    # the entry of a tile and its project, preferring a project holding this very revision of it
+    found = (None, None)
+    for project in projects:
+        entry = project.tiles.get(key)
+        if entry is not None and project.revisions.get(key) == revision:
+            return project, entry
+        if entry is not None and found[1] is None:
+            found = (project, entry)
+    return found
+
+def layer_buffers(canvas):
+    # the buffers of a canvas by their frame and layer number in the file
+    return [(frame, index, pixels) for index, layer in enumerate(canvas.layers) for frame, pixels in enumerate(layer.frames)] \
+           + [(0, PREVIEW_LAYER, canvas.preview)]
+
+def load_tile(tile, width, height, raw):
+    # decode into the top left width x height pixels of a tile buffer
+    if tile.data.ndim == 2:
+        tile.data[:height, :width] = np.frombuffer(raw, np.uint8).reshape(height, width)
+    else:
+        tile.data[:height, :width] = np.frombuffer(raw, np.uint8, height*width*4).reshape(height, width, 4)
+        mask = np.unpackbits(np.frombuffer(raw, np.uint8, offset=height*width*4), count=height*width)
+        tile.mask[:height, :width] = mask.reshape(height, width)
+    tile.mark_painted(0, 0, width, height)
+    tile.dirtyRect = None
+
+def open_project(path):
+    """
+    Read a project, returns the canvas and the open ProjectFile to pass to
+    save_project. The tiles stay in the file until the canvas uses them.
+    """
+    project = ProjectFile(path)
+    try:
+        canvas = Canvas(project.width, project.height, project.palette if project.indexed else None)
+        canvas.backgroundColor = project.backgroundColor
+        canvas.layers = [Layer(name, [canvas.new_buffer(project.width, project.height) for _ in project.frames],
+                               visible, opacity, blendMode)
+                         for name, visible, opacity, blendMode in project.layers]
+        canvas.activeLayer = project.activeLayer
+        canvas.frameDurations = list(project.frames)
+        canvas.select_frame(project.activeFrame)
+
+        for frame, layer, pixels in layer_buffers(canvas):
+            keys = [(tx, ty) for f, l, tx, ty in project.tiles if f == frame and l == layer]
+            if project.tileSize == pixels.tileSize:
+                revision = next_revision()
+                pixels.set_source(functools.partial(project.load_layer_tile, frame, layer, pixels), keys, revision)
+                project.revisions.update({(frame, layer) + key: revision for key in keys})
+            else:
+                # saved with another tile size, the tiles are decoded right away
+                for key in keys:
+                    x0, y0, x1, y1 = project.tile_rect(*key)
+                    tile = pixels.new_tile(x1 - x0, y1 - y0)
+                    load_tile(tile, x1 - x0, y1 - y0, project.read_tile(frame, layer, *key))
+                    pixels.blit(tile, 0, 0, x1 - x0, y1 - y0, x0, y0)
+        canvas.history = project.read_history()
+    except BaseException:
+        project.close()
+        raise
+
+    return canvas, project
+
+def prepare(canvas, palette, compression):
+    # the codec and palette array a save of the canvas writes
+    if compression not in CODECS:
+        raise ValueError(f"unknown compression '{compression}'")
+    codec = CODECS[compression]
+    if codec == CODECS["lz4"] and lz4 is None:
+        codec = CODECS["zlib"]
+
+    if canvas.colorTable is not None:
+        palette = canvas.colorTable.lut[:canvas.colorTable.count]
+    return codec, np.array(palette, dtype=np.uint8).reshape(-1, 4)
+
+def save_project(canvas, path, project=None, palette=(), compression=const.PROJECT_COMPRESSION):
+    """
+    Save the canvas and return the ProjectFile to pass to the next save.
+    Given the project the canvas was opened or last saved as, tiles that
+    did not change are not compressed or written again. The palette is
+    stored for canvases without a color table of their own.
+    """
+    codec, palette = prepare(canvas, palette, compression)
+
+    # chunks can only be reused by a project of the same layout. Tiles the canvas has not loaded yet are still
+    # read from the project, it is closed only once the new version is written
+    replaced = [] if project is None else [project]
+    if project is not None and not same_layout(project, canvas):
+        project = None
+
+    if project is not None and os.path.abspath(project.path) == os.path.abspath(path) and not project.needs_compaction():
+        with open(path, "r+b") as f:
+            f.seek(0, os.SEEK_END)
+            header, revisions = write_chunks(f, canvas, palette, codec, [project], False)
+            f.flush()
+            os.fsync(f.fileno())
+
+            # the new version becomes visible only once everything it points to is on disk
+            f.seek(0)
+            f.write(header)
+            f.flush()
+            os.fsync(f.fileno())
+        project.close()
+        return reopen(canvas, path, revisions)
+
+    projects = [] if project is None else [project]
+    return write_project(canvas, path, palette, codec, projects, replaced)
+
+def save_snapshot(canvas, path, projects, palette=(), compression=const.PROJECT_COMPRESSION):
+    """
+    Write a complete project of a canvas snapshot, e.g. a recovery file,
+    and return it as a ProjectFile. Tiles that did not change since one of
+    the projects was written are copied from it, not compressed again. The
+    projects are left open.
+    """
+    codec, palette = prepare(canvas, palette, compression)
+    projects = [project for project in projects if project is not None and same_layout(project, canvas)]
+    return write_project(canvas, path, palette, codec, projects, [])
+
+def reopen(canvas, path, revisions):
+    # open the saved file, the tiles the canvas has not loaded yet are now read from it
+    project = ProjectFile(path)
+    project.revisions = revisions
+    for frame, layer, pixels in layer_buffers(canvas):
+        if pixels.sourceTiles:
+            pixels.source = functools.partial(project.load_layer_tile, frame, layer, pixels)
+    return project
+
+def same_layout(project, canvas):
+    return (project.width, project.height, project.indexed, project.tileSize) \
+           == (canvas.width, canvas.height, canvas.colorTable is not None, canvas.pixels.tileSize)
+
+def tile_bytes(tile, width, height):
+    # the top left width x height pixels of a tile buffer, None when none is painted
+    mask = tile.mask_region(0, 0, width, height)
+    if not mask.any():
+        return None
+    if tile.data.ndim == 2:
+        return tile.data[:height, :width].tobytes()
+    return tile.data[:height, :width].tobytes() + np.packbits(mask).tobytes()
+
+def write_chunks(f, canvas, palette, codec, projects, copy):
+    """
+    Write the tiles, history and index at the current position of the file.
+    Returns the header pointing to them and the revision of every tile
+    written. Chunks that did not change are looked up in the projects and
+    copied from them when copy is set, otherwise referenced where they are.
+    A tile several frames share is written once.
+    """
+    copied = {}     # (project, offset) -> offset of a chunk copied already
+
+    def reuse(project, offset, length):
+        # returns where the unchanged chunk is found in the new version
+        if not copy:
+            return offset
+        if (id(project), offset) not in copied:
+            copied[(id(project), offset)] = f.tell()
+            f.write(project.map[offset:offset + length])
+        return copied[(id(project), offset)]
+
+    tileSize = canvas.pixels.tileSize
+    entries = []
+    revisions = {}
+    written = {}    # (tx, ty, revision) -> codec, offset, length and crc, the chunk of a tile frames share
+    for frame, layer, pixels in layer_buffers(canvas):
+        for tx, ty in sorted(pixels.stored_tiles()):
+            key = (frame, layer, tx, ty)
+            revision = pixels.tile_revision((tx, ty))
+            chunk = written.get((tx, ty, revision))
+
+            if chunk is None:
+                project, old = find_tile(projects, key, revision)
+
+                # a tile with the revision the project holds has not changed, not even its bytes are needed
+                if old is not None and project.revisions.get(key) == revision:
+                    chunk = (old[1], reuse(project, old[4], old[5]), old[5], old[6])
+                else:
+                    x0, y0 = tx*tileSize, ty*tileSize
+                    raw = tile_bytes(pixels.tile((tx, ty)), min(tileSize, pixels.width - x0), min(tileSize, pixels.height - y0))
+                    if raw is None:
+                        continue
+
+                    crc = zlib.crc32(raw)
+                    if old is not None and old[6] == crc:
+                        chunk = (old[1], reuse(project, old[4], old[5]), old[5], crc)
+                    else:
+                        data = compress(raw, codec)
+                        chunk = (codec, f.tell(), len(data), crc)
+                        f.write(data)
+                written[(tx, ty, revision)] = chunk
+
+            entries.append((layer, chunk[0], tx, ty, chunk[1], chunk[2], chunk[3], frame))
+            revisions[key] = revision
+
+    deltas = []
+    history = canvas.history
+    undo, redo = history.savable()
+    for delta in undo + redo:
+        buffer = io.BytesIO()
+        write_delta(delta, buffer)
+        raw = buffer.getvalue()
+
+        crc = zlib.crc32(raw)
+        project = next((project for project in projects if crc in project.deltaChunks), None)
+        if project is not None:
+            old = project.deltaChunks[crc]
+            deltas.append((reuse(project, old[0], old[1]), old[1], crc))
+            continue
+
+        data = zlib.compress(raw, 1)
+        deltas.append((f.tell(), len(data), crc))
+        f.write(data)
+
+    layers = b""
+    for layer in canvas.layers:
+        name = layer.name.encode("utf-8")
+        layers += LAYER.pack(layer.visible, layer.opacity, BLEND_MODES.index(layer.blendMode), len(name)) + name
+
+    index = INDEX.pack(*canvas.backgroundColor, len(undo), len(redo), len(palette), len(entries),
+                       len(canvas.layers), canvas.activeLayer, len(canvas.frameDurations), canvas.activeFrame) \
+            + palette.tobytes() + layers + np.array(canvas.frameDurations, dtype=DURATION).tobytes() \
+            + np.array(entries, dtype=TILE_ENTRY).tobytes() + np.array(deltas, dtype=DELTA_ENTRY).tobytes()
+    indexOffset = f.tell()
+    data = zlib.compress(index)
+    f.write(data)
+
+    flags = FLAG_INDEXED if canvas.colorTable is not None else 0
+    header = HEADER.pack(MAGIC, VERSION, flags, canvas.width, canvas.height, tileSize,
+                         indexOffset, len(data), zlib.crc32(index))
+    return header, revisions
+
+def write_project(canvas, path, palette, codec, projects, replaced):
+    """
+    Write a compacted copy of the canvas to a temporary file and move it to
+    path. The projects in replaced are closed before the move, as a mapped
+    file can not be replaced on Windows, and opened again if it fails.
+    """
+    fd, tempPath = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(bytes(HEADER.size))
+            header, revisions = write_chunks(f, canvas, palette, codec, projects, True)
+            f.seek(0)
+            f.write(header)
+        if os.path.exists(path):
+            shutil.copymode(path, tempPath)
+        else:
+            os.chmod(tempPath, exp.newFileMode)     # mkstemp makes its files private
+    except BaseException:
+        os.remove(tempPath)
+        raise
+
+    for project in replaced:
+        project.close()
+    try:
+        os.replace(tempPath, path)
+    except BaseException:
+        for project in replaced:
+            project.map_file()
+        os.remove(tempPath)
+        raise
+
+    return reopen(canvas, path, revisions)
+
+class ProjectFile():
+    """
+    A .pix31 file opened for reading. The file is memory mapped, a tile is
+    only read and decompressed when it is asked for.
+    """
+    def __init__(self, path) -> None:
+        self.path = path
+        self.map_file()
+        self.loadedTiles = weakref.WeakValueDictionary()   # chunk offset -> tile decoded from it
+
+        try:
+            self.read_index()
+        except BaseException:
+            self.map.close()
+            raise
+
+    def close(self):
+        self.map.close()
+
+    def load_layer_tile(self, frame, layer, pixels, tx, ty):
+        # the tile source of a canvas buffer, see TiledPixelBuffer.set_source.
+        # Frames stored with the same chunk get the same tile, shared like those of a copied frame
+        offset = self.tiles[(frame, layer, tx, ty)][4]
+        tile = self.loadedTiles.get(offset)
+        if tile is None:
+            x0, y0, x1, y1 = self.tile_rect(tx, ty)
+            tile = pixels.new_tile()
+            load_tile(tile, x1 - x0, y1 - y0, self.read_tile(frame, layer, tx, ty))
+            self.loadedTiles[offset] = tile
+        return tile
+
+    def map_file(self):
+        with open(self.path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                raise ProjectError(f"{self.path}: not a pix31 project")
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def needs_compaction(self):
+        return len(self.map) - self.liveBytes > self.liveBytes
+
+    def read_chunk(self, offset, length, codec, crc):
+        if offset + length > len(self.map):
+            raise ProjectError(f"{self.path}: file is truncated")
+
+        try:
+            raw = decompress(self.map[offset:offset + length], codec)
+        except (zlib.error, RuntimeError) as e:
+            raise ProjectError(f"{self.path}: chunk at byte {offset} is corrupt ({e})")
+        if not zlib.crc32(raw) == crc:
+            raise ProjectError(f"{self.path}: chunk at byte {offset} is corrupt")
+        return raw
+
+    def read_history(self, budget=const.HISTORY_BUDGET_BYTES):
+        deltas = [read_delta(io.BytesIO(self.read_chunk(offset, length, CODECS["zlib"], crc)))
+                  for offset, length, crc in self.deltas]
+
+        if any(delta.layer >= len(self.layers) or delta.frame >= len(self.frames) for delta in deltas):
+            raise ProjectError(f"{self.path}: the undo history refers to a missing layer or frame")
+
+        history = History(budget)
+        history.restore(deltas[:self.undoCount], deltas[self.undoCount:])
+        return history
+
+    def read_index(self):
+        magic, version, flags, self.width, self.height, self.tileSize, indexOffset, indexLength, indexCrc \
+            = HEADER.unpack_from(self.map)
+        if not magic == MAGIC:
+            raise ProjectError(f"{self.path}: not a pix31 project")
+        if version != VERSION:
+            raise ProjectError(f"{self.path}: saved by another version of {const.APP_NAME}")
+        self.indexed = bool(flags & FLAG_INDEXED)
+
+        index = self.read_chunk(indexOffset, indexLength, CODECS["zlib"], indexCrc)
+        *background, self.undoCount, redoCount, paletteSize, tileCount, layerCount, self.activeLayer, \
+            frameCount, self.activeFrame = INDEX.unpack_from(index)
+        offset = INDEX.size
+        self.backgroundColor = tuple(background)
+
+        palette = np.frombuffer(index, np.uint8, paletteSize*4, offset).reshape(-1, 4)
+        self.palette = [tuple(c) for c in palette.tolist()]
+        offset += paletteSize*4
+
+        if not 0 <= self.activeLayer < layerCount:
+            raise ProjectError(f"{self.path}: the active layer {self.activeLayer + 1} does not exist")
+        if not 0 <= self.activeFrame < frameCount:
+            raise ProjectError(f"{self.path}: the active frame {self.activeFrame + 1} does not exist")
+
+        # (name, visible, opacity, blend mode) of every layer, bottom to top
+        self.layers = []
+        for number in range(layerCount):
+            visible, opacity, blendMode, nameLength = LAYER.unpack_from(index, offset)
+            offset += LAYER.size
+            name = index[offset:offset + nameLength].decode("utf-8", "replace")
+            offset += nameLength
+            if blendMode >= len(BLEND_MODES):
+                raise ProjectError(f"{self.path}: layer {number + 1} has an unknown blend mode")
+            self.layers.append((name, visible, opacity, BLEND_MODES[blendMode]))
+
+        # milliseconds each frame is shown
+        self.frames = np.frombuffer(index, DURATION, frameCount, offset).tolist()
+        offset += frameCount*DURATION.itemsize
+
+        table = np.frombuffer(index, TILE_ENTRY, tileCount, offset)
+        self.tiles = {(e[7], e[0], e[2], e[3]): e for e in table.tolist()}     # (frame, layer, tx, ty) -> entry
+        self.revisions = {}     # (frame, layer, tx, ty) -> revision of the canvas tile stored in the entry
+
+        offset += tileCount*TILE_ENTRY.itemsize
+        deltas = np.frombuffer(index, DELTA_ENTRY, self.undoCount + redoCount, offset)
+        self.deltas = deltas.tolist()
+        self.deltaChunks = {e[2]: e for e in self.deltas}   # crc -> entry
+
+        _, chunks = np.unique(table["offset"], return_index=True)     # frames may share a chunk
+        self.liveBytes = HEADER.size + indexLength + int(table["length"][chunks].sum()) + int(deltas["length"].sum())
+
+    def read_tile(self, frame, layer, tx, ty):
+        entry = self.tiles.get((frame, layer, tx, ty))
+        if entry is None:
+            return None
+        return self.read_chunk(entry[4], entry[5], entry[1], entry[6])
+
+    def tile_rect(self, tx, ty):
+        x0, y0 = tx*self.tileSize, ty*self.tileSize
+        return x0, y0, min(x0 + self.tileSize, self.width), min(y0 + self.tileSize, self.height)
@@ -0,0 +1,110 @@
+import ctypes
+
+import numpy as np
+import pyglet
+import pyglet.gl as gl
+
+import constants as const
+
+class LayerTexture():
+    """
+    Draws a TiledPixelBuffer as a grid of textures, each created once
+    something is painted on its part of the buffer. Changed tiles are
+    uploaded when the layer is synced, only for the textures in view.
+    """
+    def __init__(self, pixels, x, y, opacity=255) -> None:
+        self.pixels = pixels
+        self.x = x
+        self.y = y
+        self.opacity = opacity      # 0-255
+        self.chunkSize = const.TEXTURE_CHUNK_SIZE
+        self.colorRevision = None   # palette revision last uploaded, for indexed buffers
+
+        self.batch = pyglet.graphics.Batch()
+        self.chunks = {}            # (cx, cy) -> sprite of the texture
+        self.pendingTiles = {}      # (cx, cy) -> tiles changed since that texture was uploaded
+
+        self.queue(pixels.stored_tiles())
+        self.sync()
+
+    def chunk_rect(self, key):
+        # part of the buffer a texture covers, buffer rows counting from the top
+        x0, y0 = key[0]*self.chunkSize, key[1]*self.chunkSize
+        return x0, y0, min(x0 + self.chunkSize, self.pixels.width), min(y0 + self.chunkSize, self.pixels.height)
+
+    def create_chunk(self, key):
+        x0, y0, x1, y1 = self.chunk_rect(key)
+
+        # GL_NEAREST keeps the pixels sharp when zoomed
+        texture = pyglet.image.Texture.create(x1 - x0, y1 - y0, min_filter=gl.GL_NEAREST, mag_filter=gl.GL_NEAREST)
+        self.chunks[key] = pyglet.sprite.Sprite(texture, x=self.x + x0, y=self.y + self.pixels.height - y1, batch=self.batch)
+        self.chunks[key].opacity = self.opacity
+
+    def delete(self):
+        for sprite in self.chunks.values():
+            sprite.delete()
+        self.chunks.clear()
+
+    def draw(self, view=None):
+        self.sync(view)
+        self.batch.draw()
+
+    def queue(self, tiles):
+        ratio = self.chunkSize // self.pixels.tileSize
+        for tx, ty in tiles:
+            self.pendingTiles.setdefault((tx // ratio, ty // ratio), set()).add((tx, ty))
+
+    def set_position(self, x, y):
+        self.x, self.y = x, y
+        for key, sprite in self.chunks.items():
+            x0, _, _, y1 = self.chunk_rect(key)
+            sprite.update(x=x + x0, y=y + self.pixels.height - y1)
+
+    def sync(self, view=None):
+        """
+        Upload the changed tiles. With a view (x0, y0, x1, y1) in canvas
+        coordinates only the textures it overlaps are updated, the others
+        wait until they are in view.
+        """
+        # a changed palette color is uploaded again where it is used
+        colorTable = self.pixels.colorTable
+        if colorTable is not None and not colorTable.revision == self.colorRevision:
+            if self.colorRevision is not None:
+                self.queue(self.pixels.tiles_using(colorTable.changed_since(self.colorRevision)))
+            self.colorRevision = colorTable.revision
+
+        self.queue(self.pixels.dirtyTiles)
+        self.pixels.dirtyTiles = set()
+        self.pixels.dirtyRect = None
+
+        for key in list(self.pendingTiles):
+            x0, y0, x1, y1 = self.chunk_rect(key)
+            if view is not None and (x1 <= view[0] or x0 >= view[2] or
+                                     self.pixels.height - y0 <= view[1] or self.pixels.height - y1 >= view[3]):
+                continue
+            self.upload(key, self.pendingTiles.pop(key))
+
+    def upload(self, key, tiles):
+        if key not in self.chunks:
+            if not any(tile in self.pixels.tiles or tile in self.pixels.sourceTiles for tile in tiles):
+                return      # nothing painted here yet, no texture needed
+            self.create_chunk(key)
+
+        # one upload covering the changed tiles of the texture
+        size = self.pixels.tileSize
+        cx0, cy0, cx1, cy1 = self.chunk_rect(key)
+        x0 = max(min(tx for tx, _ in tiles)*size, cx0)
+        y0 = max(min(ty for _, ty in tiles)*size, cy0)
+        x1 = min((max(tx for tx, _ in tiles) + 1)*size, cx1)
+        y1 = min((max(ty for _, ty in tiles) + 1)*size, cy1)
+
+        # buffer rows go from top to bottom, texture rows from bottom to top
+        region = np.ascontiguousarray(self.pixels.rgba_region(x0, y0, x1, y1)[::-1])
+
+        texture = self.chunks[key].image
+        gl.glBindTexture(texture.target, texture.id)
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+        gl.glTexSubImage2D(texture.target, 0,
+                           x0 - cx0, cy1 - y1, x1 - x0, y1 - y0,
+                           gl.GL_RGBA, gl.GL_UNSIGNED_BYTE,
+                           region.ctypes.data_as(ctypes.POINTER(gl.GLubyte)))
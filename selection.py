@@ -0,0 +1,63 @@
+"""
+Selected canvas pixels and the floating pixels of a paste or move.
+
+Both keep their position in buffer coordinates, rows counting from the
+top, and cover a bounding box: a selection with a bitmask of it, floating
+pixels with a dense pixel buffer of it. Copying, cutting and moving them
+are block transfers of whole tile slices, see TiledPixelBuffer.crop, blit
+and erase.
+"""
+import numpy as np
+
+def select_rectangle(x0, y0, x1, y1, width, height):
+    """
+    The pixels of the rectangle between two corners in buffer coordinates,
+    both included, clipped to a canvas of the size. None when it is outside.
+    """
+    x0, x1 = max(min(x0, x1), 0), min(max(x0, x1) + 1, width)
+    y0, y1 = max(min(y0, y1), 0), min(max(y0, y1) + 1, height)
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return Selection(x0, y0, np.ones((y1 - y0, x1 - x0), dtype=bool))
+
+def select_runs(runs, height):
+    """
+    The pixels of (y, x0, x1) runs in canvas coordinates, e.g. the area
+    flood_fill returns.
+    """
+    runs = np.asarray(runs).reshape(-1, 3)
+    rows = height - 1 - runs[:, 0]
+    x0, y0 = int(runs[:, 1].min()), int(rows.min())
+
+    # +1 where a run starts and -1 where it ends, summed along the rows
+    edges = np.zeros((int(rows.max()) + 1 - y0, int(runs[:, 2].max()) + 1 - x0), dtype=np.int32)
+    np.add.at(edges, (rows - y0, runs[:, 1] - x0), 1)
+    np.add.at(edges, (rows - y0, runs[:, 2] - x0), -1)
+    return Selection(x0, y0, np.cumsum(edges, axis=1)[:, :-1] > 0)
+
+class Selection():
+    def __init__(self, x, y, mask) -> None:
+        self.x = x          # top left corner of the bounding box
+        self.y = y
+        self.mask = mask    # True for the selected pixels of the bounding box
+
+    def contains(self, x, y):
+        x, y = x - self.x, y - self.y
+        return 0 <= y < self.mask.shape[0] and 0 <= x < self.mask.shape[1] and bool(self.mask[y, x])
+
+    def rect(self):
+        return self.x, self.y, self.x + self.mask.shape[1], self.y + self.mask.shape[0]
+
+class Floating():
+    """
+    Pixels placed over the active layer but not part of it yet, shown on
+    the preview layer until they are committed.
+    """
+    def __init__(self, pixels, x, y, lifted=None) -> None:
+        self.pixels = pixels    # dense buffer holding only the floating pixels
+        self.x = x
+        self.y = y
+        self.lifted = lifted    # (ys, xs, data, mask) the pixels had where a move lifted them off the layer
+
+    def selection(self):
+        return Selection(self.x, self.y, self.pixels.mask.copy())
@@ -0,0 +1,67 @@
+import numpy as np
+
+from canvas import Canvas
+
+def fill(canvas, color):
+    canvas.pixels.fill_runs(np.array([(y, 0, canvas.width) for y in range(canvas.height)]), color)
+
+def images(canvas):
+    return [[pixels.to_rgba() for pixels in layer.frames] for layer in canvas.layers]
+
+def test_chained_flips_keep_each_layer():
+    canvas = Canvas(100, 80)
+    fill(canvas, (255, 0, 0, 255))
+    canvas.add_layer()
+    fill(canvas, (0, 0, 255, 255))
+
+    canvas.flip()
+    canvas.flip()
+    assert tuple(canvas.layers[0].pixels.get(5, 5)) == (255, 0, 0, 255)
+    assert tuple(canvas.layers[1].pixels.get(5, 5)) == (0, 0, 255, 255)
+
+def test_chained_flips_keep_each_frame():
+    canvas = Canvas(100, 80)
+    for index, color in enumerate(((255, 0, 0, 255), (0, 0, 255, 255), (0, 255, 0, 255))):
+        if index:
+            canvas.add_frame(False)
+        fill(canvas, color)
+
+    canvas.flip()
+    canvas.compositor.sync()
+    canvas.flip()
+    for index, color in enumerate(((255, 0, 0, 255), (0, 0, 255, 255), (0, 255, 0, 255))):
+        assert tuple(canvas.layers[0].frames[index].get(5, 5)) == color
+
+def test_chained_transforms_match_numpy():
+    rng = np.random.default_rng(1)
+    canvas = Canvas(150, 100)
+    for layer in range(3):
+        if layer:
+            canvas.add_layer()
+        for frame in range(3):
+            if layer == 0 and frame:
+                canvas.add_frame(frame == 1)    # the second frame starts as a copy sharing the tiles
+            canvas.select_frame(frame)
+            xs, ys = rng.integers(0, canvas.width, 2000), rng.integers(0, canvas.height, 2000)
+            colors = rng.integers(1, 256, (2000, 4), dtype=np.uint8)
+            canvas.pixels.write(ys, xs, colors, np.ones(2000, dtype=bool))
+
+    expected = images(canvas)
+    steps = [
+        (lambda: canvas.flip(), lambda a: a[:, ::-1]),
+        (lambda: canvas.rotate(1), lambda a: np.rot90(a, -1)),
+        (lambda: canvas.flip(False), lambda a: a[::-1]),
+        (lambda: canvas.scale(2), lambda a: a.repeat(2, 0).repeat(2, 1)),
+        (lambda: canvas.resize(190, 260, (0.5, 0.5)), lambda a: a[20:280, 5:195]),
+        (lambda: canvas.resize(230, 300, (0, 1)), lambda a: np.pad(a, ((40, 0), (0, 40), (0, 0)))),
+        (lambda: canvas.rotate(2), lambda a: a[::-1, ::-1]),
+    ]
+    for step, (apply, reference) in enumerate(steps):
+        apply()
+        if step % 2:
+            canvas.compositor.sync()    # loads the tiles of the active frame, the others stay to be made
+        expected = [[reference(image) for image in frames] for frames in expected]
+
+    for frames, wanted in zip(images(canvas), expected):
+        for image, want in zip(frames, wanted):
+            assert (image == want).all()
@@ -0,0 +1,147 @@
+"""
+Whole-image transforms of TiledPixelBuffers: flips, quarter turns,
+integer nearest-neighbour scaling and resizing around an anchor.
+
+A transform returns the new buffer right away, whatever the size of the
+image. Each of its tiles is made the first time it is used, by cropping
+the old pixels it comes from and flipping, rotating or repeating them as
+one numpy array, see TiledPixelBuffer.set_source. Regions the old buffer
+has no tiles on stay empty without being visited.
+"""
+import numpy as np
+
+from pixel_buffer import TiledPixelBuffer, next_revision
+
+def flip(pixels, horizontal=True, cache=None):
+    width, height = pixels.width, pixels.height
+    if horizontal:
+        mirror = lambda x0, y0, x1, y1: (width - x1, y0, width - x0, y1)
+    else:
+        mirror = lambda x0, y0, x1, y1: (x0, height - y1, x1, height - y0)
+    return transformed(pixels, width, height, mirror, mirror, lambda a, rect: a[:, ::-1] if horizontal else a[::-1], cache)
+
+def packed(data):
+    # RGBA pixels as one uint32 each, numpy moves those much faster than four separate bytes
+    if data.ndim == 3:
+        return data.view(np.uint32)[..., 0]
+    return data
+
+def resize(pixels, width, height, x, y, cache=None):
+    """
+    The pixels on a canvas of another size, their top left corner at
+    (x, y) of it. Pixels falling outside are cut off.
+    """
+    moved = lambda x0, y0, x1, y1: (x0 + x, y0 + y, x1 + x, y1 + y)
+    back = lambda x0, y0, x1, y1: (x0 - x, y0 - y, x1 - x, y1 - y)
+    return transformed(pixels, width, height, moved, back, lambda a, rect: a, cache)
+
+def rotate(pixels, turns=1, cache=None):
+    """
+    The pixels turned clockwise by a number of quarter turns.
+    """
+    width, height = pixels.width, pixels.height
+    turns %= 4
+    if turns == 1:
+        # the left column becomes the top row
+        target = lambda x0, y0, x1, y1: (height - y1, x0, height - y0, x1)
+        source = lambda x0, y0, x1, y1: (y0, height - x1, y1, height - x0)
+        return transformed(pixels, height, width, target, source, lambda a, rect: np.rot90(a, -1), cache)
+    if turns == 3:
+        target = lambda x0, y0, x1, y1: (y0, width - x1, y1, width - x0)
+        source = lambda x0, y0, x1, y1: (width - y1, x0, width - y0, x1)
+        return transformed(pixels, height, width, target, source, lambda a, rect: np.rot90(a, 1), cache)
+    if turns == 2:
+        turn = lambda x0, y0, x1, y1: (width - x1, height - y1, width - x0, height - y0)
+        return transformed(pixels, width, height, turn, turn, lambda a, rect: a[::-1, ::-1], cache)
+    return pixels.snapshot()
+
+def scale(pixels, factor, cache=None):
+    """
+    The pixels enlarged by a whole factor, each one becoming a square of factor x factor pixels.
+    """
+    def repeat(a, rect):
+        # the pixel each pixel of the region comes from, relative to the cropped source region
+        x0, y0, x1, y1 = rect
+        ys = np.arange(y0, y1) // factor - y0 // factor
+        xs = np.arange(x0, x1) // factor - x0 // factor
+        return a[ys[:, None], xs]
+
+    target = lambda x0, y0, x1, y1: (x0*factor, y0*factor, x1*factor, y1*factor)
+    source = lambda x0, y0, x1, y1: (x0 // factor, y0 // factor, (x1 - 1) // factor + 1, (y1 - 1) // factor + 1)
+    return transformed(pixels, pixels.width*factor, pixels.height*factor, target, source, repeat, cache)
+
+def transformed(pixels, width, height, target, source, apply, cache=None):
+    """
+    A buffer of the size holding the pixels transformed. target maps a
+    region (x0, y0, x1, y1) of the pixels to the region of the new buffer
+    it lands on and source maps one back, apply(array, region) turns the
+    array of a source region into that of the new region.
+    """
+    old = pixels.snapshot()
+    if not isinstance(old.source, TransformSource):
+        # e.g. a project, it may be closed before every new tile is made
+        for key in list(old.sourceTiles):
+            old.tile(key)
+
+    buffer = TiledPixelBuffer(width, height, pixels.colorTable, pixels.tileSize)
+    size = buffer.tileSize
+    # the new tiles the old ones land on, for all of them at once
+    keys = set()
+    stored = np.array(sorted(old.stored_tiles()), dtype=np.int64).reshape(-1, 2)*size
+    x0, y0, x1, y1 = target(stored[:, 0], stored[:, 1],
+                            np.minimum(stored[:, 0] + size, pixels.width), np.minimum(stored[:, 1] + size, pixels.height))
+    x0, y0, x1, y1 = np.maximum(x0, 0), np.maximum(y0, 0), np.minimum(x1, width), np.minimum(y1, height)
+    inside = (x0 < x1) & (y0 < y1)
+    tx0, ty0, tx1, ty1 = x0[inside] // size, y0[inside] // size, (x1[inside] - 1) // size, (y1[inside] - 1) // size
+    for dy in range(int((ty1 - ty0).max(initial=0)) + 1):
+        for dx in range(int((tx1 - tx0).max(initial=0)) + 1):
+            part = (tx0 + dx <= tx1) & (ty0 + dy <= ty1)
+            keys.update(zip((tx0[part] + dx).tolist(), (ty0[part] + dy).tolist()))
+    buffer.set_source(TransformSource(old, buffer, source, apply, {} if cache is None else cache), keys, next_revision())
+    return buffer
+
+class TransformSource():
+    """
+    Makes the tiles of a transformed buffer from those of the old one, see
+    transformed. Tiles made from the same old tiles are made once per
+    cache, e.g. a WeakValueDictionary passed to the same transform of
+    every frame, so the frames of an animation keep sharing what they
+    shared before.
+    """
+    def __init__(self, old, buffer, source, apply, cache) -> None:
+        self.old = old          # snapshot of the buffer before the transform
+        self.buffer = buffer
+        self.source = source
+        self.apply = apply
+        self.cache = cache
+
+    def __call__(self, tx, ty):
+        old, size = self.old, self.buffer.tileSize
+        x0, y0 = tx*size, ty*size
+        x1, y1 = min(x0 + size, self.buffer.width), min(y0 + size, self.buffer.height)
+        rect = self.source(x0, y0, x1, y1)
+        # tiles still to be made by an earlier transform count too, their revision is that of their buffer
+        found = [(key, part) for key, part in old.tile_rects(*rect) if key in old.tiles or key in old.sourceTiles]
+        made = (tx, ty) + tuple((key, old.tile_revision(key)) for key, _ in found)
+        tile = self.cache.get(made)
+        if tile is not None:
+            return tile
+
+        if len(found) == 1 and found[0][1] == rect:
+            # inside a single old tile, read from it directly
+            key = found[0][0]
+            left, top, tile = key[0]*size, key[1]*size, old.tile(key)
+            data = tile.data[rect[1] - top:rect[3] - top, rect[0] - left:rect[2] - left]
+            mask = tile.mask_region(rect[0] - left, rect[1] - top, rect[2] - left, rect[3] - top)
+        else:
+            region = old.crop(*rect)
+            data, mask = region.data, region.mask
+
+        tile = self.buffer.new_tile()
+        packed(tile.data)[:y1 - y0, :x1 - x0] = self.apply(packed(data), (x0, y0, x1, y1))
+        if data.ndim == 3:
+            tile.mask[:y1 - y0, :x1 - x0] = self.apply(mask, (x0, y0, x1, y1))
+        tile.mark_painted(0, 0, x1 - x0, y1 - y0)
+        tile.dirtyRect = None
+        self.cache[made] = tile
+        return tile